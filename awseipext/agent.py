@@ -0,0 +1,499 @@
+"""
+.. module: awseipext.agent
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+A resident per-host agent that makes EIP calls for local processes over a
+unix socket. It keeps one AwseipextClient, with its tokens minted ahead of
+time and its Lambda connections open, so a local call costs a socket round
+trip and the invocation, rather than an interpreter start, a boto3 import,
+a KMS call and a TLS handshake. Identical requests for an IP that arrive
+while one is in flight share its result; conflicting ones wait their turn.
+"""
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import logging
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from awseipext.service import (
+    PooledHandlerMixIn,
+    PooledMixIn,
+    UnixHTTPConnection
+)
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('associate', 'disassociate', 'move')
+DEFAULT_SOCKET = '/var/run/awseipext-agent.sock'
+DEFAULT_WORKERS = 10
+# Seconds between checks of the warm tokens.
+DEFAULT_REFRESH_INTERVAL = 30
+# Seconds an IP's tokens are kept warm after its last call.
+DEFAULT_WARM_TTL = 3600
+# Seconds to wait for the rest of a request that's started to arrive.
+IDLE_TIMEOUT = 60
+
+
+class _Call(object):
+    """An in-flight call, which identical requests can wait on."""
+
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class EIPAgent(object):
+    def __init__(
+            self,
+            client,
+            warm_resources=None,
+            warm_actions=('associate', 'disassociate'),
+            refresh_interval=DEFAULT_REFRESH_INTERVAL,
+            warm_ttl=DEFAULT_WARM_TTL
+            ):
+        """
+        Makes EIP calls through a shared AwseipextClient, coalescing
+        concurrent duplicates and keeping tokens warm.
+
+        :param client: The AwseipextClient to make calls with.
+        :param warm_resources: IPs to keep tokens minted for for as long as
+            the agent runs. Tokens for other IPs are kept warm once they've
+            been used, until they go unused for warm_ttl.
+        :param warm_actions: Actions to keep tokens minted for.
+        :param refresh_interval: Seconds between checks of the warm tokens.
+        :param warm_ttl: Seconds a used IP's tokens are kept warm after its
+            last call.
+        """
+        self.client = client
+        self.warm_actions = tuple(warm_actions)
+        self.refresh_interval = refresh_interval
+        self.warm_ttl = warm_ttl
+        self.pinned = set(
+            (action, resource)
+            for resource in warm_resources or []
+            for action in self.warm_actions
+        )
+        # (action, resource) tuples that have been called, to the time of
+        # their last call.
+        self.warm = {}
+        self.calls = {}
+        self.lock = threading.Condition()
+        self.stopped = threading.Event()
+        self.refresher = None
+        self.coalesced = 0
+
+    def call(self, action, resource, instance_id):
+        """
+        Make a call, or wait for an identical one that's already in flight
+        and share its response. A call for an IP that has a different call
+        in flight waits for that one to finish first.
+
+        :return: The response, as AwseipextClient returns it.
+        """
+        if action not in ACTIONS:
+            raise ValueError('{0} is not a valid action.'.format(action))
+        key = (action, resource, instance_id)
+        with self.lock:
+            while True:
+                current = self.calls.get(resource)
+                if current is None:
+                    call = _Call(key)
+                    self.calls[resource] = call
+                    self.warm[(action, resource)] = time.time()
+                    break
+                if current.key == key:
+                    self.coalesced += 1
+                    break
+                self.lock.wait()
+        if current is not None:
+            return current.wait()
+        try:
+            call.result = getattr(self.client, action)(resource, instance_id)
+        except Exception as e:
+            call.error = e
+        with self.lock:
+            del self.calls[resource]
+            self.lock.notify_all()
+        call.done.set()
+        return call.wait()
+
+    def refresh_tokens(self):
+        """
+        Mint tokens for the warm actions and IPs that would otherwise
+        expire before the next refresh. Used IPs that have gone unused for
+        warm_ttl stop being kept warm.
+
+        :return: The number of tokens minted.
+        """
+        with self.lock:
+            cutoff = time.time() - self.warm_ttl
+            for key, used in list(self.warm.items()):
+                if used < cutoff:
+                    del self.warm[key]
+            warm = sorted(self.pinned.union(self.warm))
+        minted = 0
+        for action, resource in warm:
+            try:
+                if self.client.warm_token(
+                        action,
+                        resource,
+                        min_ttl=2 * self.refresh_interval):
+                    minted += 1
+            except Exception:
+                logger.exception('Failed to mint a token for {0} {1}.'.format(
+                    action,
+                    resource
+                ))
+        return minted
+
+    def warm_connection(self):
+        """
+        Open a connection to Lambda ahead of the first call, with a DryRun
+        invocation, which also checks the agent may invoke the function.
+        """
+        self.client.lambda_client.invoke(
+            FunctionName=self.client.function_name,
+            InvocationType='DryRun'
+        )
+
+    def _refresh(self):
+        while not self.stopped.wait(self.refresh_interval):
+            self.refresh_tokens()
+
+    def start(self):
+        """
+        Warm the tokens and connection, and start refreshing the tokens in
+        the background.
+        """
+        self.refresh_tokens()
+        try:
+            self.warm_connection()
+        except Exception:
+            logger.exception('Failed to warm the Lambda connection.')
+        self.refresher = threading.Thread(target=self._refresh)
+        self.refresher.daemon = True
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.refresher is not None:
+            self.refresher.join()
+
+
+class AgentHandler(
+        PooledHandlerMixIn,
+        BaseHTTPServer.BaseHTTPRequestHandler
+        ):
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._respond(status, json.dumps({'result': False, 'error': message}))
+
+    def do_GET(self):
+        if self.path == '/ping':
+            self._respond(200, json.dumps({'result': True}))
+        else:
+            self._error(404, 'Not found.')
+
+    def do_POST(self):
+        if self.path != '/':
+            self._error(404, 'Not found.')
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length))
+            action = request['action']
+            resource = request['resource']
+            instance_id = request['instance_id']
+            for value in (action, resource, instance_id):
+                if not isinstance(value, basestring):
+                    raise TypeError(value)
+        except (ValueError, KeyError, TypeError):
+            self._error(
+                400,
+                'Expected a JSON object with action, resource and'
+                ' instance_id.'
+            )
+            return
+        if action not in ACTIONS:
+            self._error(400, '{0} is not a valid action.'.format(action))
+            return
+        try:
+            response = self.server.agent.call(action, resource, instance_id)
+        except Exception as e:
+            logger.exception('Call failed.')
+            self._error(502, '{0}: {1}'.format(type(e).__name__, e))
+            return
+        self._respond(200, response)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class AgentServer(PooledMixIn, SocketServer.UnixStreamServer, object):
+    def __init__(
+            self,
+            path,
+            agent,
+            workers=DEFAULT_WORKERS,
+            mode=0o660
+            ):
+        """
+        Serve an EIPAgent on a unix socket. A stale socket file at path is
+        replaced.
+
+        :param path: Path of the socket.
+        :param agent: The EIPAgent to serve.
+        :param workers: Number of requests to handle at once.
+        :param mode: Permissions of the socket file. Anyone who can write
+            to it can make calls as this host.
+        """
+        self.agent = agent
+        self.mode = mode
+        self.init_pool(workers)
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, AgentHandler)
+
+    def server_bind(self):
+        # Create the socket file with its mode, rather than changing it
+        # after bind, which would leave a window where anyone could connect.
+        # The umask is process-wide, but the server is created at startup.
+        umask = os.umask(0o777 & ~self.mode)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super(AgentServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class AgentClient(object):
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        """
+        A client for an agent's socket, with the call methods of
+        AwseipextClient. Each thread gets its own connection.
+
+        :param path: Path of the agent's socket.
+        :param timeout: Socket timeout, in seconds.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _request(self, body):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = UnixHTTPConnection(self.path, self.timeout)
+            self.local.connection = connection
+        try:
+            connection.request('POST', '/', body)
+            return connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The agent may have closed an idle connection; retry once on a
+            # new one.
+            connection.close()
+            connection.request('POST', '/', body)
+            return connection.getresponse()
+
+    def _call(self, action, resource, instance_id):
+        response = self._request(json.dumps({
+            'action': action,
+            'resource': resource,
+            'instance_id': instance_id
+        }))
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError('Agent call failed ({0}): {1}'.format(
+                response.status,
+                body
+            ))
+        return body
+
+    def associate(self, resource, instance_id):
+        return self._call('associate', resource, instance_id)
+
+    def disassociate(self, resource, instance_id):
+        return self._call('disassociate', resource, instance_id)
+
+    def move(self, resource, instance_id):
+        return self._call('move', resource, instance_id)
+
+
+def main():
+    from awseipext.client import AwseipextClient
+    from awseipext.token_cache import TokenCache
+
+    parser = argparse.ArgumentParser(
+        description='A per-host agent making EIP calls for local processes'
+                    ' over a unix socket.'
+    )
+    parser.add_argument(
+        '--socket',
+        default=DEFAULT_SOCKET,
+        help='Unix socket to listen on. Default: {0}'.format(DEFAULT_SOCKET)
+    )
+    parser.add_argument(
+        '--socket-mode',
+        type=lambda value: int(value, 8),
+        default=0o660,
+        help='Permissions of the socket, in octal. Default: 660'
+    )
+    parser.add_argument(
+        '--function-name',
+        required=True,
+        help='lambda function name to call.'
+    )
+    parser.add_argument(
+        '--to',
+        required=True,
+        dest='_to',
+        help='"to" kmsauth context.'
+    )
+    parser.add_argument(
+        '--from',
+        required=True,
+        dest='_from',
+        help='"from" kmsauthcontext.'
+    )
+    parser.add_argument(
+        '--user-type',
+        help='"user_type" context. Default: service',
+        default='service'
+    )
+    parser.add_argument(
+        '--kmsauth-key',
+        required=True,
+        help='KMS key to use for auth.'
+    )
+    parser.add_argument(
+        '--endpoint-url',
+        help='Invoke the function at this endpoint rather than in Lambda.'
+    )
+    parser.add_argument(
+        '--region',
+        help='Region of the IPs and instances, whose KMS key tokens are'
+             ' minted with. Default: tokens are minted in us-east-1 and the'
+             ' function acts in its own region.'
+    )
+    parser.add_argument(
+        '--function-region',
+        help='Region of the function to invoke. Default: --region'
+    )
+    parser.add_argument(
+        '--warm',
+        action='append',
+        default=[],
+        metavar='IP',
+        help='IP to keep tokens minted for from startup. May be repeated.'
+    )
+    parser.add_argument(
+        '--refresh-interval',
+        type=float,
+        default=DEFAULT_REFRESH_INTERVAL,
+        help='Seconds between checks of the warm tokens. Default: {0}'.format(
+            DEFAULT_REFRESH_INTERVAL
+        )
+    )
+    parser.add_argument(
+        '--warm-ttl',
+        type=float,
+        default=DEFAULT_WARM_TTL,
+        help='Seconds to keep tokens warm for an IP that\'s been used, after'
+             ' its last call. Default: {0}'.format(DEFAULT_WARM_TTL)
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='Number of requests to handle at once. Default: {0}'.format(
+            DEFAULT_WORKERS
+        )
+    )
+    parser.add_argument(
+        '--token-cache-file',
+        help='File to cache kmsauth tokens in, to share them with the CLI.',
+        default=None
+    )
+    parser.add_argument(
+        '--log-level',
+        help='Logging verbosity.',
+        default='info'
+    )
+    args = parser.parse_args()
+    if args.refresh_interval <= 0:
+        parser.error('--refresh-interval must be positive')
+
+    numeric_loglevel = getattr(logging, args.log_level.upper(), None)
+    if not isinstance(numeric_loglevel, int):
+        raise ValueError('Invalid log level: {0}'.format(args.log_level))
+    logging.basicConfig(
+        level=numeric_loglevel,
+        format='%(asctime)s %(name)s: %(levelname)s %(message)s',
+        stream=sys.stderr
+    )
+
+    client = AwseipextClient(
+        args.function_name,
+        args.kmsauth_key,
+        args._from,
+        args._to,
+        args.user_type,
+        token_cache=TokenCache(cache_file=args.token_cache_file),
+        max_pool_connections=args.workers,
+        endpoint_url=args.endpoint_url,
+        log_type='None',
+        region=args.region,
+        function_region=args.function_region
+    )
+    agent = EIPAgent(
+        client,
+        warm_resources=args.warm,
+        refresh_interval=args.refresh_interval,
+        warm_ttl=args.warm_ttl
+    )
+    agent.start()
+    server = AgentServer(
+        args.socket,
+        agent,
+        workers=args.workers,
+        mode=args.socket_mode
+    )
+    logger.info('Listening on {0}.'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        agent.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,148 +3,671 @@
     :copyright: (c) 2016 by Lyft Inc.
     :license: Apache, see LICENSE for more details.
 """
+import contextlib
+import hashlib
+import json
 import logging
+import threading
+import time
+import uuid
 
-import boto3
-import botocore
-import kmsauth
+import botocore.exceptions
 import os
+from awseipext import lease_store, metrics, result_sink, result_store
 from awseipext.config.lambda_config import LambdaConfig, SECTION
-from awseipext.request.lambda_request import LambdaSchema
+from awseipext.ec2.address import Address
+from awseipext.ec2.inventory import AddressInventory
+from awseipext.ec2.retry import AdaptiveTokenBucket, Retrier, RetryingClient
+from awseipext.request.validator import (
+    ACTIONS,
+    RECONCILE,
+    LambdaRequest,
+    ValidationError,
+    get_reconcile_error,
+    get_request_error,
+    load_batch_request,
+    load_correlation_id,
+    load_idempotency_key,
+    load_reconcile_request,
+    load_region,
+    load_request
+)
+from awseipext.ttl_cache import TTLCache
 
-ec2_resource = boto3.resource('ec2')
-ec2_client = boto3.client('ec2')
+# boto3, kmsauth and concurrent.futures are imported where
+# they're first needed, rather than here, to keep cold starts short. For the
+# same reason, AWS clients are created on first use.
+
+ec2_clients = {}
+ec2_clients_lock = threading.Lock()
+kms_clients = {}
+kms_clients_lock = threading.Lock()
+lookup_executor = None
+lookup_executor_lock = threading.Lock()
 logger = None
+runtime = None
+runtime_lock = threading.Lock()
+cold_start = True
+
+# Number of (action, resource) validators to keep per container.
+VALIDATOR_CACHE_SIZE = 1024
+# Number of validated tokens each validator remembers. A validator only
+# sees the tokens for one action and resource.
+VALIDATOR_TOKEN_CACHE_SIZE = 32
+# Instance roles are cached across warm invocations. Instances that have no
+# instance profile, or malformed ids, are cached for a shorter time.
+# Instances that can't be found aren't cached at all, since EC2 may not list
+# an instance that was just launched yet.
+ROLE_CACHE_SIZE = 4096
+ROLE_CACHE_TTL = 300
+ROLE_CACHE_NEGATIVE_TTL = 30
+PERMANENT_INSTANCE_ERRORS = ('InvalidInstanceID.Malformed',)
+
+# Seconds between full refreshes of the address inventory. Changes made by
+# this function are recorded in the inventory as they happen, so this only
+# bounds how long changes made elsewhere can go unnoticed.
+ADDRESS_INVENTORY_TTL = 60
+
+# Seconds before the lambda times out that a duplicate of an idempotent
+# request stops waiting for the first execution to finish.
+IDEMPOTENCY_WAIT_MARGIN = 1
+
+LEASE_ERROR = 'IP is in use by another request.'
+# Work under a lease stops starting EC2 calls this many seconds before the
+# lease would expire, since nothing renews it.
+LEASE_MARGIN = 1
+
+# Metric dimension value for requests whose action isn't one of ACTIONS, so
+# callers can't add dimension values of their own.
+INVALID_ACTION = 'invalid'
+
+# Number of threads in the pool that runs a request's independent lookups
+# alongside each other, shared by every invocation in the container.
+LOOKUP_WORKERS = 4
+
+# EC2 calls are rate limited per container, starting at EC2_MAX_RATE calls
+# per second and slowing down while EC2 throttles them. Throttled and
+# transiently failed calls are retried, up to EC2_MAX_ATTEMPTS times, until
+# EC2_RETRY_MARGIN seconds before the lambda would time out.
+EC2_MAX_RATE = 100
+EC2_MAX_ATTEMPTS = 8
+EC2_RETRY_MARGIN = 1
+
+
+class RegionState(object):
+    def __init__(self):
+        """
+        Per-container EC2 state for a region. Instances, addresses and EC2's
+        rate limits are all regional, so each region the lambda is asked to
+        act in gets its own.
+        """
+        self.role_cache = TTLCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
+        self.address_inventory = AddressInventory(ADDRESS_INVENTORY_TTL)
+        self.ec2_retrier = Retrier(
+            AdaptiveTokenBucket(EC2_MAX_RATE),
+            max_attempts=EC2_MAX_ATTEMPTS
+        )
+
+
+# Region states are created on first use. None is the region the lambda
+# runs in, whose state is also kept in the module-level names below.
+region_states = {None: RegionState()}
+region_states_lock = threading.Lock()
+role_cache = region_states[None].role_cache
+address_inventory = region_states[None].address_inventory
+ec2_retrier = region_states[None].ec2_retrier
+
+
+def get_region_state(region=None):
+    """
+    Get the RegionState for a region, creating it on first use.
+
+    :param region: The AWS region. Default: the region the lambda runs in.
+    """
+    state = region_states.get(region)
+    if state is None:
+        with region_states_lock:
+            state = region_states.get(region)
+            if state is None:
+                state = RegionState()
+                region_states[region] = state
+    return state
+
+
+def get_ec2_client(region=None, deadline=None):
+    """
+    Get the EC2 client for a region, creating it on first use and reusing
+    it afterwards. Calls made with it are rate limited and retried by the
+    region's ec2_retrier.
+
+    :param region: The AWS region. Default: the region boto3 would pick
+        from the environment.
+    :param deadline: Time, in seconds since the epoch, to give up retrying
+        calls by. Default: no deadline.
+    """
+    client = ec2_clients.get(region)
+    if client is None:
+        with ec2_clients_lock:
+            client = ec2_clients.get(region)
+            if client is None:
+                import boto3
+                import botocore.config
+
+                # boto3's default session isn't thread-safe, so use a
+                # dedicated one.
+                session = boto3.session.Session(region_name=region)
+                # Retries are left to ec2_retrier, which knows how long
+                # the lambda has left.
+                client = session.client(
+                    'ec2',
+                    config=botocore.config.Config(retries={'max_attempts': 0})
+                )
+                ec2_clients[region] = client
+    return RetryingClient(
+        client,
+        get_region_state(region).ec2_retrier,
+        deadline=deadline
+    )
+
+
+def get_kms_client(region):
+    """
+    Get the KMS client for a region, creating it on first use and reusing
+    it afterwards.
+    """
+    client = kms_clients.get(region)
+    if client is None:
+        with kms_clients_lock:
+            client = kms_clients.get(region)
+            if client is None:
+                import kmsauth.services
+
+                client = kmsauth.services.get_boto_client(
+                    'kms',
+                    region=region
+                )
+                kms_clients[region] = client
+    return client
+
+
+def get_lookup_executor():
+    """
+    Get the executor that runs lookups alongside each other, creating it on
+    first use. It's shared by every invocation in the container, so the
+    number of lookup threads stays bounded however many requests are in
+    flight.
+    """
+    global lookup_executor
 
+    if lookup_executor is None:
+        with lookup_executor_lock:
+            if lookup_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
 
-def get_role_name(instance_id):
-    instance = ec2_resource.Instance(instance_id)
+                lookup_executor = ThreadPoolExecutor(
+                    max_workers=LOOKUP_WORKERS
+                )
+    return lookup_executor
+
+
+def _get_mtime(config_file):
     try:
-        role = instance.iam_instance_profile['Arn'].split('/')[1]
-    except botocore.exceptions.ClientError:
-        logger.exception('Could not find instance {0}.'.format(instance_id))
-        role = None
+        return os.path.getmtime(config_file)
+    except OSError:
+        return None
+
+
+class RuntimeContext(object):
+    def __init__(self, config_file, region):
+        """
+        Per-container state that only needs to be built once for a given
+        config file and region, and is reused across warm invocations.
+
+        :param config_file: The config file to load settings from.
+        :param region: The AWS region the lambda runs in, which requests
+            without a region are for.
+        """
+        self.config_file = config_file
+        self.config_mtime = _get_mtime(config_file)
+        self.region = region
+
+        # Load the deployment config values
+        self.config = LambdaConfig(config_file=config_file)
+        self.kmsauth_key = self.config.get(SECTION, 'kmsauth_key')
+        self.kmsauth_user_key = self.config.get(SECTION, 'kmsauth_user_key')
+        self.kmsauth_to_context = self.config.get(
+            SECTION,
+            'kmsauth_to_context'
+        )
+
+        logging_level = self.config.get(SECTION, 'logging_level_option')
+        numeric_level = getattr(logging, logging_level.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: {}'.format(logging_level))
+        self.logger = logging.getLogger()
+        self.logger.setLevel(numeric_level)
+
+        self.metrics_namespace = self.config.get(SECTION, 'metrics_namespace')
+
+        self.batch_concurrency = self.config.getint(
+            SECTION,
+            'batch_concurrency'
+        )
+        if self.batch_concurrency < 1:
+            raise ValueError('batch_concurrency must be at least 1.')
+
+        # Validators never go stale; they're only evicted to bound memory.
+        self.validators = TTLCache(VALIDATOR_CACHE_SIZE, float('inf'))
+        self.validators_lock = threading.Lock()
+        # KMS key metadata, by region.
+        self.key_metadata = {}
+
+        # Results of requests with an idempotency key, so client retries
+        # don't repeat the KMS and EC2 calls.
+        self.result_store = result_store.create_result_store(
+            self.config.get(SECTION, 'idempotency_store'),
+            self.config.getint(SECTION, 'idempotency_ttl'),
+            self.config.get(SECTION, 'idempotency_directory'),
+            self.config.get(SECTION, 'idempotency_table'),
+            region
+        )
+        self.idempotency_wait = self.config.getfloat(
+            SECTION,
+            'idempotency_wait'
+        )
+
+        # Where the results of requests with a correlation id are put, since
+        # Lambda discards what an asynchronous invocation returns.
+        self.result_sink = result_sink.create_result_sink(
+            self.config.get(SECTION, 'result_sink'),
+            self.config.get(SECTION, 'result_sink_directory'),
+            self.config.get(SECTION, 'result_sink_queue_url'),
+            region
+        )
+
+        # Leases serialise the check-and-mutate of concurrent requests for
+        # the same IP, in this container or, with a shared store, any.
+        self.lease_store = lease_store.create_lease_store(
+            self.config.get(SECTION, 'lease_store'),
+            self.config.get(SECTION, 'lease_directory'),
+            self.config.get(SECTION, 'lease_table'),
+            region
+        )
+        self.lease_duration = self.config.getfloat(SECTION, 'lease_duration')
+        self.lease_wait = self.config.getfloat(SECTION, 'lease_wait')
+
+    def matches(self, config_file, region):
+        return (
+            self.config_file == config_file and
+            self.region == region and
+            self.config_mtime == _get_mtime(config_file)
+        )
+
+    def get_ec2_region(self, region):
+        """
+        The key of a request's region in ec2_clients and region_states:
+        None for the region the lambda runs in, so it shares the clients and
+        state of requests without a region.
+        """
+        return None if region == self.region else region
+
+    def get_validator(self, extra_context, region=None):
+        """
+        Get a KMSTokenValidator for the given extra context.
+
+        Validators are kept per extra context, since kmsauth's token cache
+        doesn't take extra_context into account; sharing a single validator
+        would let a token minted for one action be replayed for another.
+        KMS key metadata doesn't depend on the context, so it's shared by
+        the validators of a region.
+
+        A validator's token cache is the only cache of validated tokens:
+        decrypt_token reuses a token it has validated until its not_after,
+        so retries don't decrypt it again. kmsauth sizes it for a validator
+        that sees every token, so it's replaced with a smaller one, and as
+        it isn't thread-safe, decrypt_token is called under the validator's
+        lock.
+
+        :param region: The region of the KMS key tokens were minted with.
+            Default: the region the lambda runs in.
+        """
+        import kmsauth
+        from kmsauth.utils import lru
+
+        if region is None:
+            region = self.region
+        key = (region,) + tuple(sorted(extra_context.items()))
+        with self.validators_lock:
+            found, validator = self.validators.lookup(key)
+            if not found:
+                validator = kmsauth.KMSTokenValidator(
+                    self.kmsauth_key,
+                    self.kmsauth_user_key,
+                    self.kmsauth_to_context,
+                    region,
+                    extra_context=extra_context
+                )
+                validator.kms_client = get_kms_client(region)
+                validator.KEY_METADATA = self.key_metadata.setdefault(
+                    region,
+                    {}
+                )
+                validator.TOKENS = lru.LRUCache(VALIDATOR_TOKEN_CACHE_SIZE)
+                validator.lock = threading.Lock()
+                self.validators.set(key, validator)
+            return validator
+
+
+def get_runtime(config_file, region):
+    """
+    Get the RuntimeContext for this container, rebuilding it if the config
+    file has changed or the region is different. Concurrent invocations
+    share a single rebuild, and so the new context's stores and caches.
+    """
+    global runtime
+
+    ctx = runtime
+    if ctx is None or not ctx.matches(config_file, region):
+        with runtime_lock:
+            ctx = runtime
+            if ctx is None or not ctx.matches(config_file, region):
+                ctx = runtime = RuntimeContext(config_file, region)
+    return ctx
+
+
+def _get_role_from_profile_arn(instance_id, profile_arn):
+    try:
+        return profile_arn.split('/')[1]
     except IndexError:
         logger.error(
             'Could not find the role associated with {0}.'.format(instance_id)
         )
-        role = None
+        return None
+
+
+def _lookup_role_name(instance_id, region=None, deadline=None):
+    """
+    Look up the role of an instance, without using the role cache.
+
+    :return: A (role, cacheable) tuple. If the role is None, cacheable says
+        whether the failure is permanent (rather than, say, a throttle).
+    """
+    try:
+        reservations = get_ec2_client(region, deadline).describe_instances(
+            InstanceIds=[instance_id]
+        )['Reservations']
+        profile = reservations[0]['Instances'][0].get('IamInstanceProfile')
+    except botocore.exceptions.ClientError as e:
+        logger.exception('Could not find instance {0}.'.format(instance_id))
+        code = e.response.get('Error', {}).get('Code')
+        return None, code in PERMANENT_INSTANCE_ERRORS
+    except IndexError:
+        logger.error('Could not find instance {0}.'.format(instance_id))
+        return None, False
     except Exception:
         logger.exception(
             'Failed to lookup role for instance id {0}.'.format(instance_id)
         )
-        role = None
+        return None, False
+    if profile is None:
+        logger.error(
+            'Could not find the role associated with {0}.'.format(instance_id)
+        )
+        return None, True
+    return _get_role_from_profile_arn(instance_id, profile['Arn']), True
+
+
+def _cache_role(instance_id, role, cacheable=True, region=None):
+    cache = get_region_state(region).role_cache
+    if role is not None:
+        cache.set(instance_id, role)
+    elif cacheable:
+        cache.set(instance_id, None, ttl=ROLE_CACHE_NEGATIVE_TTL)
+
+
+def invalidate_role(instance_id=None, region=None):
+    """
+    Drop an instance's role from its region's role cache, or every cached
+    role in the region if no instance id is given.
+    """
+    get_region_state(region).role_cache.invalidate(instance_id)
+
+
+def get_role_name(instance_id, region=None, deadline=None):
+    found, role = get_region_state(region).role_cache.lookup(instance_id)
+    if found:
+        return role
+    role, cacheable = _lookup_role_name(instance_id, region, deadline)
+    _cache_role(instance_id, role, cacheable, region)
     return role
 
 
-def get_instance_id(resource):
-    addr = ec2_resource.ClassicAddress(resource)
+def get_role_names(instance_ids, region=None, deadline=None):
+    """
+    Look up the roles of several instances, with a single describe_instances
+    call for those not in the role cache. If the combined lookup fails (for
+    instance, because one of the ids doesn't exist), fall back to looking up
+    each instance individually.
+
+    :param instance_ids: A list of instance ids.
+    :param region: The region of the instances. Default: the region the
+        lambda runs in.
+    :param deadline: Time, in seconds since the epoch, to give up retrying
+        EC2 calls by. Default: no deadline.
+    :return: A dict of instance id to role name (or None).
+    """
+    cache = get_region_state(region).role_cache
+    roles = {}
+    for instance_id in set(instance_ids):
+        found, role = cache.lookup(instance_id)
+        if found:
+            roles[instance_id] = role
+    instance_ids = sorted(set(instance_ids) - set(roles))
+    if not instance_ids:
+        return roles
+    roles.update(dict.fromkeys(instance_ids))
     try:
-        instance_id = addr.instance_id
+        paginator = get_ec2_client(region, deadline).get_paginator(
+            'describe_instances'
+        )
+        for page in paginator.paginate(InstanceIds=instance_ids):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_id = instance['InstanceId']
+                    profile = instance.get('IamInstanceProfile')
+                    if profile is None:
+                        logger.error(
+                            'Could not find the role associated with'
+                            ' {0}.'.format(instance_id)
+                        )
+                        role = None
+                    else:
+                        role = _get_role_from_profile_arn(
+                            instance_id,
+                            profile['Arn']
+                        )
+                    roles[instance_id] = role
+                    _cache_role(instance_id, role, region=region)
     except botocore.exceptions.ClientError:
-        logger.exception('Could not lookup ip {0}.'.format(resource))
-        instance_id = None
-    return instance_id
+        logger.warning(
+            'Batch instance lookup failed, looking up instances individually.'
+        )
+        for instance_id in instance_ids:
+            roles[instance_id] = get_role_name(
+                instance_id,
+                region=region,
+                deadline=deadline
+            )
+    return roles
+
 
+def _get_inventory(region=None, deadline=None):
+    """
+    Get a region's address inventory, refreshing it if it's stale.
 
-def get_allocation_id(resource):
+    :return: The AddressInventory, or None if it couldn't be refreshed.
+    """
+    inventory = get_region_state(region).address_inventory
     try:
-        addrs = ec2_client.describe_addresses(PublicIps=[resource])
-        addr = addrs['Addresses'][0]
-        allocation_id = addr['AllocationId']
+        inventory.refresh(get_ec2_client(region, deadline))
     except botocore.exceptions.ClientError:
-        logger.exception('Could not lookup ip {0}.'.format(resource))
-        allocation_id = None
-    return allocation_id
+        logger.exception('Could not refresh address inventory.')
+        return None
+    return inventory
 
 
-def get_association_id(resource):
+def _describe_address(resource, region=None, deadline=None):
     try:
-        addrs = ec2_client.describe_addresses(PublicIps=[resource])
-        addr = addrs['Addresses'][0]
-        association_id = addr['AssociationId']
+        addrs = get_ec2_client(region, deadline).describe_addresses(
+            PublicIps=[resource]
+        )
+        address = Address.from_description(addrs['Addresses'][0])
     except botocore.exceptions.ClientError:
         logger.exception('Could not lookup ip {0}.'.format(resource))
-        association_id = None
-    return association_id
+        return None
+    except IndexError:
+        logger.error('Could not find ip {0}.'.format(resource))
+        return None
+    get_region_state(region).address_inventory.update(address)
+    return address
 
 
-def lambda_handler(
-        event, context=None,
-        config_file=os.path.join(
-            os.path.dirname(__file__),
-            'lambda_deploy.cfg'
-        )
-        ):
+def get_address(resource, fresh=False, region=None, deadline=None):
     """
-    This is the function that will be called when the lambda function starts.
-    :param event: Dictionary of the json request.
-    :param context: AWS LambdaContext Object
-    http://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
-    :param config_file: The config file to load additional settings.
-    :return: A dict with success or error information.
+    Look up the current state of an elastic IP from the address inventory,
+    falling back to a describe_addresses call for IPs it doesn't know.
+
+    :param resource: The elastic IP address.
+    :param fresh: Always describe the address, rather than trusting the
+        inventory.
+    :param region: The region of the address. Default: the region the
+        lambda runs in.
+    :param deadline: Time, in seconds since the epoch, to give up retrying
+        EC2 calls by. Default: no deadline.
+    :return: An Address, or None if the address couldn't be found.
     """
-    global logger
+    if fresh:
+        return _describe_address(resource, region, deadline)
+    inventory = _get_inventory(region, deadline)
+    if inventory is not None:
+        address = inventory.get(resource)
+        if address is not None:
+            return address
+    return _describe_address(resource, region, deadline)
 
-    # AWS Region determines configs related to KMS
-    region = os.environ['AWS_REGION']
 
-    # Load the deployment config values
-    config = LambdaConfig(config_file=config_file)
-    kmsauth_key = config.get(SECTION, 'kmsauth_key')
-    kmsauth_user_key = config.get(SECTION, 'kmsauth_user_key')
-    kmsauth_to_context = config.get(SECTION, 'kmsauth_to_context')
+def get_addresses(resources, fresh=False, region=None, deadline=None):
+    """
+    Look up the current state of several elastic IPs from the address
+    inventory. IPs it doesn't know are looked up with a single
+    describe_addresses call; if that fails (for instance, because one of
+    the IPs doesn't exist), fall back to looking up each IP individually.
 
-    logging_level = config.get(SECTION, 'logging_level_option')
-    numeric_level = getattr(logging, logging_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: {}'.format(logging_level))
+    :param resources: A list of elastic IP addresses.
+    :param fresh: Always describe the addresses, rather than trusting the
+        inventory.
+    :param region: The region of the addresses. Default: the region the
+        lambda runs in.
+    :param deadline: Time, in seconds since the epoch, to give up retrying
+        EC2 calls by. Default: no deadline.
+    :return: A dict of elastic IP to Address (or None).
+    """
+    addresses = dict.fromkeys(set(resources))
+    if not addresses:
+        return addresses
+    inventory = None if fresh else _get_inventory(region, deadline)
+    if inventory is not None:
+        for resource in addresses:
+            addresses[resource] = inventory.get(resource)
+    missing = sorted(
+        resource for resource, address in addresses.items()
+        if address is None
+    )
+    if not missing:
+        return addresses
+    try:
+        addrs = get_ec2_client(region, deadline).describe_addresses(
+            PublicIps=missing
+        )
+        for addr in addrs['Addresses']:
+            address = Address.from_description(addr)
+            get_region_state(region).address_inventory.update(address)
+            addresses[address.public_ip] = address
+    except botocore.exceptions.ClientError:
+        logger.warning(
+            'Batch ip lookup failed, looking up ips individually.'
+        )
+        for resource in missing:
+            addresses[resource] = _describe_address(
+                resource,
+                region,
+                deadline
+            )
+    return addresses
 
-    logger = logging.getLogger()
-    logger.setLevel(numeric_level)
 
-    # Process request
-    schema = LambdaSchema(strict=True)
-    request = schema.load(event).data
+def authenticate(ctx, region, request):
+    """
+    Validate the kmsauth token of a request.
+
+    :param ctx: The RuntimeContext for this container.
+    :param region: The region of the KMS key the token was minted with.
+    :param request: A LambdaRequest.
+    :return: The KMSTokenValidator used, or None if authentication failed.
+    """
+    # datetime.strptime, which kmsauth uses, imports _strptime on first use
+    # without waiting for the import lock, so concurrent first uses can see
+    # a half-imported module. Importing it here waits for the lock.
+    import _strptime  # noqa
+    import kmsauth
 
-    # Authenticate the user with KMS, if key is setup
     extra_context = {
         'action': request.action,
         'resource': request.resource
     }
-    validator = kmsauth.KMSTokenValidator(
-        kmsauth_key,
-        kmsauth_user_key,
-        kmsauth_to_context,
-        region,
-        extra_context=extra_context
-    )
+    validator = ctx.get_validator(extra_context, region)
     try:
         # decrypt_token will raise a TokenValidationError if token
-        # doesn't match
-        validator.decrypt_token(request.username, request.token)
+        # doesn't match. Retries present the same token, which it reuses
+        # from its cache (see RuntimeContext.get_validator).
+        with validator.lock:
+            validator.decrypt_token(request.username, request.token)
     except kmsauth.TokenValidationError:
         logger.error(
             'KMS auth info: {0} {1} {2} {3} {4}'.format(
-                kmsauth_key,
-                kmsauth_user_key,
-                kmsauth_to_context,
+                ctx.kmsauth_key,
+                ctx.kmsauth_user_key,
+                ctx.kmsauth_to_context,
                 region,
                 extra_context
             )
         )
-        return {
-            'result': False,
-            'error': 'Authentication failed.'
-        }
+        return None
+    return validator
+
+
+def check_role(validator, request, role, instance_id=None, region=None):
+    """
+    Ensure an instance is in the role the kmsauth token is from.
 
-    role = get_role_name(request.instance_id)
+    :param role: The instance's role.
+    :param instance_id: The instance. Default: the request's target
+        instance.
+    :param region: The region of the instance. Default: the region the
+        lambda runs in.
+    :return: An error dict, or None if the role matches.
+    """
+    if instance_id is None:
+        instance_id = request.instance_id
     if role is None:
         return {
             'result': False,
             'error': 'Could not find instance id.'
         }
     if role != validator.extract_username_field(request.username, 'from'):
+        # The role may have been cached before the instance's profile
+        # changed; make sure the next request sees the current one.
+        invalidate_role(instance_id, region)
         msg = 'Instance is not in role ({0}) associated with kms token ({1}).'
         msg = msg.format(
             role,
@@ -155,54 +678,124 @@ def lambda_handler(
             'result': False,
             'error': msg
         }
+    return None
 
-    instance_id = get_instance_id(request.resource)
-    if request.action == 'associate':
-        if instance_id:
-            if instance_id == request.instance_id:
-                logger.info(
-                    'IP already associated with {0}.'.format(
-                        request.instance_id
-                    )
+
+def get_source_instance(request, address):
+    """
+    Get the instance a move request would take an address from.
+
+    :return: An instance id, or None if the request isn't a move or the
+        address isn't associated with another instance.
+    """
+    if request.action != 'move' or address is None:
+        return None
+    if address.instance_id in (None, request.instance_id):
+        return None
+    return address.instance_id
+
+
+def update_address(
+        request,
+        address,
+        region=None,
+        fresh=False,
+        deadline=None
+        ):
+    """
+    Apply an associate, disassociate or move request to an address. The
+    roles of the instances involved must already have been checked.
+
+    :param request: A LambdaRequest with a valid action.
+    :param address: The Address snapshot for request.resource, or None if
+        it couldn't be looked up.
+    :param region: The region of the address. Default: the region the
+        lambda runs in.
+    :param fresh: Whether address was just described, rather than read
+        from the address inventory. The inventory can be out of date, so
+        a request it says has nothing to do is only reported as done once
+        a fresh describe agrees.
+    :param deadline: Time, in seconds since the epoch, to give up retrying
+        EC2 calls by. Default: no deadline.
+    :return: A dict with success or error information.
+    """
+    inventory = get_region_state(region).address_inventory
+    if address is None:
+        return {
+            'result': False,
+            'error': 'Could not lookup IP.'
+        }
+    instance_id = address.instance_id
+    if request.action in ('associate', 'move'):
+        if instance_id == request.instance_id:
+            if not fresh:
+                return _recheck_address(request, region, deadline)
+            logger.info(
+                'IP already associated with {0}.'.format(
+                    request.instance_id
                 )
-                return {'result': True}
-            else:
-                return {
-                    'result': False,
-                    'error': 'IP is already associated with another instance.'
-                }
-        allocation_id = get_allocation_id(request.resource)
+            )
+            return {'result': True}
+        if instance_id and request.action == 'associate':
+            return {
+                'result': False,
+                'error': 'IP is already associated with another instance.'
+            }
+        allocation_id = address.allocation_id
         if allocation_id is None:
             return {
                 'result': False,
                 'error': 'Could not get allocation id for IP.'
             }
-        logger.info(
-            'associating {0} to {1}.'.format(
-                request.resource,
-                request.instance_id
+        kwargs = {}
+        if instance_id:
+            # Moving: reassociate in one call, so the IP is never left
+            # unassociated.
+            kwargs['AllowReassociation'] = True
+            logger.info(
+                'moving {0} from {1} to {2}.'.format(
+                    request.resource,
+                    instance_id,
+                    request.instance_id
+                )
+            )
+        else:
+            logger.info(
+                'associating {0} to {1}.'.format(
+                    request.resource,
+                    request.instance_id
+                )
             )
-        )
         try:
-            ec2_client.associate_address(
+            response = get_ec2_client(region, deadline).associate_address(
                 InstanceId=request.instance_id,
-                AllocationId=allocation_id
+                AllocationId=allocation_id,
+                **kwargs
             )
         except botocore.exceptions.ClientError:
             msg = 'Failed to associate IP address with instance.'
             logger.exception(msg)
+            # The failure may be down to a stale inventory.
+            inventory.invalidate()
             return {
                 'result': False,
                 'error': msg
             }
-    elif request.action == 'disassociate':
+        inventory.update(Address(
+            address.public_ip,
+            allocation_id=allocation_id,
+            association_id=response.get('AssociationId'),
+            instance_id=request.instance_id,
+            domain=address.domain
+        ))
+    else:
         if instance_id:
             if instance_id != request.instance_id:
                 return {
                     'result': False,
                     'error': 'IP is not associated with this instance id.'
                 }
-            association_id = get_association_id(request.resource)
+            association_id = address.association_id
             if association_id is None:
                 return {
                     'result': False,
@@ -215,26 +808,847 @@ def lambda_handler(
                 )
             )
             try:
-                ec2_client.disassociate_address(
+                get_ec2_client(region, deadline).disassociate_address(
                     AssociationId=association_id
                 )
             except botocore.exceptions.ClientError:
                 msg = 'Failed to disassociate IP address from instance.'
                 logger.exception(msg)
+                inventory.invalidate()
                 return {
                     'result': False,
                     'error': msg
                 }
+            inventory.update(Address(
+                address.public_ip,
+                allocation_id=address.allocation_id,
+                domain=address.domain
+            ))
         else:
+            if not fresh:
+                return _recheck_address(request, region, deadline)
             logger.info(
                 'No IP associated with {0}.'.format(request.instance_id)
             )
             return {'result': True}
-    else:
+    return {
+        'result': True
+    }
+
+
+def _recheck_address(request, region=None, deadline=None):
+    # The inventory says there's nothing to do; make sure EC2 agrees before
+    # saying so.
+    return update_address(
+        request,
+        _describe_address(request.resource, region, deadline),
+        region,
+        fresh=True,
+        deadline=deadline
+    )
+
+
+def leases_shared(ctx):
+    """
+    Whether requests lease the IPs they act on in a store shared with other
+    processes. A lease only serialises the check-and-mutate of requests
+    that read the IP's current state under it. Every change made under a
+    lease from a process-local store was made in this process, and is
+    already in the address inventory; changes made under a shared one may
+    not be, so the inventory isn't trusted.
+    """
+    return ctx.lease_store is not None and ctx.lease_store.shared
+
+
+@contextlib.contextmanager
+def hold_leases(ctx, region, resources, timer=None, deadline=None):
+    """
+    Lease some IPs for as long as the block runs, waiting in line for those
+    another request holds, until the lease_wait has passed or the lambda is
+    about to time out. IPs are leased in order, so requests for overlapping
+    IPs can't deadlock.
+
+    :param region: The region of the IPs.
+    :param resources: The IPs to lease.
+    :param timer: A StageTimer to record the time spent waiting in.
+    :param deadline: Time, in seconds since the epoch, to stop waiting by.
+        Default: only the lease_wait applies.
+    :return: A context manager yielding the set of IPs leased, and the
+        deadline for EC2 calls made under the leases: the given one,
+        brought forward to before the first lease expires.
+    """
+    store = ctx.lease_store
+    if store is None:
+        yield set(resources), deadline
+        return
+    if timer is None:
+        timer = metrics.StageTimer()
+    owner = uuid.uuid4().hex
+    wait_deadline = time.time() + ctx.lease_wait
+    if deadline is not None:
+        wait_deadline = min(wait_deadline, deadline)
+    leased = set()
+    try:
+        with timer.stage('LeaseWait'):
+            for resource in sorted(resources):
+                key = '{0}:{1}'.format(region, resource)
+                if store.acquire(
+                        key,
+                        owner,
+                        ctx.lease_duration,
+                        max(0, wait_deadline - time.time())):
+                    if not leased:
+                        # The first lease taken is the first to expire.
+                        expires = (
+                            time.time() + ctx.lease_duration - LEASE_MARGIN
+                        )
+                        if deadline is None or expires < deadline:
+                            deadline = expires
+                    leased.add(resource)
+                else:
+                    logger.warning(
+                        'Timed out waiting for a lease on {0}.'.format(
+                            resource
+                        )
+                    )
+        yield leased, deadline
+    finally:
+        for resource in leased:
+            try:
+                store.release('{0}:{1}'.format(region, resource), owner)
+            except Exception:
+                # It'll expire.
+                logger.exception(
+                    'Failed to release the lease on {0}.'.format(resource)
+                )
+
+
+def invalid_request(request):
+    """
+    Check the format of a request before doing any KMS or EC2 work.
+
+    :return: An error dict, or None if the request is well formed.
+    """
+    error = get_request_error(request, ACTIONS)
+    if error is None:
+        return None
+    return {
+        'result': False,
+        'error': error
+    }
+
+
+def handle_request(ctx, region, request, timer=None, deadline=None):
+    """
+    Process a single associate, disassociate or move request.
+
+    :param timer: A StageTimer to record the time spent in each stage.
+    :param deadline: Time, in seconds since the epoch, to give up EC2 calls
+        and waits by. Default: no deadline.
+    """
+    if timer is None:
+        timer = metrics.StageTimer()
+    error = invalid_request(request)
+    if error is not None:
+        return error
+
+    with timer.stage('KmsDecrypt'):
+        validator = authenticate(ctx, region, request)
+    if validator is None:
+        return {
+            'result': False,
+            'error': 'Authentication failed.'
+        }
+
+    # The instance and address lookups don't depend on each other, so they
+    # run at the same time. The role is still checked before any change.
+    ec2_region = ctx.get_ec2_region(region)
+
+    def lookup_role():
+        # Timed here, since the time spent waiting for the result below
+        # leaves out however much of it overlapped the address lookup.
+        with timer.stage('RoleLookup'):
+            return get_role_name(
+                request.instance_id,
+                region=ec2_region,
+                deadline=deadline
+            )
+    role_future = get_lookup_executor().submit(lookup_role)
+
+    # Other requests for the IP wait until this one has checked and
+    # changed it.
+    with hold_leases(
+            ctx,
+            region,
+            [request.resource],
+            timer,
+            deadline) as (leased, deadline):
+        if not leased:
+            return {'result': False, 'error': LEASE_ERROR}
+
+        with timer.stage('AddressLookup'):
+            # The check below is only serialised with other processes'
+            # changes if it's made against current state, rather than the
+            # inventory. Without shared leases, only moves need it: a move
+            # takes the IP from whichever instance holds it when it's made.
+            fresh = leases_shared(ctx) or request.action == 'move'
+            # An inventory refreshed for this lookup is as current as a
+            # describe, so its answer needn't be confirmed before a no-op.
+            current = (
+                fresh or
+                get_region_state(ec2_region).address_inventory.is_stale()
+            )
+            address = get_address(
+                request.resource,
+                fresh=fresh,
+                region=ec2_region,
+                deadline=deadline
+            )
+
+        role = role_future.result()
+        error = check_role(validator, request, role, region=ec2_region)
+        if error is not None:
+            return error
+
+        # A move must be authorized for the instance it takes the IP from
+        # too.
+        source = get_source_instance(request, address)
+        if source is not None:
+            with timer.stage('RoleLookup'):
+                role = get_role_name(
+                    source,
+                    region=ec2_region,
+                    deadline=deadline
+                )
+            error = check_role(validator, request, role, source, ec2_region)
+            if error is not None:
+                return error
+
+        with timer.stage('Ec2Mutation'):
+            return update_address(
+                request,
+                address,
+                ec2_region,
+                current,
+                deadline
+            )
+
+
+def _safe_update_address(
+        request,
+        address,
+        region=None,
+        fresh=False,
+        deadline=None
+        ):
+    try:
+        return update_address(request, address, region, fresh, deadline)
+    except Exception:
+        logger.exception(
+            'Failed to {0} {1}.'.format(request.action, request.resource)
+        )
         return {
             'result': False,
-            'error': '{0} is not a valid action.'.format(request.action)
+            'error': 'Unexpected error.'
         }
+
+
+def handle_batch(ctx, region, requests, timer=None, deadline=None):
+    """
+    Process a batch of associate, disassociate and move requests. Tokens are
+    validated and addresses are updated concurrently, and instance and
+    address lookups are grouped into one EC2 call each.
+
+    :param timer: A StageTimer to record the time spent in each stage.
+    :param deadline: Time, in seconds since the epoch, to give up EC2 calls
+        and waits by. Default: no deadline.
+    :return: A dict with an overall result, and a list of per-operation
+        results in request order.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if timer is None:
+        timer = metrics.StageTimer()
+    results = [invalid_request(request) for request in requests]
+    valid = [i for i, result in enumerate(results) if result is None]
+    ec2_region = ctx.get_ec2_region(region)
+    max_workers = min(ctx.batch_concurrency, len(requests))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with timer.stage('KmsDecrypt'):
+            validators = dict(zip(valid, executor.map(
+                lambda i: authenticate(ctx, region, requests[i]),
+                valid
+            )))
+        pending = []
+        for i in valid:
+            if validators[i] is None:
+                results[i] = {
+                    'result': False,
+                    'error': 'Authentication failed.'
+                }
+            else:
+                pending.append(i)
+
+        with timer.stage('RoleLookup'):
+            roles = get_role_names(
+                [requests[i].instance_id for i in pending],
+                ec2_region,
+                deadline
+            )
+        authorized = []
+        resources = set()
+        for i in pending:
+            request = requests[i]
+            error = check_role(
+                validators[i],
+                request,
+                roles.get(request.instance_id),
+                region=ec2_region
+            )
+            if error is not None:
+                results[i] = error
+            elif request.resource in resources:
+                # Updates run concurrently from a single snapshot, so only
+                # one operation per IP can be applied safely.
+                results[i] = {
+                    'result': False,
+                    'error': 'IP is already targeted in this batch.'
+                }
+            else:
+                resources.add(request.resource)
+                authorized.append(i)
+
+        # Other requests for the IPs wait until this batch has checked and
+        # changed them.
+        with hold_leases(
+                ctx,
+                region,
+                resources,
+                timer,
+                deadline) as (leased, deadline):
+            for i in list(authorized):
+                if requests[i].resource not in leased:
+                    results[i] = {'result': False, 'error': LEASE_ERROR}
+                    authorized.remove(i)
+            resources = leased
+
+            with timer.stage('AddressLookup'):
+                # IPs leased in a shared store, and those moves take from
+                # whichever instance holds them, are checked against current
+                # state.
+                if leases_shared(ctx):
+                    fresh = resources
+                else:
+                    fresh = set(
+                        requests[i].resource for i in authorized
+                        if requests[i].action == 'move'
+                    )
+                if get_region_state(ec2_region).address_inventory.is_stale():
+                    current = resources
+                else:
+                    current = fresh
+                addresses = get_addresses(
+                    resources - fresh,
+                    region=ec2_region,
+                    deadline=deadline
+                )
+                addresses.update(get_addresses(
+                    fresh,
+                    fresh=True,
+                    region=ec2_region,
+                    deadline=deadline
+                ))
+
+            sources = {}
+            for i in authorized:
+                source = get_source_instance(
+                    requests[i],
+                    addresses.get(requests[i].resource)
+                )
+                if source is not None:
+                    sources[i] = source
+            if sources:
+                with timer.stage('RoleLookup'):
+                    roles = get_role_names(
+                        list(sources.values()),
+                        ec2_region,
+                        deadline
+                    )
+                for i, source in sources.items():
+                    error = check_role(
+                        validators[i],
+                        requests[i],
+                        roles.get(source),
+                        source,
+                        ec2_region
+                    )
+                    if error is not None:
+                        results[i] = error
+                        authorized.remove(i)
+
+            with timer.stage('Ec2Mutation'):
+                futures = {}
+                for i in authorized:
+                    request = requests[i]
+                    futures[i] = executor.submit(
+                        _safe_update_address,
+                        request,
+                        addresses.get(request.resource),
+                        ec2_region,
+                        request.resource in current,
+                        deadline
+                    )
+                for i, future in futures.items():
+                    results[i] = future.result()
+
+    for request, result in zip(requests, results):
+        result.update({
+            'action': request.action,
+            'resource': request.resource,
+            'instance_id': request.instance_id
+        })
     return {
-        'result': True
+        'result': all(result['result'] for result in results),
+        'results': results
+    }
+
+
+def plan_change(resource, instance_id, address):
+    """
+    Work out the change that brings an address in line with the instance
+    it should be associated with.
+
+    :param instance_id: The desired instance, or None for no instance.
+    :param address: The Address snapshot, or None if the IP wasn't found.
+    :return: A (change, request action, instance to act on) tuple, where
+        change is 'none', 'associate', 'disassociate' or 'reassociate', or
+        None if the IP wasn't found.
+    """
+    if address is None:
+        return None, None, None
+    current = address.instance_id
+    if current == instance_id:
+        return 'none', None, None
+    if instance_id is None:
+        return 'disassociate', 'disassociate', current
+    if current is None:
+        return 'associate', 'associate', instance_id
+    return 'reassociate', 'move', instance_id
+
+
+def handle_reconcile(ctx, region, request, timer=None, deadline=None):
+    """
+    Bring the associations of a set of IPs in line with a desired mapping.
+    The mapping is diffed against a single describe_addresses snapshot, and
+    only the changes needed are made, concurrently. Every instance an IP is
+    given to, taken from or left on must be in the role the token is from.
+
+    :param request: A LambdaReconcileRequest.
+    :param timer: A StageTimer to record the time spent in each stage.
+    :param deadline: Time, in seconds since the epoch, to give up EC2 calls
+        and waits by. Default: no deadline.
+    :return: A dict with an overall result, the number of changes of each
+        kind in the plan, and a result per IP.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if timer is None:
+        timer = metrics.StageTimer()
+    error = get_reconcile_error(request)
+    if error is not None:
+        return {'result': False, 'error': error}
+
+    with timer.stage('KmsDecrypt'):
+        validator = authenticate(ctx, region, request)
+    if validator is None:
+        return {
+            'result': False,
+            'error': 'Authentication failed.'
+        }
+
+    ec2_region = ctx.get_ec2_region(region)
+    inventory = get_region_state(ec2_region).address_inventory
+    # The IPs are leased before they're looked up, so the plan can't be
+    # overtaken by other requests for them. A dry run changes nothing, so
+    # it doesn't need them.
+    leases = [] if request.dry_run else list(request.mapping)
+    with hold_leases(
+            ctx,
+            region,
+            leases,
+            timer,
+            deadline) as (leased, deadline):
+        busy = set(leases) - leased
+        with timer.stage('AddressLookup'):
+            try:
+                inventory.refresh(
+                    get_ec2_client(ec2_region, deadline),
+                    force=True
+                )
+            except botocore.exceptions.ClientError:
+                logger.exception('Could not lookup IPs.')
+                return {
+                    'result': False,
+                    'error': 'Could not lookup IPs.'
+                }
+
+        results = []
+        checks = {}
+        changes = {}
+        instance_ids = set()
+        for resource, instance_id in sorted(request.mapping.items()):
+            address = inventory.get(resource)
+            if resource in busy:
+                change = action = target = None
+            else:
+                change, action, target = plan_change(
+                    resource,
+                    instance_id,
+                    address
+                )
+            result = {
+                'resource': resource,
+                'instance_id': instance_id,
+                'change': change,
+                'result': True
+            }
+            results.append(result)
+            if resource in busy:
+                result.update({'result': False, 'error': LEASE_ERROR})
+                continue
+            if change is None:
+                result.update({'result': False, 'error': 'Could not find IP.'})
+                continue
+            involved = sorted(set(
+                i for i in (instance_id, address.instance_id) if i
+            ))
+            checks[resource] = (result, address, involved)
+            instance_ids.update(involved)
+            if change != 'none':
+                changes[resource] = (result, address, LambdaRequest(
+                    action,
+                    resource,
+                    target,
+                    request.username,
+                    request.token
+                ))
+
+        if instance_ids:
+            with timer.stage('RoleLookup'):
+                roles = get_role_names(
+                    sorted(instance_ids),
+                    ec2_region,
+                    deadline
+                )
+        # An IP's current instance is only reported once the token is
+        # authorized for it, so a dry run can't be used to find out which
+        # instance holds any IP.
+        for resource, (result, address, involved) in checks.items():
+            for instance_id in involved:
+                error = check_role(
+                    validator,
+                    request,
+                    roles.get(instance_id),
+                    instance_id,
+                    ec2_region
+                )
+                if error is not None:
+                    result.update(error)
+                    changes.pop(resource, None)
+                    break
+            else:
+                result['current_instance_id'] = address.instance_id
+
+        plan = dict.fromkeys(
+            ('associate', 'disassociate', 'reassociate', 'none'),
+            0
+        )
+        for result in results:
+            if result['change'] is not None:
+                plan[result['change']] += 1
+        if changes and not request.dry_run:
+            max_workers = min(ctx.batch_concurrency, len(changes))
+            with timer.stage('Ec2Mutation'):
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = dict(
+                        (resource, executor.submit(
+                            _safe_update_address,
+                            change,
+                            address,
+                            ec2_region,
+                            True,
+                            deadline
+                        ))
+                        for resource, (_, address, change) in changes.items()
+                    )
+                    for resource, future in futures.items():
+                        changes[resource][0].update(future.result())
+    return {
+        'result': all(result['result'] for result in results),
+        'dry_run': request.dry_run,
+        'plan': plan,
+        'results': results
     }
+
+
+def _get_result_key(event):
+    """
+    Key the result of an idempotent request on its whole payload, tokens
+    included, so a result is only replayed to an identical request from a
+    caller holding the same tokens.
+    """
+    payload = json.dumps(event, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _get_remaining_time(context):
+    """
+    Seconds left before the lambda times out, or None if unknown.
+    """
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return None
+    return get_remaining_time() / 1000.0
+
+
+def _get_ec2_deadline(context):
+    """
+    The time EC2 calls have to give up by for the lambda to answer before it
+    times out, or None if unknown. It's kept per invocation, since several
+    may share a container's EC2 clients at once.
+    """
+    remaining = _get_remaining_time(context)
+    if remaining is None:
+        return None
+    return time.time() + remaining - EC2_RETRY_MARGIN
+
+
+def handle_idempotent(
+        ctx,
+        context,
+        event,
+        handle,
+        timer=None,
+        permanent=None
+        ):
+    """
+    Run a request that has an idempotency key at most once while its result
+    is kept. A duplicate that arrives while the first execution is running
+    waits for its result; one that arrives afterwards gets the recorded
+    result straight away. Only results that a retry would get again are
+    recorded; others, such as failures from throttled EC2 calls, release
+    the key so a retry runs afresh.
+
+    :param handle: Function that processes the request and returns its
+        result.
+    :param timer: A StageTimer to record the time spent in each stage.
+    :param permanent: Function that says whether a result would be the same
+        on a retry. Default: only successes are.
+    """
+    if permanent is None:
+        def permanent(result):
+            return result['result']
+    if timer is None:
+        timer = metrics.StageTimer()
+    key = _get_result_key(event)
+    lease = _get_remaining_time(context)
+    wait = ctx.idempotency_wait
+    if lease is not None:
+        wait = min(wait, lease - IDEMPOTENCY_WAIT_MARGIN)
+    with timer.stage('IdempotencyCheck'):
+        state, result = ctx.result_store.begin(key, lease)
+        if state == result_store.PENDING and wait > 0:
+            state, result = ctx.result_store.wait(key, wait, lease)
+    if state == result_store.DONE:
+        return result
+    if state == result_store.PENDING:
+        return {
+            'result': False,
+            'error': 'A request with this idempotency key is in progress.'
+        }
+    try:
+        result = handle()
+    except Exception:
+        ctx.result_store.abandon(key)
+        raise
+    if permanent(result):
+        ctx.result_store.finish(key, result)
+    else:
+        ctx.result_store.abandon(key)
+    return result
+
+
+def deliver_result(ctx, correlation_id, result, timer=None):
+    """
+    Put the result of a request with a correlation id into the result sink.
+    A failure to deliver fails the invocation, so Lambda retries an
+    asynchronous one.
+
+    :param timer: A StageTimer to record the time spent in each stage.
+    """
+    if correlation_id is None or ctx.result_sink is None:
+        return
+    if timer is None:
+        timer = metrics.StageTimer()
+    with timer.stage('ResultDelivery'):
+        ctx.result_sink.put(correlation_id, result)
+
+
+def _deliver_validation_error(ctx, event, error, timer):
+    # A malformed request fails the same way however often it's retried, so
+    # its caller is told rather than left waiting for a result.
+    if ctx is None or not isinstance(event, dict):
+        return
+    try:
+        correlation_id = load_correlation_id(event)
+    except ValidationError:
+        return
+    deliver_result(
+        ctx,
+        correlation_id,
+        {'result': False, 'error': str(error)},
+        timer
+    )
+
+
+def lambda_handler(
+        event, context=None,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda_deploy.cfg'
+        )
+        ):
+    """
+    This is the function that will be called when the lambda function starts.
+    :param event: Dictionary of the json request. Either a single operation,
+        a batch of operations under the 'operations' key, or a reconcile
+        request with a 'mapping', with an optional 'region' (default: the
+        region the lambda runs in), 'idempotency_key' and 'correlation_id'.
+    :param context: AWS LambdaContext Object
+    http://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
+    :param config_file: The config file to load additional settings.
+    :return: A dict with success or error information.
+    """
+    global logger, cold_start
+
+    timer = metrics.StageTimer()
+    start_type = 'cold' if cold_start else 'warm'
+    cold_start = False
+    ctx = None
+    action = 'unknown'
+    outcome = 'error'
+    try:
+        # The region the lambda runs in, which requests are for unless
+        # they say otherwise.
+        region = os.environ['AWS_REGION']
+
+        # Load the deployment config values, reusing them on warm containers
+        with timer.stage('ConfigLoad'):
+            ctx = get_runtime(config_file, region)
+        logger = ctx.logger
+
+        # Process request
+        try:
+            with timer.stage('SchemaLoad'):
+                if 'operations' in event:
+                    batch = load_batch_request(event)
+                    action = 'batch'
+                elif isinstance(event, dict) and \
+                        event.get('action') == RECONCILE:
+                    reconcile = load_reconcile_request(event)
+                    action = RECONCILE
+                else:
+                    request = load_request(event)
+                    action = request.action
+                    if action not in ACTIONS:
+                        action = INVALID_ACTION
+                idempotency_key = load_idempotency_key(event)
+                correlation_id = load_correlation_id(event)
+                # Both the IPs and the KMS key tokens were minted with are
+                # in the request's region.
+                region = load_region(event) or region
+        except ValidationError as e:
+            _deliver_validation_error(ctx, event, e, timer)
+            raise
+        deadline = _get_ec2_deadline(context)
+        # Successes and malformed requests are permanent results; anything
+        # else may go differently on a retry.
+        if action == 'batch':
+            def handle():
+                return handle_batch(
+                    ctx,
+                    region,
+                    batch.operations,
+                    timer,
+                    deadline
+                )
+
+            def permanent(ret):
+                return all(
+                    result['result'] or invalid_request(operation) is not None
+                    for operation, result in zip(
+                        batch.operations,
+                        ret['results']
+                    )
+                )
+        elif action == RECONCILE:
+            def handle():
+                return handle_reconcile(ctx, region, reconcile, timer, deadline)
+
+            def permanent(ret):
+                return (
+                    ret['result'] or
+                    get_reconcile_error(reconcile) is not None
+                )
+        else:
+            def handle():
+                return handle_request(ctx, region, request, timer, deadline)
+
+            def permanent(ret):
+                return ret['result'] or invalid_request(request) is not None
+        if idempotency_key is None or ctx.result_store is None:
+            ret = handle()
+        else:
+            ret = handle_idempotent(
+                ctx,
+                context,
+                event,
+                handle,
+                timer,
+                permanent
+            )
+        deliver_result(ctx, correlation_id, ret, timer)
+        outcome = 'success' if ret['result'] else 'failure'
+        return ret
+    finally:
+        emit_metrics(ctx, context, timer, action, outcome, start_type)
+
+
+def emit_metrics(ctx, context, timer, action, outcome, start_type):
+    """
+    Emit the stage timings of an invocation as a single metrics record.
+    Failing to emit metrics never fails the request.
+    """
+    try:
+        if ctx is None:
+            namespace = 'awseipext'
+        else:
+            namespace = ctx.metrics_namespace
+        timings = dict(timer.timings)
+        timings['Total'] = timer.total()
+        properties = {}
+        request_id = getattr(context, 'aws_request_id', None)
+        if request_id is not None:
+            properties['RequestId'] = request_id
+        metrics.emit(metrics.emf_record(
+            namespace,
+            {
+                'Action': action,
+                'Outcome': outcome,
+                'StartType': start_type
+            },
+            timings,
+            properties=properties
+        ))
+    except Exception:
+        logging.getLogger(__name__).exception('Failed to emit metrics.')
@@ -0,0 +1,137 @@
+"""
+.. module: awseipext.bulk
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import csv
+import json
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('associate', 'disassociate', 'move')
+INPUT_FORMATS = ('jsonl', 'csv')
+
+
+def read_operations(stream, input_format='jsonl'):
+    """
+    Lazily read operations from a stream.
+
+    JSON lines input has an object per line, with action, resource and
+    instance_id keys. CSV input has a header row with the same columns.
+    Blank lines are skipped.
+
+    :param stream: A file-like object to read from.
+    :param input_format: Either 'jsonl' or 'csv'.
+    :return: A generator of (line number, operation) tuples. An operation is
+        a dict, or the raw line if it couldn't be parsed.
+    """
+    if input_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif input_format == 'jsonl':
+        for line_num, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except ValueError:
+                yield line_num, line
+    else:
+        raise ValueError('Invalid input format: {0}'.format(input_format))
+
+
+def run_operation(client, line_num, operation):
+    """
+    Run a single operation with an AwseipextClient.
+
+    :return: A result dict, suitable for writing as a JSON line.
+    """
+    result = {'line': line_num}
+    if not isinstance(operation, dict):
+        result.update({'result': False, 'error': 'Invalid input line.'})
+        return result
+    action = operation.get('action')
+    resource = operation.get('resource')
+    instance_id = operation.get('instance_id')
+    result.update({
+        'action': action,
+        'resource': resource,
+        'instance_id': instance_id
+    })
+    if action not in ACTIONS:
+        result.update({
+            'result': False,
+            'error': '{0} is not a valid action.'.format(action)
+        })
+        return result
+    if not resource or not instance_id:
+        result.update({
+            'result': False,
+            'error': 'resource and instance_id are required.'
+        })
+        return result
+    try:
+        if action == 'associate':
+            response = client.associate(resource, instance_id)
+        elif action == 'move':
+            response = client.move(resource, instance_id)
+        else:
+            response = client.disassociate(resource, instance_id)
+        response = json.loads(response)
+    except Exception as e:
+        logger.exception('Failed to {0} {1}.'.format(action, resource))
+        result.update({'result': False, 'error': str(e)})
+        return result
+    if isinstance(response, dict) and 'result' in response:
+        result.update(response)
+    else:
+        # Lambda errors (e.g. timeouts) come back as an error document.
+        result.update({'result': False, 'error': response})
+    return result
+
+
+def run_operations(client, operations, output, concurrency=10):
+    """
+    Run operations concurrently with a single AwseipextClient, writing each
+    result to output as a JSON line as soon as it finishes. Input is read
+    lazily, with at most twice the concurrency in flight at a time.
+
+    :param client: An AwseipextClient.
+    :param operations: An iterable of (line number, operation) tuples, as
+        returned by read_operations.
+    :param output: A file-like object to write results to.
+    :param concurrency: Number of operations to run at once.
+    :return: The number of failed operations.
+    """
+    output_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    failures = [0]
+
+    def write_result(future):
+        try:
+            result = future.result()
+            with output_lock:
+                if not result['result']:
+                    failures[0] += 1
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for line_num, operation in operations:
+            slots.acquire()
+            future = executor.submit(
+                run_operation,
+                client,
+                line_num,
+                operation
+            )
+            future.add_done_callback(write_result)
+    return failures[0]
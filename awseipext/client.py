@@ -2,9 +2,21 @@ import logging
 import json
 import argparse
 import sys
+import threading
+import time
+import uuid
 
 import boto3
+import botocore.config
 import kmsauth
+from concurrent.futures import ThreadPoolExecutor
+
+from awseipext import bulk
+from awseipext.request.validator import RECONCILE, get_mapping_digest
+from awseipext.result_sink import ResultCollector
+from awseipext.token_cache import TokenCache
+
+logger = logging.getLogger(__name__)
 
 
 class AwseipextClient(object):
@@ -16,14 +28,112 @@ class AwseipextClient(object):
             kmsauth_key,
             from_context,
             to_context,
-            user_type_context
+            user_type_context,
+            token_lifetime=10,
+            token_cache=None,
+            lambda_client=None,
+            max_pool_connections=10,
+            connect_timeout=None,
+            read_timeout=None,
+            idempotent=False,
+            endpoint_url=None,
+            log_type='Tail',
+            result_sink=None,
+            result_timeout=300,
+            region=None,
+            function_region=None
             ):
-        """Create an AwseipextClient object."""
+        """Create an AwseipextClient object.
+
+        Args:
+            token_lifetime: Lifetime, in minutes, of generated kmsauth
+                tokens. Default: 10
+            token_cache: A TokenCache to reuse tokens from. Default: an
+                in-memory TokenCache.
+            lambda_client: A boto3 lambda client (or a stand-in for it) to
+                invoke the function with. Default: a client created on first
+                use, and shared by all calls.
+            max_pool_connections: Size of the lambda client's connection
+                pool. Default: 10
+            connect_timeout: Connect timeout, in seconds, of the lambda
+                client. Default: botocore's default.
+            read_timeout: Read timeout, in seconds, of the lambda client.
+                Default: botocore's default.
+            idempotent: Send a new idempotency key with every call that
+                isn't given one, so a retried invocation of the call is only
+                applied once. Default: False
+            endpoint_url: Endpoint to invoke the function at, such as a
+                local awseipext.service. Default: Lambda's endpoint.
+            log_type: LogType of synchronous invocations: 'Tail' to have
+                Lambda return the tail of the invocation's log, or 'None'.
+                Default: 'Tail'
+            result_sink: The result sink the function puts the results of
+                asynchronous calls in (see awseipext.result_sink). Required
+                for the *_async calls.
+            result_timeout: Seconds to wait for the result of an
+                asynchronous call before failing its future. Default: 300
+            region: Region of the IPs and instances this client acts on.
+                Tokens are minted with the KMS key in this region, and
+                requests ask the function to act in it. Default: tokens are
+                minted in us-east-1, and the function acts in its own region.
+            function_region: Region of the function to invoke. Default:
+                region, so each region's calls go to its own deployment.
+        """
         self.function_name = function_name
         self.kmsauth_key = kmsauth_key
         self.from_context = from_context
         self.to_context = to_context
         self.user_type_context = user_type_context
+        self.token_lifetime = token_lifetime
+        if token_cache is None:
+            self.token_cache = TokenCache()
+        else:
+            self.token_cache = token_cache
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idempotent = idempotent
+        self.endpoint_url = endpoint_url
+        self.log_type = log_type
+        self.result_sink = result_sink
+        self.result_timeout = result_timeout
+        self.region = region
+        self.function_region = function_region or region
+        self._function_region = function_region
+        self._lambda_client = lambda_client
+        self._injected_lambda_client = lambda_client
+        self._lambda_client_lock = threading.Lock()
+        self._collector = None
+        self._regional_clients = {}
+
+    @property
+    def lambda_client(self):
+        """
+        The lambda client used for invocations. It's created on first use
+        and reused afterwards, so connections are kept alive in its pool
+        rather than being set up again for every call.
+        """
+        if self._lambda_client is None:
+            with self._lambda_client_lock:
+                if self._lambda_client is None:
+                    config = {
+                        'max_pool_connections': self.max_pool_connections
+                    }
+                    if self.connect_timeout is not None:
+                        config['connect_timeout'] = self.connect_timeout
+                    if self.read_timeout is not None:
+                        config['read_timeout'] = self.read_timeout
+                    # boto3's default session isn't thread-safe, so use a
+                    # dedicated one.
+                    session = boto3.session.Session(
+                        region_name=self.function_region
+                    )
+                    self._lambda_client = session.client(
+                        'lambda',
+                        endpoint_url=self.endpoint_url,
+                        config=botocore.config.Config(**config)
+                    )
+        return self._lambda_client
 
     def _get_generator(self, action, resource):
         generator = kmsauth.KMSTokenGenerator(
@@ -42,51 +152,370 @@ class AwseipextClient(object):
                 'resource': resource
             },
             # Find the KMS key in this region
-            'us-east-1'
+            self.region or 'us-east-1',
+            token_lifetime=self.token_lifetime
         )
         return generator
 
-    def associate(self, resource, instance_id):
-        generator = self._get_generator('associate', resource)
+    def _get_token_key(self, action, resource):
+        # Everything a token was minted with: the key it was encrypted
+        # with, its auth context and its lifetime, which the cached expiry
+        # was worked out from.
+        key = (
+            self.kmsauth_key,
+            self.to_context,
+            self.from_context,
+            self.user_type_context,
+            action,
+            resource,
+            self.token_lifetime
+        )
+        # A token can only be decrypted in the region it was minted in.
+        if self.region is not None:
+            key += (self.region,)
+        return key
+
+    def _mint_token(self, key, action, resource):
+        generator = self._get_generator(action, resource)
+        # kmsauth sets not_after to the token lifetime minus its clock skew
+        # allowance, from the time the token is generated.
+        not_after = time.time() + 60 * (
+            self.token_lifetime - kmsauth.TOKEN_SKEW
+        )
         username = generator.get_username()
         token = generator.get_token()
-        payload = {
-            'action': 'associate',
+        self.token_cache.set(key, username, token, not_after)
+        return username, token
+
+    def _get_token(self, action, resource):
+        key = self._get_token_key(action, resource)
+        cached = self.token_cache.get(key)
+        if cached is not None:
+            return cached
+        return self._mint_token(key, action, resource)
+
+    def warm_token(self, action, resource, min_ttl=0):
+        """
+        Make sure a token for an action on a resource is cached, and will
+        be used for at least min_ttl more seconds, minting a new one if not.
+
+        :return: True if a token was minted.
+        """
+        key = self._get_token_key(action, resource)
+        ttl = self.token_cache.ttl(key)
+        if ttl is not None and ttl > min_ttl:
+            return False
+        self._mint_token(key, action, resource)
+        return True
+
+    def _get_payload(self, action, resource, instance_id):
+        username, token = self._get_token(action, resource)
+        return {
+            'action': action,
             'resource': resource,
             'instance_id': instance_id,
             'username': username,
             'token': token
         }
-        payload_json = json.dumps(payload)
-        client = boto3.client('lambda')
-        response = client.invoke(
+
+    def _set_region(self, payload):
+        if self.region is not None:
+            payload['region'] = self.region
+        return payload
+
+    def _set_idempotency_key(self, payload, idempotency_key):
+        if idempotency_key is None and self.idempotent:
+            idempotency_key = uuid.uuid4().hex
+        if idempotency_key is not None:
+            payload['idempotency_key'] = idempotency_key
+        return payload
+
+    def _invoke(self, payload):
+        payload_json = json.dumps(self._set_region(payload))
+        response = self.lambda_client.invoke(
             FunctionName=self.function_name,
             InvocationType='RequestResponse',
-            LogType='Tail',
+            LogType=self.log_type,
             Payload=payload_json
         )
         return response['Payload'].read()
 
-    def disassociate(self, resource, instance_id):
-        generator = self._get_generator('disassociate', resource)
-        username = generator.get_username()
-        token = generator.get_token()
+    @property
+    def collector(self):
+        """
+        The ResultCollector resolving the futures of asynchronous calls,
+        created on first use.
+        """
+        if self.result_sink is None:
+            raise ValueError('A result_sink is required for async calls.')
+        if self._collector is None:
+            with self._lambda_client_lock:
+                if self._collector is None:
+                    self._collector = ResultCollector(
+                        self.result_sink,
+                        timeout=self.result_timeout,
+                        transform=json.dumps
+                    )
+        return self._collector
+
+    def _invoke_async(self, payload):
+        collector = self.collector
+        correlation_id = uuid.uuid4().hex
+        payload['correlation_id'] = correlation_id
+        # Lambda retries asynchronous invocations that fail, so they're
+        # always made idempotent.
+        payload.setdefault('idempotency_key', correlation_id)
+        future = collector.register(correlation_id)
+        try:
+            self.lambda_client.invoke(
+                FunctionName=self.function_name,
+                InvocationType='Event',
+                Payload=json.dumps(self._set_region(payload))
+            )
+        except Exception:
+            collector.discard(correlation_id)
+            raise
+        return future
+
+    def associate(self, resource, instance_id, idempotency_key=None):
+        """
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        """
+        payload = self._get_payload('associate', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke(payload)
+
+    def disassociate(self, resource, instance_id, idempotency_key=None):
+        """
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        """
+        payload = self._get_payload('disassociate', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke(payload)
+
+    def move(self, resource, instance_id, idempotency_key=None):
+        """
+        Associate an IP with an instance, taking it from the instance it's
+        currently associated with, if any, in a single call. Both instances
+        must be in this client's role.
+
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        """
+        payload = self._get_payload('move', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke(payload)
+
+    def associate_async(self, resource, instance_id, idempotency_key=None):
+        """
+        Invoke an association asynchronously, without waiting for the
+        function to run.
+
+        :return: A Future that resolves to the response associate would
+            return.
+        """
+        payload = self._get_payload('associate', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke_async(payload)
+
+    def disassociate_async(self, resource, instance_id, idempotency_key=None):
+        """
+        Invoke a disassociation asynchronously, as associate_async.
+        """
+        payload = self._get_payload('disassociate', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke_async(payload)
+
+    def move_async(self, resource, instance_id, idempotency_key=None):
+        """
+        Invoke a move asynchronously, as associate_async.
+        """
+        payload = self._get_payload('move', resource, instance_id)
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke_async(payload)
+
+    def batch(self, operations, idempotency_key=None):
+        """
+        Run several operations in a single lambda invocation.
+
+        :param operations: A list of (action, resource, instance_id) tuples.
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        :return: The lambda's response, with a result per operation.
+        """
         payload = {
-            'action': 'disassociate',
-            'resource': resource,
-            'instance_id': instance_id,
+            'operations': [
+                self._get_payload(action, resource, instance_id)
+                for action, resource, instance_id in operations
+            ]
+        }
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke(payload)
+
+    def for_region(self, region, function_name=None):
+        """
+        Get a client for another region's IPs, with this client's settings
+        and token cache. Clients are created on first use and reused
+        afterwards, so each keeps its connections open. They invoke the
+        function at this client's endpoint, and with its lambda client if
+        one was given; only the default endpoint has a deployment per
+        region.
+
+        :param region: Region of the IPs and instances to act on.
+        :param function_name: Name of the function deployed in the region.
+            Default: this client's function name.
+        :return: An AwseipextClient.
+        """
+        if region == self.region and function_name in (
+                None, self.function_name):
+            return self
+        key = (region, function_name)
+        with self._lambda_client_lock:
+            client = self._regional_clients.get(key)
+            if client is None:
+                client = AwseipextClient(
+                    function_name or self.function_name,
+                    self.kmsauth_key,
+                    self.from_context,
+                    self.to_context,
+                    self.user_type_context,
+                    token_lifetime=self.token_lifetime,
+                    token_cache=self.token_cache,
+                    max_pool_connections=self.max_pool_connections,
+                    connect_timeout=self.connect_timeout,
+                    read_timeout=self.read_timeout,
+                    idempotent=self.idempotent,
+                    log_type=self.log_type,
+                    result_sink=self.result_sink,
+                    result_timeout=self.result_timeout,
+                    region=region,
+                    lambda_client=self._injected_lambda_client,
+                    endpoint_url=self.endpoint_url,
+                    function_region=self._function_region
+                )
+                self._regional_clients[key] = client
+        return client
+
+    def batch_regions(
+            self,
+            operations,
+            idempotency_key=None,
+            function_names=None
+            ):
+        """
+        Run operations on IPs in several regions, with a batch invocation of
+        each region's deployment of the function (or of the function at
+        this client's endpoint, for each region), made concurrently.
+
+        :param operations: A list of (region, action, resource, instance_id)
+            tuples.
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        :param function_names: A dict of region to the name of the function
+            deployed there. Default: this client's function name everywhere.
+        :return: A response like batch's, with a result per operation in
+            request order, each with its region.
+        """
+        function_names = function_names or {}
+        by_region = {}
+        for i, (region, action, resource, instance_id) in enumerate(
+                operations):
+            by_region.setdefault(region, []).append(
+                (i, (action, resource, instance_id))
+            )
+
+        def run(region):
+            client = self.for_region(region, function_names.get(region))
+            try:
+                response = json.loads(client.batch(
+                    [operation for _, operation in by_region[region]],
+                    idempotency_key=idempotency_key
+                ))
+            except Exception as e:
+                logger.exception(
+                    'Batch invocation in {0} failed.'.format(region)
+                )
+                response = {
+                    'result': False,
+                    'error': '{0}: {1}'.format(type(e).__name__, e)
+                }
+            if 'results' in response:
+                return response['results']
+            # The whole invocation failed, so each operation did. Errors
+            # raised by the function come back as an errorMessage.
+            error = response.get('error') or response.get(
+                'errorMessage',
+                'Invocation failed.'
+            )
+            return [
+                {
+                    'result': False,
+                    'error': error,
+                    'action': action,
+                    'resource': resource,
+                    'instance_id': instance_id
+                }
+                for _, (action, resource, instance_id) in by_region[region]
+            ]
+
+        results = [None] * len(operations)
+        if by_region:
+            with ThreadPoolExecutor(max_workers=len(by_region)) as executor:
+                regions = sorted(by_region)
+                for region, region_results in zip(
+                        regions,
+                        executor.map(run, regions)):
+                    for (i, _), result in zip(
+                            by_region[region],
+                            region_results):
+                        result['region'] = region
+                        results[i] = result
+        return json.dumps({
+            'result': all(result['result'] for result in results),
+            'results': results
+        })
+
+    def reconcile(self, mapping, dry_run=False, idempotency_key=None):
+        """
+        Bring a set of IPs in line with a desired mapping, in a single
+        invocation that only makes the changes needed.
+
+        :param mapping: A dict of public IP to the instance id it should be
+            associated with, or to None if it should be unassociated.
+        :param dry_run: Only plan the changes, without applying them.
+        :param idempotency_key: A key identifying this call, to reuse when
+            retrying it. Optional.
+        :return: The lambda's response, with the plan and a result per IP.
+        """
+        username, token = self._get_token(
+            RECONCILE,
+            get_mapping_digest(mapping)
+        )
+        payload = {
+            'action': RECONCILE,
+            'mapping': mapping,
             'username': username,
             'token': token
         }
-        payload_json = json.dumps(payload)
-        client = boto3.client('lambda')
-        response = client.invoke(
-            FunctionName=self.function_name,
-            InvocationType='RequestResponse',
-            LogType='Tail',
-            Payload=payload_json
-        )
-        return response['Payload'].read()
+        if dry_run:
+            payload['dry_run'] = True
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke(payload)
+
+    def batch_async(self, operations, idempotency_key=None):
+        """
+        Invoke a batch asynchronously, as associate_async.
+        """
+        payload = {
+            'operations': [
+                self._get_payload(action, resource, instance_id)
+                for action, resource, instance_id in operations
+            ]
+        }
+        self._set_idempotency_key(payload, idempotency_key)
+        return self._invoke_async(payload)
 
 
 def main():
@@ -97,20 +526,45 @@ def main():
 
     parser.add_argument(
         '--action',
-        choices=['associate', 'disassociate'],
-        required=True,
-        help='Action to take (associate or disassociate).'
+        choices=['associate', 'disassociate', 'move'],
+        help='Action to take (associate, disassociate or move).'
     )
     parser.add_argument(
         '--resource',
-        required=True,
         help='IP address to associate or disassociate.'
     )
     parser.add_argument(
         '--instance-id',
-        required=True,
         help='Instance ID to target.'
     )
+    parser.add_argument(
+        '--input',
+        help=('Read operations from this file (- for stdin) instead of'
+              ' --action, --resource and --instance-id, and write a JSON'
+              ' line result for each.')
+    )
+    parser.add_argument(
+        '--reconcile',
+        help=('Bring IPs in line with the JSON mapping of IP to instance id'
+              ' (or null) in this file (- for stdin).')
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='With --reconcile, only print the changes that would be made.'
+    )
+    parser.add_argument(
+        '--input-format',
+        choices=bulk.INPUT_FORMATS,
+        help='Format of --input. Default: jsonl',
+        default='jsonl'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        help='Number of --input operations to run at once. Default: 10',
+        default=10
+    )
     parser.add_argument(
         '--function-name',
         required=True,
@@ -138,12 +592,61 @@ def main():
         required=True,
         help='KMS key to use for auth.'
     )
+    endpoint = parser.add_mutually_exclusive_group()
+    endpoint.add_argument(
+        '--endpoint-url',
+        help='Invoke the function at this endpoint, such as a local'
+             ' awseipext-service, rather than in Lambda.'
+    )
+    endpoint.add_argument(
+        '--socket',
+        help='Invoke a local awseipext-service listening on this unix'
+             ' socket, rather than Lambda.'
+    )
+    parser.add_argument(
+        '--region',
+        help='Region of the IPs and instances, whose KMS key tokens are'
+             ' minted with. Default: tokens are minted in us-east-1 and the'
+             ' function acts in its own region.'
+    )
+    parser.add_argument(
+        '--function-region',
+        help='Region of the function to invoke. Default: --region'
+    )
+    parser.add_argument(
+        '--no-log-tail',
+        action='store_true',
+        help="Don't have Lambda return the tail of each invocation's log."
+    )
+    parser.add_argument(
+        '--token-cache-file',
+        help='File to cache kmsauth tokens in, to share them between runs.',
+        default=None
+    )
+    parser.add_argument(
+        '--token-cache-margin',
+        type=int,
+        help=('Seconds before expiry to stop using a cached token.'
+              ' Default: 60'),
+        default=60
+    )
     parser.add_argument(
         '--log-level',
         help='Logging verbosity.',
         default='info'
     )
     args = parser.parse_args()
+    if args.reconcile is not None:
+        if args.input is not None:
+            parser.error('--reconcile and --input are mutually exclusive')
+    elif args.input is None:
+        if not (args.action and args.resource and args.instance_id):
+            parser.error(
+                '--action, --resource and --instance-id are required'
+                ' without --input'
+            )
+    elif args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
 
     numeric_loglevel = getattr(logging, args.log_level.upper(), None)
     if not isinstance(numeric_loglevel, int):
@@ -154,17 +657,60 @@ def main():
         stream=sys.stderr
     )
 
+    lambda_client = None
+    if args.socket:
+        from awseipext.service import UnixSocketLambdaClient
+
+        lambda_client = UnixSocketLambdaClient(args.socket)
     client = AwseipextClient(
         args.function_name,
         args.kmsauth_key,
         args._from,
         args._to,
-        args.user_type
+        args.user_type,
+        token_cache=TokenCache(
+            cache_file=args.token_cache_file,
+            safety_margin=args.token_cache_margin
+        ),
+        lambda_client=lambda_client,
+        max_pool_connections=max(10, args.concurrency),
+        endpoint_url=args.endpoint_url,
+        log_type='None' if args.no_log_tail else 'Tail',
+        region=args.region,
+        function_region=args.function_region
     )
-    if args.action == 'associate':
+    if args.reconcile is not None:
+        if args.reconcile == '-':
+            mapping = json.load(sys.stdin)
+        else:
+            with open(args.reconcile, 'r') as f:
+                mapping = json.load(f)
+        response = client.reconcile(mapping, dry_run=args.dry_run)
+        print response
+        sys.exit(0 if json.loads(response).get('result') else 1)
+    elif args.input is not None:
+        if args.input == '-':
+            failures = bulk.run_operations(
+                client,
+                bulk.read_operations(sys.stdin, args.input_format),
+                sys.stdout,
+                concurrency=args.concurrency
+            )
+        else:
+            with open(args.input, 'r') as f:
+                failures = bulk.run_operations(
+                    client,
+                    bulk.read_operations(f, args.input_format),
+                    sys.stdout,
+                    concurrency=args.concurrency
+                )
+        sys.exit(1 if failures else 0)
+    elif args.action == 'associate':
         print client.associate(args.resource, args.instance_id)
     elif args.action == 'disassociate':
         print client.disassociate(args.resource, args.instance_id)
+    elif args.action == 'move':
+        print client.move(args.resource, args.instance_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+"""
+.. module: awseipext.coldstart
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules that are slow to import, and shouldn't be loaded until a request
+# actually needs them.
+HEAVY_MODULES = (
+    'boto3',
+    'botocore.session',
+    'kmsauth',
+    'marshmallow',
+    'concurrent.futures'
+)
+
+# Environment variables stripped from the measured interpreter, so the
+# measurement doesn't depend on (or pick up) the caller's AWS setup.
+AWS_ENVIRONMENT = ('AWS_REGION', 'AWS_DEFAULT_REGION', 'AWS_PROFILE')
+
+_IMPORT_SCRIPT = '''
+import json
+import sys
+import time
+
+start = time.time()
+__import__(sys.argv[1])
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+'''
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure_import(module, runs=5, python=None, path=None):
+    """
+    Measure how long a module takes to import in a fresh interpreter, as it
+    would on a cold start.
+
+    :param module: Name of the module to import.
+    :param runs: Number of fresh interpreters to measure.
+    :param python: The interpreter to use. Default: the current one.
+    :param path: Directory to import the module from, which is also the
+        interpreter's working directory. Default: the current sys.path.
+    :return: A dict with the median, min and max import time in seconds,
+        and the heavy modules the import loaded.
+    """
+    if python is None:
+        python = sys.executable
+    env = dict(
+        (key, value) for key, value in os.environ.items()
+        if key not in AWS_ENVIRONMENT
+    )
+    if path is None:
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    else:
+        env['PYTHONPATH'] = path
+    timings = []
+    modules = set()
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [python, '-c', _IMPORT_SCRIPT, module],
+            env=env,
+            cwd=path
+        )
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.append(result['elapsed'])
+        modules.update(result['modules'])
+    return {
+        'module': module,
+        'runs': runs,
+        'median': _median(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'heavy_modules': sorted(
+            name for name in HEAVY_MODULES if name in modules
+        )
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cold import time of a module.'
+    )
+    parser.add_argument(
+        'module',
+        nargs='?',
+        default='awseipext.aws_lambda.lambda_function',
+        help='Module to import. Default: the lambda function.'
+    )
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+        help='Number of fresh interpreters to measure. Default: 5'
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        help='Exit non-zero if the median import time exceeds this (seconds).'
+    )
+    args = parser.parse_args()
+    result = measure_import(args.module, runs=args.runs)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if args.budget is not None and result['median'] > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,25 @@ class LambdaConfig(ConfigParser.RawConfigParser):
 
         :param config_file: Path to the config file.
         """
-        defaults = {'kmsauth_user_key': None, 'logging_level_option': 'INFO'}
+        defaults = {
+            'kmsauth_user_key': None,
+            'logging_level_option': 'INFO',
+            'batch_concurrency': '10',
+            'metrics_namespace': 'awseipext',
+            'idempotency_store': 'memory',
+            'idempotency_directory': None,
+            'idempotency_table': None,
+            'idempotency_ttl': '300',
+            'idempotency_wait': '10',
+            'result_sink': 'none',
+            'result_sink_directory': None,
+            'result_sink_queue_url': None,
+            'lease_store': 'memory',
+            'lease_directory': None,
+            'lease_table': None,
+            'lease_duration': '30',
+            'lease_wait': '10'
+        }
         ConfigParser.RawConfigParser.__init__(self, defaults=defaults)
         self.read(config_file)
 
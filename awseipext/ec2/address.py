@@ -0,0 +1,55 @@
+"""
+.. module: awseipext.ec2.address
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+
+
+class Address(object):
+    def __init__(
+            self,
+            public_ip,
+            allocation_id=None,
+            association_id=None,
+            instance_id=None,
+            network_interface_id=None,
+            domain=None
+            ):
+        """
+        A snapshot of an elastic IP's state, as returned by a single
+        describe_addresses call.
+
+        :param public_ip: The elastic IP address.
+        :param allocation_id: The allocation id of the address (vpc only).
+        :param association_id: The association id, if associated (vpc only).
+        :param instance_id: The instance the address is associated with.
+        :param network_interface_id: The network interface the address is
+            associated with.
+        :param domain: Either 'vpc' or 'standard'.
+        """
+        self.public_ip = public_ip
+        self.allocation_id = allocation_id
+        self.association_id = association_id
+        self.instance_id = instance_id
+        self.network_interface_id = network_interface_id
+        self.domain = domain
+
+    @classmethod
+    def from_description(cls, description):
+        """
+        Build an Address from an entry of a describe_addresses response.
+        """
+        return cls(
+            description['PublicIp'],
+            allocation_id=description.get('AllocationId'),
+            association_id=description.get('AssociationId'),
+            instance_id=description.get('InstanceId') or None,
+            network_interface_id=description.get('NetworkInterfaceId'),
+            domain=description.get('Domain')
+        )
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
@@ -0,0 +1,120 @@
+"""
+.. module: awseipext.ec2.inventory
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import threading
+import time
+
+from awseipext.ec2.address import Address
+
+
+class AddressInventory(object):
+    def __init__(self, ttl, clock=time.time):
+        """
+        An in-memory index of every elastic IP in the account and region,
+        keyed by public IP, allocation id and instance id.
+
+        The index is loaded with a single describe_addresses call, and is
+        considered stale ttl seconds after that. In between, callers should
+        record their own changes with update(), and invalidate() it when
+        they suspect it's wrong.
+
+        :param ttl: Seconds before the index needs a full refresh.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self.refreshed_at = None
+        self.by_public_ip = {}
+        self.by_allocation_id = {}
+        self.by_instance_id = {}
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def is_stale(self):
+        refreshed_at = self.refreshed_at
+        return refreshed_at is None or self.clock() - refreshed_at >= self.ttl
+
+    def load(self, descriptions):
+        """
+        Replace the index with the given describe_addresses entries.
+        """
+        with self.lock:
+            self.by_public_ip = {}
+            self.by_allocation_id = {}
+            self.by_instance_id = {}
+            for description in descriptions:
+                self._add(Address.from_description(description))
+            self.refreshed_at = self.clock()
+
+    def refresh(self, ec2_client, force=False):
+        """
+        Reload the index from describe_addresses, if it's stale. Concurrent
+        callers share a single refresh.
+
+        :raises botocore.exceptions.ClientError: If the lookup fails.
+        """
+        with self.refresh_lock:
+            if force or self.is_stale():
+                addrs = ec2_client.describe_addresses()
+                self.load(addrs['Addresses'])
+
+    def invalidate(self):
+        """
+        Mark the index as stale, so the next lookup refreshes it.
+        """
+        self.refreshed_at = None
+
+    def _add(self, address):
+        self.by_public_ip[address.public_ip] = address
+        if address.allocation_id:
+            self.by_allocation_id[address.allocation_id] = address
+        if address.instance_id:
+            self.by_instance_id.setdefault(
+                address.instance_id,
+                set()
+            ).add(address.public_ip)
+
+    def _remove(self, public_ip):
+        address = self.by_public_ip.pop(public_ip, None)
+        if address is None:
+            return
+        if address.allocation_id:
+            self.by_allocation_id.pop(address.allocation_id, None)
+        if address.instance_id:
+            public_ips = self.by_instance_id.get(address.instance_id, set())
+            public_ips.discard(public_ip)
+            if not public_ips:
+                self.by_instance_id.pop(address.instance_id, None)
+
+    def update(self, address):
+        """
+        Record the current state of an address, replacing any previous one.
+        """
+        with self.lock:
+            self._remove(address.public_ip)
+            self._add(address)
+
+    def get(self, public_ip):
+        with self.lock:
+            return self.by_public_ip.get(public_ip)
+
+    def get_by_allocation_id(self, allocation_id):
+        with self.lock:
+            return self.by_allocation_id.get(allocation_id)
+
+    def get_by_instance_id(self, instance_id):
+        """
+        :return: A list of the Addresses associated with an instance.
+        """
+        with self.lock:
+            return [
+                self.by_public_ip[public_ip]
+                for public_ip in sorted(
+                    self.by_instance_id.get(instance_id, ())
+                )
+            ]
+
+    def __len__(self):
+        return len(self.by_public_ip)
@@ -0,0 +1,306 @@
+"""
+.. module: awseipext.ec2.retry
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import functools
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+THROTTLE = 'throttle'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+THROTTLE_ERRORS = (
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'RequestThrottled',
+    'TooManyRequestsException'
+)
+TRANSIENT_ERRORS = (
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'RequestTimeoutException'
+)
+# Errors raised before or while talking to the endpoint, where the call may
+# not have been made.
+CONNECTION_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError
+)
+
+# Calls that don't change anything, and so are safe to retry after any
+# transient error. Other calls are only retried after a throttle, which
+# EC2 returns before applying the call.
+READ_OPERATIONS = (
+    'describe_addresses',
+    'describe_instances'
+)
+
+
+def classify_error(error):
+    """
+    Classify an error from an EC2 call.
+
+    :return: THROTTLE, TRANSIENT or PERMANENT.
+    """
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        if code in THROTTLE_ERRORS:
+            return THROTTLE
+        status = error.response.get(
+            'ResponseMetadata', {}
+        ).get('HTTPStatusCode')
+        if code in TRANSIENT_ERRORS or (status and status >= 500):
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(error, CONNECTION_ERRORS):
+        return TRANSIENT
+    return PERMANENT
+
+
+def _rate_limited(operation):
+    return botocore.exceptions.ClientError(
+        {
+            'Error': {
+                'Code': 'RequestLimitExceeded',
+                'Message': 'Rate limited before the call was made.'
+            }
+        },
+        operation
+    )
+
+
+class AdaptiveTokenBucket(object):
+    def __init__(
+            self,
+            rate,
+            min_rate=1,
+            increase=0.5,
+            decrease=0.5,
+            clock=time.time,
+            sleep=time.sleep
+            ):
+        """
+        A thread-safe token bucket whose rate adapts to throttling: it's
+        cut by a factor on every throttle, and grows back by a fixed amount
+        on every successful call, up to the initial rate.
+
+        :param rate: Maximum calls per second, and the bucket's size.
+        :param min_rate: Rate below which throttles don't slow it further.
+        :param increase: Calls per second added on every success.
+        :param decrease: Factor the rate is multiplied by on a throttle.
+        :param clock: Function returning the current time, in seconds.
+        :param sleep: Function to sleep for some seconds.
+        """
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.rate = self.max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.max_rate
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self.last)
+        self.tokens = min(self.rate, self.tokens + elapsed * self.rate)
+        self.last = now
+
+    def acquire(self, deadline=None):
+        """
+        Take a token, waiting for one if the bucket is empty. Tokens are
+        reserved in order, so the bucket may go into debt, and each caller
+        waits until its own token would have been refilled.
+
+        :param deadline: Time, in seconds since the epoch, after which to
+            stop waiting. Default: wait as long as it takes.
+        :return: True if a token was taken, False if the deadline would
+            pass first.
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate)
+            if deadline is not None and now + wait > deadline:
+                self.tokens += 1
+                return False
+        if wait:
+            self.sleep(wait)
+        return True
+
+    def on_throttle(self):
+        with self.lock:
+            self._refill(self.clock())
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, self.rate)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class Retrier(object):
+    def __init__(
+            self,
+            bucket,
+            max_attempts=8,
+            base_delay=0.05,
+            max_delay=2,
+            clock=time.time,
+            sleep=time.sleep,
+            seed=None
+            ):
+        """
+        Retries calls after throttles and transient errors, with
+        decorrelated jitter backoff, and rate limits them with a shared
+        token bucket. A retrier is shared by concurrent callers, each of
+        which passes its own deadline to call.
+
+        :param bucket: An AdaptiveTokenBucket shared by every call.
+        :param max_attempts: Maximum attempts per call.
+        :param base_delay: Minimum backoff, in seconds.
+        :param max_delay: Maximum backoff, in seconds.
+        :param clock: Function returning the current time, in seconds.
+        :param sleep: Function to sleep for some seconds.
+        :param seed: Seed for the backoff jitter.
+        """
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.retries = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def _backoff(self, delay):
+        # Decorrelated jitter: a random delay between the base and three
+        # times the previous delay.
+        with self.lock:
+            return min(
+                self.max_delay,
+                self.random.uniform(self.base_delay, delay * 3)
+            )
+
+    def call(self, operation, function, retry_transient=True, deadline=None):
+        """
+        Call a function, retrying it as needed.
+
+        :param operation: Name of the call, for errors raised here.
+        :param function: Function making the call.
+        :param retry_transient: Whether transient errors (as opposed to
+            throttles) may be retried.
+        :param deadline: Time, in seconds since the epoch, the caller has to
+            give up by (for a lambda, when it would time out). No attempt is
+            rate limited, and no retry started, that couldn't begin before
+            then. Default: no deadline.
+        """
+        delay = self.base_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.bucket.acquire(deadline):
+                raise _rate_limited(operation)
+            try:
+                result = function()
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == THROTTLE:
+                    self.bucket.on_throttle()
+                    with self.lock:
+                        self.throttles += 1
+                retryable = kind == THROTTLE or (
+                    kind == TRANSIENT and retry_transient
+                )
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+                delay = self._backoff(delay)
+                if deadline is not None and \
+                        self.clock() + delay >= deadline:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                self.sleep(delay)
+            else:
+                self.bucket.on_success()
+                return result
+
+
+class RetryingPaginator(object):
+    def __init__(self, paginator, retrier, operation, deadline=None):
+        self.paginator = paginator
+        self.retrier = retrier
+        self.operation = operation
+        self.deadline = deadline
+
+    def paginate(self, **kwargs):
+        """
+        Fetch every page, retrying the whole pagination if a page fails.
+
+        :return: A list of pages.
+        """
+        return self.retrier.call(
+            self.operation,
+            lambda: list(self.paginator.paginate(**kwargs)),
+            retry_transient=self.operation in READ_OPERATIONS,
+            deadline=self.deadline
+        )
+
+
+class RetryingClient(object):
+    def __init__(self, client, retrier, operations=None, deadline=None):
+        """
+        Wraps an EC2 client so its calls go through a Retrier. Attributes
+        other than the wrapped calls are passed through to the client.
+
+        :param client: A boto3 EC2 client, or a stand-in for one.
+        :param retrier: The Retrier to make calls with.
+        :param operations: Names of the calls to wrap. Default: the calls
+            awseipext makes.
+        :param deadline: Time, in seconds since the epoch, to give up
+            retrying calls by. Default: no deadline.
+        """
+        self.client = client
+        self.retrier = retrier
+        self.deadline = deadline
+        if operations is None:
+            operations = READ_OPERATIONS + (
+                'associate_address',
+                'disassociate_address'
+            )
+        self.operations = operations
+
+    def _call(self, operation, *args, **kwargs):
+        method = getattr(self.client, operation)
+        return self.retrier.call(
+            operation,
+            functools.partial(method, *args, **kwargs),
+            retry_transient=operation in READ_OPERATIONS,
+            deadline=self.deadline
+        )
+
+    def get_paginator(self, operation):
+        return RetryingPaginator(
+            self.client.get_paginator(operation),
+            self.retrier,
+            operation,
+            self.deadline
+        )
+
+    def __getattr__(self, name):
+        if name in self.operations:
+            return functools.partial(self._call, name)
+        return getattr(self.client, name)
@@ -0,0 +1,113 @@
+"""
+.. module: awseipext.file_store
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Helpers for stores that keep a JSON entry per key in a directory shared by
+processes on a host. Entries are only ever put in place whole, by linking
+or renaming a complete temp file, so readers never see a partial one.
+Changes that depend on the entry already there, such as taking over an
+expired one, are made under an exclusive lock on the directory.
+"""
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import tempfile
+
+LOCK_FILE = '.lock'
+TEMP_SUFFIX = '.tmp'
+
+
+def read(path, stale_after=0):
+    """
+    Read an entry.
+
+    :param stale_after: Seconds after its last change that an entry which
+        can't be parsed, such as one left by an older writer that died
+        while writing it, is treated as expired.
+    :return: The entry, or None if there isn't one. An entry that can't be
+        parsed is returned as a dict with only an expires time.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return {'expires': mtime + stale_after}
+
+
+def _write_temp(directory, entry):
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=TEMP_SUFFIX)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def create(directory, path, entry):
+    """
+    Put an entry in place, unless there already is one.
+
+    :return: True if the entry was created.
+    """
+    temp_path = _write_temp(directory, entry)
+    try:
+        os.link(temp_path, path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.remove(temp_path)
+    return True
+
+
+def replace(directory, path, entry):
+    """
+    Put an entry in place, replacing any already there.
+    """
+    os.rename(_write_temp(directory, entry), path)
+
+
+def remove(path):
+    """
+    Remove an entry, if there is one.
+
+    :return: True if this call removed it.
+    """
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def locked(directory):
+    """
+    Hold an exclusive lock on a directory's entries for as long as the
+    block runs. Entries are only replaced or removed under the lock, so
+    an entry read under it stays put until the lock is released.
+    """
+    fd = os.open(os.path.join(directory, LOCK_FILE), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
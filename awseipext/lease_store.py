@@ -0,0 +1,314 @@
+"""
+.. module: awseipext.lease_store
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Stores for short per-IP leases, which serialise the check-and-mutate of
+concurrent requests for the same IP. Without them, two invocations can both
+see an IP in the state they expect and then both change it. A request that
+finds an IP leased waits in line for it, rather than failing and being
+retried. Leases expire, so one whose holder died is eventually taken over.
+"""
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import botocore.exceptions
+
+from awseipext import file_store
+
+STORES = ('memory', 'file', 'dynamodb', 'none')
+
+
+class MemoryLeaseStore(object):
+    # Whether other processes, and so changes the address inventory hasn't
+    # seen, can hold leases in the store.
+    shared = False
+
+    def __init__(self):
+        """
+        A lease store local to this process. Waiters for a key are served
+        in the order they arrived.
+        """
+        # Key to an (owner, expires) tuple.
+        self.leases = {}
+        # Key to a deque of the owners waiting for it.
+        self.waiters = {}
+        self.condition = threading.Condition()
+
+    def _take(self, key, owner, duration):
+        now = time.time()
+        held = self.leases.get(key)
+        if held is not None and held[0] != owner and held[1] > now:
+            return False
+        self.leases[key] = (owner, now + duration)
+        return True
+
+    def try_acquire(self, key, owner, duration):
+        """
+        Lease a key, unless someone else holds or is waiting for it.
+
+        :param owner: A string identifying the holder.
+        :param duration: Seconds the lease lasts.
+        :return: True if the lease was taken.
+        """
+        with self.condition:
+            if self.waiters.get(key):
+                return False
+            return self._take(key, owner, duration)
+
+    def acquire(self, key, owner, duration, timeout):
+        """
+        Lease a key, waiting in line behind earlier waiters for it.
+
+        :param timeout: Seconds to wait.
+        :return: True if the lease was taken, False if the timeout passed.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            queue = self.waiters.setdefault(key, collections.deque())
+            queue.append(owner)
+            try:
+                while True:
+                    if queue[0] == owner and \
+                            self._take(key, owner, duration):
+                        return True
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    held = self.leases.get(key)
+                    if held is not None:
+                        # Wake up when the lease expires, in case its holder
+                        # never releases it.
+                        remaining = min(
+                            remaining,
+                            max(held[1] - time.time(), 0.001)
+                        )
+                    self.condition.wait(remaining)
+            finally:
+                queue.remove(owner)
+                if not queue:
+                    del self.waiters[key]
+                self.condition.notify_all()
+
+    def release(self, key, owner):
+        """
+        Release a lease, if owner still holds it.
+        """
+        with self.condition:
+            held = self.leases.get(key)
+            if held is not None and held[0] == owner:
+                del self.leases[key]
+                self.condition.notify_all()
+
+
+class FileLeaseStore(object):
+    shared = True
+
+    def __init__(self, directory, poll_interval=0.05):
+        """
+        A lease store in a directory, one file per leased key, that can be
+        shared by processes on a host. Leases are taken by linking a
+        complete file into place, the way DynamoDBLeaseStore takes them
+        with a conditional write. Expired leases are taken over, and leases
+        released, under a lock on the directory, so two takers can't both
+        end up holding one. Waiters poll, so they aren't served in order.
+
+        :param directory: Directory to keep leases in.
+        :param poll_interval: Seconds between checks while waiting.
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}.json'.format(name))
+
+    def try_acquire(self, key, owner, duration):
+        """
+        Lease a key, unless someone else holds it, as
+        MemoryLeaseStore.try_acquire.
+        """
+        path = self._path(key)
+        entry = {'owner': owner, 'expires': time.time() + duration}
+        if file_store.create(self.directory, path, entry):
+            return True
+        with file_store.locked(self.directory):
+            # A lease that can't be read is treated as expired once it's
+            # been around for as long as this one would last.
+            held = file_store.read(path, duration)
+            if held is None:
+                return file_store.create(self.directory, path, entry)
+            if held.get('owner') != owner and held['expires'] > time.time():
+                return False
+            # The lease expired, or is this owner's; replace it whole.
+            entry['expires'] = time.time() + duration
+            file_store.replace(self.directory, path, entry)
+        held = file_store.read(path)
+        return held is not None and held.get('owner') == owner
+
+    def acquire(self, key, owner, duration, timeout):
+        """
+        Lease a key, waiting for its holder to release it, as
+        MemoryLeaseStore.acquire.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.try_acquire(key, owner, duration):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def release(self, key, owner):
+        """
+        Release a lease, if owner still holds it.
+        """
+        path = self._path(key)
+        with file_store.locked(self.directory):
+            held = file_store.read(path)
+            if held is not None and held.get('owner') == owner:
+                file_store.remove(path)
+
+
+class DynamoDBLeaseStore(object):
+    shared = True
+
+    def __init__(
+            self,
+            table_name,
+            dynamodb_client=None,
+            region=None,
+            poll_interval=0.05
+            ):
+        """
+        A lease store in a DynamoDB table, shared by every container of the
+        function. Leases are taken with a conditional write that only
+        succeeds if the key isn't leased, or its lease has expired. Waiters
+        poll, so they aren't served in order.
+
+        The table's partition key is a string named resource. Its expires
+        attribute can be used as the table's TTL attribute, to clear out
+        expired leases.
+
+        :param table_name: Name of the table.
+        :param dynamodb_client: A boto3 DynamoDB client, or a stand-in for
+            one. Default: one created on first use.
+        :param region: Region of the table, for the default client.
+        :param poll_interval: Seconds between checks while waiting.
+        """
+        self.table_name = table_name
+        self.region = region
+        self.poll_interval = poll_interval
+        self._dynamodb_client = dynamodb_client
+        self._dynamodb_client_lock = threading.Lock()
+
+    @property
+    def dynamodb_client(self):
+        if self._dynamodb_client is None:
+            with self._dynamodb_client_lock:
+                if self._dynamodb_client is None:
+                    import boto3
+
+                    session = boto3.session.Session()
+                    self._dynamodb_client = session.client(
+                        'dynamodb',
+                        region_name=self.region
+                    )
+        return self._dynamodb_client
+
+    def try_acquire(self, key, owner, duration):
+        """
+        Lease a key, unless someone else holds it, as
+        MemoryLeaseStore.try_acquire.
+        """
+        now = time.time()
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'resource': {'S': key},
+                    'owner': {'S': owner},
+                    'expires': {'N': repr(now + duration)}
+                },
+                ConditionExpression=(
+                    'attribute_not_exists(#resource) OR #expires < :now'
+                    ' OR #owner = :owner'
+                ),
+                ExpressionAttributeNames={
+                    '#resource': 'resource',
+                    '#expires': 'expires',
+                    '#owner': 'owner'
+                },
+                ExpressionAttributeValues={
+                    ':now': {'N': repr(now)},
+                    ':owner': {'S': owner}
+                }
+            )
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def acquire(self, key, owner, duration, timeout):
+        """
+        Lease a key, waiting for its holder to release it, as
+        MemoryLeaseStore.acquire.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.try_acquire(key, owner, duration):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def release(self, key, owner):
+        """
+        Release a lease, if owner still holds it.
+        """
+        try:
+            self.dynamodb_client.delete_item(
+                TableName=self.table_name,
+                Key={'resource': {'S': key}},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code != 'ConditionalCheckFailedException':
+                raise
+
+
+def create_lease_store(store, directory=None, table=None, region=None):
+    """
+    Create a lease store from its config.
+
+    :param store: One of STORES.
+    :param directory: Directory for the file store.
+    :param table: Table name for the dynamodb store.
+    :param region: Region of the table.
+    :return: A lease store, or None if store is 'none'.
+    """
+    if store == 'memory':
+        return MemoryLeaseStore()
+    if store == 'file':
+        if not directory:
+            raise ValueError('lease_directory not set.')
+        return FileLeaseStore(directory)
+    if store == 'dynamodb':
+        if not table:
+            raise ValueError('lease_table not set.')
+        return DynamoDBLeaseStore(table, region=region)
+    if store == 'none':
+        return None
+    raise ValueError('Invalid lease store: {0}'.format(store))
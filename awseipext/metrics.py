@@ -0,0 +1,115 @@
+"""
+.. module: awseipext.metrics
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class StageTimer(object):
+    def __init__(self, clock=time.time):
+        """
+        Accumulates how long each stage of an invocation takes. A stage
+        entered more than once (in a batch, say) adds up.
+
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.clock = clock
+        self.start = clock()
+        self.timings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = (self.clock() - start) * 1000
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0) + elapsed
+
+    def total(self):
+        return (self.clock() - self.start) * 1000
+
+
+def emf_record(namespace, dimensions, metrics, properties=None,
+               timestamp=None):
+    """
+    Build a CloudWatch Embedded Metric Format record.
+
+    :param namespace: The CloudWatch namespace.
+    :param dimensions: A dict of dimension name to value.
+    :param metrics: A dict of metric name to value, in milliseconds.
+    :param properties: A dict of extra, non-dimension fields to include.
+    :param timestamp: Time of the record, in seconds. Default: now.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    record = {
+        '_aws': {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Milliseconds'}
+                    for name in metrics
+                ]
+            }]
+        }
+    }
+    record.update(properties or {})
+    record.update(dimensions)
+    record.update(metrics)
+    return record
+
+
+class StdoutSink(object):
+    """Writes records to stdout as JSON lines, where Lambda picks them up."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        stream = self.stream or sys.stdout
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            stream.write(line + '\n')
+            stream.flush()
+
+
+class MemorySink(object):
+    """Keeps records in a list; useful for tests."""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+sink = StdoutSink()
+
+
+def set_sink(new_sink):
+    """
+    Replace the sink metrics are emitted to.
+
+    :return: The previous sink.
+    """
+    global sink
+
+    old_sink = sink
+    sink = new_sink
+    return old_sink
+
+
+def emit(record):
+    sink.emit(record)
@@ -0,0 +1,276 @@
+"""
+.. module: awseipext.publish
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Builds the lambda's deployment zip from the import closure of the lambda
+function, rather than from a whole virtualenv. Every module the function can
+import, including those it only imports when a request needs them, is
+found by scanning its bytecode, and only the installed dependencies and
+awseipext modules among them are shipped, as precompiled bytecode. Modules
+the Lambda runtime already provides are left out, so the zip is smaller,
+and nothing is compiled on a cold start.
+"""
+import argparse
+import distutils.sysconfig
+import json
+import modulefinder
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipfile
+
+from awseipext import coldstart
+
+LAMBDA_FUNCTION = os.path.join(
+    os.path.dirname(__file__),
+    'aws_lambda',
+    'lambda_function.py'
+)
+# The module Lambda imports the handler from, at the root of the zip.
+HANDLER_MODULE = 'lambda_function'
+
+# Packages the Lambda Python runtime provides.
+RUNTIME_PROVIDED = ('boto3', 'botocore')
+
+# Entries get a fixed time, so the same closure always gives the same zip.
+ZIP_DATE_TIME = (2016, 1, 1, 0, 0, 0)
+
+_CODE_EXTENSIONS = ('.py', '.pyc', '.pyo')
+
+
+def _site_dirs():
+    dirs = set([
+        distutils.sysconfig.get_python_lib(),
+        distutils.sysconfig.get_python_lib(plat_specific=True)
+    ])
+    dirs.update(
+        path for path in sys.path
+        if os.path.basename(path) in ('site-packages', 'dist-packages')
+    )
+    return [os.path.join(os.path.realpath(path), '') for path in dirs]
+
+
+def _is_excluded(name, excludes):
+    return any(
+        name == exclude or name.startswith(exclude + '.')
+        for exclude in excludes
+    )
+
+
+def find_closure(script=LAMBDA_FUNCTION, excludes=RUNTIME_PROVIDED):
+    """
+    Find the modules a script can import that need to be shipped with it:
+    awseipext's own, and installed dependencies. The standard library and
+    excluded packages are left out.
+
+    :param script: Path of the script.
+    :param excludes: Packages to leave out, along with anything only they
+        import.
+    :return: A dict of module name to a (path, is_package) tuple. The
+        script itself is HANDLER_MODULE.
+    """
+    finder = modulefinder.ModuleFinder(excludes=list(excludes))
+    finder.run_script(script)
+    site_dirs = _site_dirs()
+    closure = {}
+    for name, module in finder.modules.items():
+        path = module.__file__
+        if path is None or _is_excluded(name, excludes):
+            continue
+        if name == '__main__':
+            closure[HANDLER_MODULE] = (path, False)
+            continue
+        real_path = os.path.realpath(path)
+        if name != 'awseipext' and not name.startswith('awseipext.') and \
+                not any(real_path.startswith(d) for d in site_dirs):
+            continue
+        closure[name] = (path, module.__path__ is not None)
+    return closure
+
+
+def _archive_name(name, path, is_package):
+    parts = name.split('.')
+    if is_package:
+        parts.append('__init__')
+    base, extension = os.path.splitext(path)
+    if extension in _CODE_EXTENSIONS:
+        extension = '.py'
+    return '/'.join(parts) + extension
+
+
+def _package_data(closure):
+    """
+    The non-code files in the directories of packages in the closure, such
+    as certificate bundles, as (path, archive name) tuples.
+    """
+    files = []
+    for name, (path, is_package) in closure.items():
+        if not is_package:
+            continue
+        directory = os.path.dirname(path)
+        for entry in sorted(os.listdir(directory)):
+            entry_path = os.path.join(directory, entry)
+            if os.path.isfile(entry_path) and \
+                    os.path.splitext(entry)[1] not in _CODE_EXTENSIONS:
+                files.append((
+                    entry_path,
+                    '/'.join(name.split('.') + [entry])
+                ))
+    return files
+
+
+def _add(archive, arcname, data):
+    info = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    archive.writestr(info, data)
+
+
+def build(
+        output,
+        config_dir=None,
+        script=LAMBDA_FUNCTION,
+        excludes=RUNTIME_PROVIDED,
+        sources=False
+        ):
+    """
+    Build a deployment zip of a script's import closure, with each Python
+    module precompiled.
+
+    :param output: Path of the zip to write.
+    :param config_dir: Directory whose files, such as lambda_deploy.cfg,
+        are put at the root of the zip. Optional.
+    :param script: Path of the lambda function.
+    :param excludes: Packages the runtime provides, to leave out.
+    :param sources: Ship each module's source along with its bytecode.
+        Without it, modules are imported straight from their bytecode,
+        which tracebacks then have no source lines for.
+    :return: A dict of the modules shipped and the zip's size.
+    """
+    closure = find_closure(script, excludes)
+    staging = tempfile.mkdtemp()
+    uncompressed = 0
+    try:
+        directory = os.path.dirname(os.path.abspath(output))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with zipfile.ZipFile(output, 'w') as archive:
+            entries = []
+            for name, (path, is_package) in sorted(closure.items()):
+                arcname = _archive_name(name, path, is_package)
+                if not arcname.endswith('.py'):
+                    # An extension module, shipped as it is.
+                    entries.append((arcname, path))
+                    continue
+                compiled = os.path.join(staging, arcname + 'c')
+                if not os.path.exists(os.path.dirname(compiled)):
+                    os.makedirs(os.path.dirname(compiled))
+                py_compile.compile(
+                    path,
+                    cfile=compiled,
+                    dfile=arcname,
+                    doraise=True
+                )
+                entries.append((arcname + 'c', compiled))
+                if sources:
+                    entries.append((arcname, path))
+            entries.extend(
+                (arcname, path)
+                for path, arcname in _package_data(closure)
+            )
+            if config_dir is not None:
+                entries.extend(
+                    (entry, os.path.join(config_dir, entry))
+                    for entry in os.listdir(config_dir)
+                    if os.path.isfile(os.path.join(config_dir, entry))
+                )
+            for arcname, path in sorted(entries):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                uncompressed += len(data)
+                _add(archive, arcname, data)
+    finally:
+        shutil.rmtree(staging)
+    return {
+        'output': output,
+        'modules': sorted(closure),
+        'excluded': sorted(excludes),
+        'files': len(entries),
+        'size': os.path.getsize(output),
+        'uncompressed_size': uncompressed
+    }
+
+
+def measure_artifact(output, runs=5):
+    """
+    Measure the cold import time of the handler module from a built zip,
+    extracted the way Lambda extracts it.
+
+    :return: A dict as coldstart.measure_import returns.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        with zipfile.ZipFile(output) as archive:
+            archive.extractall(directory)
+        return coldstart.measure_import(
+            HANDLER_MODULE,
+            runs=runs,
+            path=directory
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the lambda's deployment zip from its import"
+                    ' closure, as precompiled bytecode.'
+    )
+    parser.add_argument(
+        '--output',
+        default=os.path.join('publish', 'awseipext_lambda.zip'),
+        help='Zip to write. Default: publish/awseipext_lambda.zip'
+    )
+    parser.add_argument(
+        '--config-dir',
+        help='Directory of config files to put at the root of the zip.'
+    )
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=[],
+        choices=RUNTIME_PROVIDED,
+        help='Ship a package the runtime provides anyway, such as to pin'
+             ' its version. May be repeated.'
+    )
+    parser.add_argument(
+        '--sources',
+        action='store_true',
+        help='Ship the source of each module along with its bytecode.'
+    )
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+        help='Number of cold imports of the built zip to measure; 0 to skip.'
+             ' Default: 5'
+    )
+    args = parser.parse_args()
+    result = build(
+        args.output,
+        config_dir=args.config_dir,
+        excludes=[
+            name for name in RUNTIME_PROVIDED if name not in args.include
+        ],
+        sources=args.sources
+    )
+    if args.runs > 0:
+        result['cold_import'] = measure_artifact(args.output, args.runs)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
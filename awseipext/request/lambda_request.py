@@ -3,7 +3,16 @@
     :copyright: (c) 2016 by Lyft Inc.
     :license: Apache, see LICENSE for more details.
 """
-from marshmallow import Schema, fields, post_load
+from marshmallow import Schema, fields, post_load, validate
+
+# The request classes live with the precompiled validator, which the lambda
+# function uses instead of these schemas. They're imported here so both
+# produce the same objects.
+from awseipext.request.validator import (
+    LambdaBatchRequest,
+    LambdaRequest,
+    MAX_BATCH_SIZE
+)
 
 
 class LambdaSchema(Schema):
@@ -18,20 +27,14 @@ class LambdaSchema(Schema):
         return LambdaRequest(**data)
 
 
-class LambdaRequest:
-    def __init__(self, action, resource, instance_id, username, token):
-        """
-        A LambdaRequest must have the following key value pairs to be valid.
-        :param action: The eip action to take.
-        :param resource: The eip resource to manage.
-        :param username: The KMS auth username.
-        :param kmsauth_token: The KMS auth token.
-        """
-        self.action = action
-        self.resource = resource
-        self.instance_id = instance_id
-        self.username = username
-        self.token = token
+class LambdaBatchSchema(Schema):
+    operations = fields.Nested(
+        LambdaSchema,
+        many=True,
+        required=True,
+        validate=validate.Length(min=1, max=MAX_BATCH_SIZE)
+    )
 
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+    @post_load
+    def make_lambda_batch_request(self, data):
+        return LambdaBatchRequest(**data)
@@ -0,0 +1,305 @@
+"""
+.. module: awseipext.request.validator
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+A precompiled validator for lambda requests. It accepts the same payloads as
+LambdaSchema, without marshmallow's reflective load, and checks the format
+of each field so malformed requests can be rejected before any KMS or EC2
+work.
+"""
+import hashlib
+import json
+import re
+
+try:
+    STRING_TYPES = (basestring,)
+except NameError:
+    STRING_TYPES = (str,)
+
+ACTIONS = ('associate', 'disassociate', 'move')
+FIELDS = ('action', 'resource', 'instance_id', 'username', 'token')
+# Maximum number of operations accepted in a single batch request.
+MAX_BATCH_SIZE = 100
+MAX_IDEMPOTENCY_KEY_LENGTH = 256
+RECONCILE = 'reconcile'
+# Maximum number of IPs in the mapping of a reconcile request.
+MAX_RECONCILE_SIZE = 1000
+MAX_CORRELATION_ID_LENGTH = 256
+
+IPV4_RE = re.compile(
+    r'^(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+    r'(\.(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])){3}\Z'
+)
+INSTANCE_ID_RE = re.compile(r'^i-[0-9a-f]{1,17}\Z')
+REGION_RE = re.compile(r'^[a-z]{2}(-gov)?-[a-z]+-[0-9]{1,2}\Z')
+
+
+class ValidationError(ValueError):
+    """An exception raised when a request payload is malformed."""
+    pass
+
+
+class LambdaRequest(object):
+    __slots__ = FIELDS
+
+    def __init__(self, action, resource, instance_id, username, token):
+        """
+        A LambdaRequest must have the following key value pairs to be valid.
+        LambdaRequests are immutable.
+        :param action: The eip action to take.
+        :param resource: The eip resource to manage.
+        :param instance_id: The instance to take the action on.
+        :param username: The KMS auth username.
+        :param token: The KMS auth token.
+        """
+        set_field = super(LambdaRequest, self).__setattr__
+        set_field('action', action)
+        set_field('resource', resource)
+        set_field('instance_id', instance_id)
+        set_field('username', username)
+        set_field('token', token)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('LambdaRequest is immutable.')
+
+    def __delattr__(self, name):
+        raise AttributeError('LambdaRequest is immutable.')
+
+    def _fields(self):
+        return tuple(getattr(self, field) for field in FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, LambdaRequest):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return 'LambdaRequest({0})'.format(', '.join(
+            '{0}={1!r}'.format(field, getattr(self, field))
+            for field in FIELDS if field != 'token'
+        ))
+
+
+class LambdaBatchRequest(object):
+    __slots__ = ('operations',)
+
+    def __init__(self, operations):
+        """
+        A batch of LambdaRequests, each with its own kmsauth token.
+        :param operations: A list of LambdaRequest objects.
+        """
+        self.operations = operations
+
+    def __eq__(self, other):
+        if not isinstance(other, LambdaBatchRequest):
+            return NotImplemented
+        return self.operations == other.operations
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def get_mapping_digest(mapping):
+    """
+    Digest of a desired IP to instance mapping, which a reconcile request's
+    token is minted for in place of a single resource, so the token only
+    authorizes that exact mapping.
+    """
+    payload = json.dumps(sorted(mapping.items()), separators=(',', ':'))
+    return 'sha256:{0}'.format(
+        hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    )
+
+
+class LambdaReconcileRequest(object):
+    __slots__ = ('mapping', 'username', 'token', 'dry_run', 'resource')
+
+    action = RECONCILE
+
+    def __init__(self, mapping, username, token, dry_run=False):
+        """
+        A desired IP to instance mapping to bring the account in line with.
+        :param mapping: A dict of public IP to instance id, or to None for
+            IPs that should be unassociated.
+        :param username: The KMS auth username.
+        :param token: The KMS auth token, minted for the reconcile action
+            on the mapping's digest.
+        :param dry_run: Only plan the changes, without applying them.
+        """
+        self.mapping = mapping
+        self.username = username
+        self.token = token
+        self.dry_run = dry_run
+        self.resource = get_mapping_digest(mapping)
+
+
+def load_request(data):
+    """
+    Load a LambdaRequest from a payload.
+
+    :raises ValidationError: If the payload isn't a dict of strings with
+        every field set.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Invalid input type.')
+    values = []
+    for field in FIELDS:
+        value = data.get(field)
+        if value is None:
+            raise ValidationError('{0} is required.'.format(field))
+        if not isinstance(value, STRING_TYPES):
+            raise ValidationError('{0} is not a valid string.'.format(field))
+        values.append(value)
+    return LambdaRequest(*values)
+
+
+def load_batch_request(data):
+    """
+    Load a LambdaBatchRequest from a payload.
+
+    :raises ValidationError: If the payload doesn't have between 1 and
+        MAX_BATCH_SIZE valid operations.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Invalid input type.')
+    operations = data.get('operations')
+    if not isinstance(operations, list):
+        raise ValidationError('operations must be a list.')
+    if not 1 <= len(operations) <= MAX_BATCH_SIZE:
+        raise ValidationError(
+            'operations must have between 1 and {0} items.'.format(
+                MAX_BATCH_SIZE
+            )
+        )
+    return LambdaBatchRequest([load_request(op) for op in operations])
+
+
+def load_reconcile_request(data):
+    """
+    Load a LambdaReconcileRequest from a payload.
+
+    :raises ValidationError: If the payload doesn't have a mapping of
+        between 1 and MAX_RECONCILE_SIZE IPs to instance ids (or null), a
+        username and a token.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Invalid input type.')
+    mapping = data.get('mapping')
+    if not isinstance(mapping, dict):
+        raise ValidationError('mapping must be an object.')
+    if not 1 <= len(mapping) <= MAX_RECONCILE_SIZE:
+        raise ValidationError(
+            'mapping must have between 1 and {0} items.'.format(
+                MAX_RECONCILE_SIZE
+            )
+        )
+    for instance_id in mapping.values():
+        if instance_id is not None and \
+                not isinstance(instance_id, STRING_TYPES):
+            raise ValidationError(
+                'mapping values must be instance ids or null.'
+            )
+    values = []
+    for field in ('username', 'token'):
+        value = data.get(field)
+        if value is None:
+            raise ValidationError('{0} is required.'.format(field))
+        if not isinstance(value, STRING_TYPES):
+            raise ValidationError('{0} is not a valid string.'.format(field))
+        values.append(value)
+    dry_run = data.get('dry_run', False)
+    if not isinstance(dry_run, bool):
+        raise ValidationError('dry_run must be a boolean.')
+    return LambdaReconcileRequest(mapping, values[0], values[1], dry_run)
+
+
+def _load_key(data, field, max_length):
+    key = data.get(field)
+    if key is None:
+        return None
+    if not isinstance(key, STRING_TYPES):
+        raise ValidationError('{0} is not a valid string.'.format(field))
+    if not 1 <= len(key) <= max_length:
+        raise ValidationError(
+            '{0} must have between 1 and {1} characters.'.format(
+                field,
+                max_length
+            )
+        )
+    return key
+
+
+def load_idempotency_key(data):
+    """
+    Load the optional idempotency key of a single or batch request payload.
+
+    :return: The key, or None if the payload doesn't have one.
+    :raises ValidationError: If the key isn't a non-empty string of at most
+        MAX_IDEMPOTENCY_KEY_LENGTH characters.
+    """
+    return _load_key(data, 'idempotency_key', MAX_IDEMPOTENCY_KEY_LENGTH)
+
+
+def load_correlation_id(data):
+    """
+    Load the optional correlation id of a single or batch request payload,
+    which its result is delivered to the result sink under.
+
+    :return: The id, or None if the payload doesn't have one.
+    :raises ValidationError: If the id isn't a non-empty string of at most
+        MAX_CORRELATION_ID_LENGTH characters.
+    """
+    return _load_key(data, 'correlation_id', MAX_CORRELATION_ID_LENGTH)
+
+
+def load_region(data):
+    """
+    Load the optional region of a single, batch or reconcile request
+    payload, which its IPs and instances are in.
+
+    :return: The region, or None if the payload doesn't have one.
+    :raises ValidationError: If the region isn't a valid AWS region name.
+    """
+    region = data.get('region')
+    if region is None:
+        return None
+    if not isinstance(region, STRING_TYPES) or not REGION_RE.match(region):
+        raise ValidationError('region is not a valid region.')
+    return region
+
+
+def get_request_error(request, actions=ACTIONS):
+    """
+    Check the format of a request's fields.
+
+    :param actions: The actions to accept.
+    :return: An error message, or None if the request is well formed.
+    """
+    if request.action not in actions:
+        return '{0} is not a valid action.'.format(request.action)
+    if not IPV4_RE.match(request.resource):
+        return '{0} is not a valid IP address.'.format(request.resource)
+    if not INSTANCE_ID_RE.match(request.instance_id):
+        return '{0} is not a valid instance id.'.format(request.instance_id)
+    return None
+
+
+def get_reconcile_error(request):
+    """
+    Check the format of a reconcile request's mapping.
+
+    :return: An error message, or None if the mapping is well formed.
+    """
+    for resource, instance_id in sorted(request.mapping.items()):
+        if not IPV4_RE.match(resource):
+            return '{0} is not a valid IP address.'.format(resource)
+        if instance_id is not None and not INSTANCE_ID_RE.match(instance_id):
+            return '{0} is not a valid instance id.'.format(instance_id)
+    return None
@@ -0,0 +1,407 @@
+"""
+.. module: awseipext.result_sink
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Sinks for the results of asynchronous (Event) invocations. Lambda discards
+what an Event invocation returns, so the handler puts the result of a
+request that has a correlation id into a sink, and the client collects it
+from there to resolve the future it handed out for the request.
+
+The lambda imports this module, so concurrent.futures is only imported by
+the client-side ResultCollector, where it's used.
+"""
+import Queue
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from awseipext import file_store
+
+logger = logging.getLogger(__name__)
+
+SINKS = ('none', 'memory', 'file', 'sqs')
+
+# Longest an SQS receive may wait for messages.
+SQS_MAX_WAIT = 20
+# Seconds a result nobody has polled for is kept, after which no client is
+# still waiting on it. It matches the client's default result_timeout.
+DEFAULT_MAX_AGE = 300
+
+
+class QueueResultSink(object):
+    def __init__(self, max_age=DEFAULT_MAX_AGE, clock=time.time):
+        """
+        A result sink local to this process, for a handler and a client
+        running in the same process, such as in tests or behind a local
+        awseipext.service.
+
+        :param max_age: Seconds to keep a result nobody has polled for.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.max_age = max_age
+        self.clock = clock
+        self.queue = Queue.Queue()
+        # Results polled for ids nobody was waiting on yet, to a (result,
+        # time put) tuple.
+        self.unclaimed = {}
+        self.lock = threading.Lock()
+
+    def put(self, correlation_id, result):
+        self.queue.put((correlation_id, result, self.clock()))
+
+    def _claim(self, correlation_ids):
+        with self.lock:
+            try:
+                while True:
+                    key, result, put = self.queue.get_nowait()
+                    self.unclaimed[key] = (result, put)
+            except Queue.Empty:
+                pass
+            found = [
+                (correlation_id, self.unclaimed.pop(correlation_id)[0])
+                for correlation_id in correlation_ids
+                if correlation_id in self.unclaimed
+            ]
+            cutoff = self.clock() - self.max_age
+            for key, (_, put) in list(self.unclaimed.items()):
+                if put < cutoff:
+                    del self.unclaimed[key]
+            return found
+
+    def poll(self, correlation_ids, timeout):
+        """
+        Take the results that have arrived for some correlation ids.
+
+        :param correlation_ids: The ids to look for.
+        :param timeout: Seconds to wait for a result if none has arrived.
+        :return: A list of (correlation_id, result) tuples.
+        """
+        deadline = time.time() + timeout
+        while True:
+            found = self._claim(correlation_ids)
+            remaining = deadline - time.time()
+            if found or remaining <= 0:
+                return found
+            try:
+                item = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                return []
+            # Put it back for _claim to sort out under the lock.
+            self.queue.put(item)
+
+
+class FileResultSink(object):
+    def __init__(
+            self,
+            directory,
+            poll_interval=0.05,
+            max_age=DEFAULT_MAX_AGE,
+            clock=time.time
+            ):
+        """
+        A result sink in a directory, one file per result, that can be
+        shared by processes on a host. Results nobody has polled for are
+        deleted by a put or poll once they're max_age old, in a sweep of
+        the directory made at most every max_age seconds.
+
+        :param directory: Directory to put results in.
+        :param poll_interval: Seconds between checks while polling.
+        :param max_age: Seconds to keep a result nobody has polled for.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+        self.clock = clock
+        self.swept_at = clock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, correlation_id):
+        # Correlation ids are chosen by callers, so they're hashed rather
+        # than used as file names.
+        name = hashlib.sha256(correlation_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}.json'.format(name))
+
+    def _expire(self):
+        now = self.clock()
+        if now - self.swept_at < self.max_age:
+            return
+        self.swept_at = now
+        cutoff = now - self.max_age
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stale = os.path.getmtime(path) < cutoff
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if stale:
+                file_store.remove(path)
+
+    def put(self, correlation_id, result):
+        file_store.replace(
+            self.directory,
+            self._path(correlation_id),
+            {'correlation_id': correlation_id, 'result': result}
+        )
+        self._expire()
+
+    def _take(self, correlation_id):
+        path = self._path(correlation_id)
+        entry = file_store.read(path)
+        # Another poller that read the result first may have taken it.
+        if entry is None or not file_store.remove(path):
+            return None
+        return entry['result']
+
+    def poll(self, correlation_ids, timeout):
+        """
+        Take the results that have arrived for some correlation ids, as
+        QueueResultSink.poll.
+        """
+        self._expire()
+        deadline = time.time() + timeout
+        while True:
+            found = []
+            for correlation_id in correlation_ids:
+                result = self._take(correlation_id)
+                if result is not None:
+                    found.append((correlation_id, result))
+            remaining = deadline - time.time()
+            if found or remaining <= 0:
+                return found
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class SQSResultSink(object):
+    def __init__(
+            self,
+            queue_url,
+            sqs_client=None,
+            region=None,
+            max_age=DEFAULT_MAX_AGE
+            ):
+        """
+        A result sink in an SQS queue. Each client should read from its own
+        queue: messages for ids a client isn't waiting on are left for the
+        queue's visibility timeout to hand back, until they're max_age old,
+        when they're deleted.
+
+        :param queue_url: URL of the queue.
+        :param sqs_client: A boto3 SQS client, or a stand-in for one.
+            Default: one created on first use.
+        :param region: Region of the queue, for the default client.
+        :param max_age: Seconds to keep a message nobody has polled for. It
+            should be at least the client's result_timeout.
+        """
+        self.queue_url = queue_url
+        self.region = region
+        self.max_age = max_age
+        self._sqs_client = sqs_client
+        self._sqs_client_lock = threading.Lock()
+
+    @property
+    def sqs_client(self):
+        if self._sqs_client is None:
+            with self._sqs_client_lock:
+                if self._sqs_client is None:
+                    import boto3
+
+                    session = boto3.session.Session()
+                    self._sqs_client = session.client(
+                        'sqs',
+                        region_name=self.region
+                    )
+        return self._sqs_client
+
+    def put(self, correlation_id, result):
+        self.sqs_client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({
+                'correlation_id': correlation_id,
+                'result': result
+            })
+        )
+
+    def poll(self, correlation_ids, timeout):
+        """
+        Take the results that have arrived for some correlation ids, as
+        QueueResultSink.poll.
+        """
+        correlation_ids = set(correlation_ids)
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=max(0, min(SQS_MAX_WAIT, int(timeout))),
+            AttributeNames=['SentTimestamp']
+        )
+        # Messages sent before this are for calls nobody is waiting on any
+        # more, so they'd otherwise come back forever.
+        cutoff = (time.time() - self.max_age) * 1000
+        found = []
+        entries = []
+        for message in response.get('Messages', []):
+            sent = message.get('Attributes', {}).get('SentTimestamp')
+            stale = sent is not None and int(sent) < cutoff
+            try:
+                body = json.loads(message['Body'])
+                correlation_id = body['correlation_id']
+                result = body['result']
+            except (ValueError, KeyError, TypeError):
+                logger.warning(
+                    'Ignoring malformed result message {0}.'.format(
+                        message.get('MessageId')
+                    )
+                )
+                correlation_id = None
+            if correlation_id in correlation_ids:
+                found.append((correlation_id, result))
+            elif not stale:
+                continue
+            entries.append({
+                'Id': str(len(entries)),
+                'ReceiptHandle': message['ReceiptHandle']
+            })
+        if entries:
+            self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=entries
+            )
+        return found
+
+
+# The sink shared by a handler and client in this process.
+local_sink = QueueResultSink()
+
+
+def create_result_sink(sink, directory=None, queue_url=None, region=None):
+    """
+    Create a result sink from its config.
+
+    :param sink: One of SINKS.
+    :param directory: Directory for the file sink.
+    :param queue_url: Queue URL for the sqs sink.
+    :param region: Region of the queue.
+    :return: A result sink, or None if sink is 'none'.
+    """
+    if sink == 'memory':
+        return local_sink
+    if sink == 'file':
+        if not directory:
+            raise ValueError('result_sink_directory not set.')
+        return FileResultSink(directory)
+    if sink == 'sqs':
+        if not queue_url:
+            raise ValueError('result_sink_queue_url not set.')
+        return SQSResultSink(queue_url, region=region)
+    if sink == 'none':
+        return None
+    raise ValueError('Invalid result sink: {0}'.format(sink))
+
+
+class ResultCollector(object):
+    def __init__(
+            self,
+            sink,
+            timeout=300,
+            poll_timeout=1,
+            transform=None,
+            clock=time.time
+            ):
+        """
+        Resolves the futures of asynchronous requests from a result sink,
+        with a single polling thread however many requests are in flight.
+        The thread runs only while a request is pending.
+
+        :param sink: The result sink to poll.
+        :param timeout: Seconds to wait for a result before failing its
+            future with a TimeoutError.
+        :param poll_timeout: Longest a single poll waits, in seconds.
+        :param transform: Function applied to each result before it's set
+            on its future. Optional.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.sink = sink
+        self.timeout = timeout
+        self.poll_timeout = poll_timeout
+        self.transform = transform
+        self.clock = clock
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, correlation_id):
+        """
+        Register a request whose result is on its way.
+
+        :return: A Future that resolves to the request's result.
+        """
+        from concurrent.futures import Future
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            self.pending[correlation_id] = (
+                future,
+                self.clock() + self.timeout
+            )
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return future
+
+    def discard(self, correlation_id):
+        """
+        Stop waiting for a request, such as one that couldn't be sent.
+        """
+        with self.lock:
+            self.pending.pop(correlation_id, None)
+
+    def _expire(self):
+        from concurrent.futures import TimeoutError
+
+        now = self.clock()
+        with self.lock:
+            expired = [
+                correlation_id
+                for correlation_id, (_, deadline) in self.pending.items()
+                if deadline <= now
+            ]
+            futures = [self.pending.pop(key)[0] for key in expired]
+        for future in futures:
+            future.set_exception(TimeoutError(
+                'No result arrived within {0} seconds.'.format(self.timeout)
+            ))
+
+    def _run(self):
+        while True:
+            self._expire()
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                correlation_ids = list(self.pending)
+            try:
+                found = self.sink.poll(correlation_ids, self.poll_timeout)
+            except Exception:
+                logger.exception('Failed to poll for results.')
+                time.sleep(self.poll_timeout)
+                continue
+            for correlation_id, result in found:
+                with self.lock:
+                    entry = self.pending.pop(correlation_id, None)
+                if entry is None:
+                    continue
+                if self.transform is not None:
+                    result = self.transform(result)
+                entry[0].set_result(result)
@@ -0,0 +1,342 @@
+"""
+.. module: awseipext.result_store
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Stores for the results of idempotent requests. The first execution of a key
+claims it, duplicates that arrive while it's running can wait for it, and
+duplicates that arrive afterwards get the recorded result.
+"""
+import copy
+import json
+import os
+import threading
+import time
+
+import botocore.exceptions
+
+from awseipext import file_store
+from awseipext.ttl_cache import TTLCache
+
+# States returned by begin and wait.
+NEW = 'new'
+PENDING = 'pending'
+DONE = 'done'
+
+STORES = ('memory', 'file', 'dynamodb', 'none')
+
+
+class MemoryResultStore(object):
+    def __init__(self, ttl=300, lease=60, capacity=4096, clock=time.time):
+        """
+        A result store local to this process.
+
+        :param ttl: Seconds to keep a finished result.
+        :param lease: Default seconds a claim lasts before another caller
+            may take it over.
+        :param capacity: Maximum number of keys to keep.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.ttl = ttl
+        self.lease = lease
+        self.entries = TTLCache(capacity, ttl, clock)
+        self.condition = threading.Condition()
+
+    def begin(self, key, lease=None):
+        """
+        Claim a key, unless it's already claimed or finished.
+
+        :param lease: Seconds the claim lasts. Default: the store's lease.
+        :return: A (state, result) tuple. NEW means the caller now owns the
+            key and must finish or abandon it; PENDING means another caller
+            owns it; DONE comes with the recorded result.
+        """
+        with self.condition:
+            found, entry = self.entries.lookup(key)
+            if found:
+                state, result = entry
+                return state, copy.deepcopy(result)
+            if lease is None:
+                lease = self.lease
+            self.entries.set(key, (PENDING, None), lease)
+            return NEW, None
+
+    def finish(self, key, result):
+        """
+        Record the result of a claimed key.
+        """
+        with self.condition:
+            self.entries.set(key, (DONE, copy.deepcopy(result)))
+            self.condition.notify_all()
+
+    def abandon(self, key):
+        """
+        Release a claimed key without a result, so it can be claimed again.
+        """
+        with self.condition:
+            self.entries.invalidate(key)
+            self.condition.notify_all()
+
+    def wait(self, key, timeout, lease=None):
+        """
+        Wait for another caller's claim on a key to finish. If it's
+        abandoned or expires, the key is claimed for this caller instead.
+
+        :param timeout: Seconds to wait.
+        :return: A (state, result) tuple, as begin. PENDING means the
+            timeout passed.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                state, result = self.begin(key, lease)
+                remaining = deadline - time.time()
+                if state != PENDING or remaining <= 0:
+                    return state, result
+                self.condition.wait(remaining)
+
+
+class FileResultStore(object):
+    def __init__(self, directory, ttl=300, lease=60, poll_interval=0.05):
+        """
+        A result store in a directory, one file per key, that can be shared
+        by processes on a host. Keys are claimed by linking a complete file
+        into place, the way DynamoDBResultStore claims them with a
+        conditional write. Expired entries are taken over, and claims
+        finished or abandoned, under a lock on the directory, so two callers
+        can't both end up owning a key.
+
+        :param directory: Directory to keep results in.
+        :param ttl: Seconds to keep a finished result.
+        :param lease: Default seconds a claim lasts before another caller
+            may take it over.
+        :param poll_interval: Seconds between checks while waiting.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{0}.json'.format(key))
+
+    def begin(self, key, lease=None):
+        """
+        Claim a key, unless it's already claimed or finished.
+
+        :param lease: Seconds the claim lasts. Default: the store's lease.
+        :return: A (state, result) tuple, as MemoryResultStore.begin.
+        """
+        if lease is None:
+            lease = self.lease
+        path = self._path(key)
+        claim = {'state': PENDING, 'expires': time.time() + lease}
+        if file_store.create(self.directory, path, claim):
+            return NEW, None
+        with file_store.locked(self.directory):
+            # An entry that can't be read is treated as an expired claim
+            # once it's been around for as long as a claim lasts.
+            entry = file_store.read(path, self.lease)
+            if entry is not None and entry['expires'] > time.time():
+                return entry.get('state', PENDING), entry.get('result')
+            claim['expires'] = time.time() + lease
+            file_store.replace(self.directory, path, claim)
+        return NEW, None
+
+    def finish(self, key, result):
+        """
+        Record the result of a claimed key.
+        """
+        entry = {
+            'state': DONE,
+            'expires': time.time() + self.ttl,
+            'result': result
+        }
+        with file_store.locked(self.directory):
+            file_store.replace(self.directory, self._path(key), entry)
+
+    def abandon(self, key):
+        """
+        Release a claimed key without a result, so it can be claimed again.
+        """
+        with file_store.locked(self.directory):
+            file_store.remove(self._path(key))
+
+    def wait(self, key, timeout, lease=None):
+        """
+        Wait for another caller's claim on a key to finish, as
+        MemoryResultStore.wait.
+        """
+        deadline = time.time() + timeout
+        while True:
+            state, result = self.begin(key, lease)
+            remaining = deadline - time.time()
+            if state != PENDING or remaining <= 0:
+                return state, result
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class DynamoDBResultStore(object):
+    def __init__(
+            self,
+            table_name,
+            ttl=300,
+            lease=60,
+            dynamodb_client=None,
+            region=None,
+            poll_interval=0.05
+            ):
+        """
+        A result store in a DynamoDB table, shared by every container of the
+        function. Keys are claimed with a conditional write that only
+        succeeds if the key has no entry, or its entry has expired.
+
+        The table's partition key is a string named key. Its expires
+        attribute can be used as the table's TTL attribute, to clear out
+        expired entries.
+
+        :param table_name: Name of the table.
+        :param ttl: Seconds to keep a finished result.
+        :param lease: Default seconds a claim lasts before another caller
+            may take it over.
+        :param dynamodb_client: A boto3 DynamoDB client, or a stand-in for
+            one. Default: one created on first use.
+        :param region: Region of the table, for the default client.
+        :param poll_interval: Seconds between checks while waiting.
+        """
+        self.table_name = table_name
+        self.ttl = ttl
+        self.lease = lease
+        self.region = region
+        self.poll_interval = poll_interval
+        self._dynamodb_client = dynamodb_client
+        self._dynamodb_client_lock = threading.Lock()
+
+    @property
+    def dynamodb_client(self):
+        if self._dynamodb_client is None:
+            with self._dynamodb_client_lock:
+                if self._dynamodb_client is None:
+                    import boto3
+
+                    session = boto3.session.Session()
+                    self._dynamodb_client = session.client(
+                        'dynamodb',
+                        region_name=self.region
+                    )
+        return self._dynamodb_client
+
+    def _claim(self, key, lease):
+        now = time.time()
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'key': {'S': key},
+                    'state': {'S': PENDING},
+                    'expires': {'N': repr(now + lease)}
+                },
+                ConditionExpression=(
+                    'attribute_not_exists(#key) OR #expires < :now'
+                ),
+                ExpressionAttributeNames={
+                    '#key': 'key',
+                    '#expires': 'expires'
+                },
+                ExpressionAttributeValues={':now': {'N': repr(now)}}
+            )
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def begin(self, key, lease=None):
+        """
+        Claim a key, unless it's already claimed or finished.
+
+        :param lease: Seconds the claim lasts. Default: the store's lease.
+        :return: A (state, result) tuple, as MemoryResultStore.begin.
+        """
+        if lease is None:
+            lease = self.lease
+        while True:
+            if self._claim(key, lease):
+                return NEW, None
+            item = self.dynamodb_client.get_item(
+                TableName=self.table_name,
+                Key={'key': {'S': key}},
+                ConsistentRead=True
+            ).get('Item')
+            if item is None or float(item['expires']['N']) < time.time():
+                # Released or expired since the claim was refused.
+                continue
+            result = None
+            if 'result' in item:
+                result = json.loads(item['result']['S'])
+            return item['state']['S'], result
+
+    def finish(self, key, result):
+        """
+        Record the result of a claimed key.
+        """
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'key': {'S': key},
+                'state': {'S': DONE},
+                'expires': {'N': repr(time.time() + self.ttl)},
+                'result': {'S': json.dumps(result)}
+            }
+        )
+
+    def abandon(self, key):
+        """
+        Release a claimed key without a result, so it can be claimed again.
+        """
+        self.dynamodb_client.delete_item(
+            TableName=self.table_name,
+            Key={'key': {'S': key}}
+        )
+
+    def wait(self, key, timeout, lease=None):
+        """
+        Wait for another caller's claim on a key to finish, as
+        MemoryResultStore.wait.
+        """
+        deadline = time.time() + timeout
+        while True:
+            state, result = self.begin(key, lease)
+            remaining = deadline - time.time()
+            if state != PENDING or remaining <= 0:
+                return state, result
+            time.sleep(min(self.poll_interval, remaining))
+
+
+def create_result_store(store, ttl, directory=None, table=None, region=None):
+    """
+    Create a result store from its config.
+
+    :param store: One of STORES.
+    :param ttl: Seconds to keep a finished result.
+    :param directory: Directory for the file store.
+    :param table: Table name for the dynamodb store.
+    :param region: Region of the table.
+    :return: A result store, or None if store is 'none'.
+    """
+    if store == 'memory':
+        return MemoryResultStore(ttl=ttl)
+    if store == 'file':
+        if not directory:
+            raise ValueError('idempotency_directory not set.')
+        return FileResultStore(directory, ttl=ttl)
+    if store == 'dynamodb':
+        if not table:
+            raise ValueError('idempotency_table not set.')
+        return DynamoDBResultStore(table, ttl=ttl, region=region)
+    if store == 'none':
+        return None
+    raise ValueError('Invalid idempotency store: {0}'.format(store))
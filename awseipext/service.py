@@ -0,0 +1,764 @@
+"""
+.. module: awseipext.service
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Serves lambda_handler from a long-lived process, over HTTP or a unix
+socket, so its caches and clients stay warm between requests. Requests and
+responses follow the Lambda Invoke API, so a boto3 lambda client pointed at
+the service with endpoint_url (or a UnixSocketLambdaClient) can call it the
+same way it would call the deployed function.
+"""
+import argparse
+import BaseHTTPServer
+import errno
+import httplib
+import json
+import logging
+import os
+import select
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Seconds an invocation may run for, as the function's timeout would be set
+# in Lambda. Handlers use it to bound their retries.
+DEFAULT_TIMEOUT = 30
+DEFAULT_WORKERS = 10
+DEFAULT_EVENT_WORKERS = 10
+# Seconds an idle keep-alive connection is kept open.
+IDLE_TIMEOUT = 60
+INVOCATION_TYPES = ('RequestResponse', 'Event', 'DryRun')
+
+
+class InvocationContext(object):
+    def __init__(self, function_name, timeout):
+        """
+        The equivalent of Lambda's context object for a single invocation.
+
+        :param function_name: Name the service is invoked as.
+        :param timeout: Seconds the invocation may run for.
+        """
+        self.aws_request_id = str(uuid.uuid4())
+        self.function_name = function_name
+        self.invoked_function_arn = function_name
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+def invoke(event, context, config_file=None):
+    """
+    Run lambda_handler on an event, the way Lambda would.
+
+    :param config_file: Config file for lambda_handler. Default: its own
+        default.
+    :return: A (payload, function_error) tuple. If the handler raised,
+        payload is an error document and function_error is 'Unhandled'.
+    """
+    from awseipext.aws_lambda import lambda_function
+
+    kwargs = {}
+    if config_file is not None:
+        kwargs['config_file'] = config_file
+    try:
+        return lambda_function.lambda_handler(event, context, **kwargs), None
+    except Exception as e:
+        logger.exception('Invocation {0} failed.'.format(
+            context.aws_request_id
+        ))
+        return {
+            'errorMessage': str(e),
+            'errorType': type(e).__name__
+        }, 'Unhandled'
+
+
+class SocketReader(object):
+    def __init__(self, sock, bufsize=8192):
+        """
+        A buffered reader of a socket, like the file object makefile()
+        returns, that says how much it has read ahead of its caller.
+
+        :param sock: The socket to read from.
+        :param bufsize: Bytes to receive at a time.
+        """
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buffer = b''
+
+    def buffered(self):
+        """
+        The number of bytes received but not yet read.
+        """
+        return len(self.buffer)
+
+    def _recv(self, size):
+        while True:
+            try:
+                return self.sock.recv(size)
+            except socket.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buffer and (
+                size < 0 or len(self.buffer) < size):
+            data = self._recv(self.bufsize)
+            if not data:
+                break
+            self.buffer += data
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        received = len(self.buffer)
+        while size < 0 or received < size:
+            data = self._recv(
+                self.bufsize if size < 0 else max(self.bufsize, size - received)
+            )
+            if not data:
+                break
+            chunks.append(data)
+            received += len(data)
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class PooledHandlerMixIn:
+    """
+    Handle the request that's arrived on a connection, and leave a
+    keep-alive connection open for a PooledMixIn server to watch for the
+    next one, rather than holding a worker while waiting for it. It's a
+    classic class, as the request handlers it's mixed into are.
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # The server watches the socket for the next request, so requests
+        # read ahead into rfile's buffer need to be seen here.
+        self.rfile.close()
+        self.rfile = SocketReader(self.connection)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        # Requests the client has already sent are handled now, rather than
+        # handing the connection back to the server to wait for them.
+        while not self.close_connection and self.rfile.buffered():
+            self.handle_one_request()
+
+
+class InvocationHandler(
+        PooledHandlerMixIn,
+        BaseHTTPServer.BaseHTTPRequestHandler
+        ):
+    # Keep connections alive, as boto3 does with its connection pool.
+    protocol_version = 'HTTP/1.1'
+    # Seconds to wait for the rest of a request that's started to arrive.
+    timeout = IDLE_TIMEOUT
+
+    def _respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, error_type, message):
+        self._respond(
+            status,
+            json.dumps({'Type': 'User', 'message': message}),
+            {'X-Amzn-ErrorType': error_type}
+        )
+
+    def do_GET(self):
+        if self.path == '/ping':
+            self._respond(200, json.dumps({'result': True}))
+        else:
+            self._error(404, 'ResourceNotFoundException', 'Not found.')
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path != '/' and not path.endswith('/invocations'):
+            self._error(404, 'ResourceNotFoundException', 'Not found.')
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        try:
+            event = json.loads(body or '{}')
+        except ValueError:
+            self._error(
+                400,
+                'InvalidRequestContentException',
+                'Could not parse request body into json.'
+            )
+            return
+        invocation_type = self.headers.getheader(
+            'X-Amz-Invocation-Type'
+        ) or 'RequestResponse'
+        if invocation_type not in INVOCATION_TYPES:
+            self._error(
+                400,
+                'InvalidParameterValueException',
+                'Invalid invocation type: {0}'.format(invocation_type)
+            )
+            return
+        if invocation_type == 'DryRun':
+            self._respond(204)
+            return
+        context = InvocationContext(
+            self.server.function_name,
+            self.server.invocation_timeout
+        )
+        if invocation_type == 'Event':
+            self.server.submit(
+                invoke,
+                event,
+                context,
+                self.server.config_file
+            )
+            self._respond(202)
+            return
+        payload, function_error = invoke(
+            event,
+            context,
+            self.server.config_file
+        )
+        headers = {
+            'X-Amz-Executed-Version': '$LATEST',
+            'X-Amzn-RequestId': context.aws_request_id
+        }
+        if function_error is not None:
+            headers['X-Amz-Function-Error'] = function_error
+        self._respond(200, json.dumps(payload), headers)
+
+    def log_message(self, format, *args):
+        # The default writes to stderr, and looks up the client's address,
+        # which unix socket connections don't have.
+        logger.debug(format % args)
+
+
+class PooledMixIn(object):
+    """
+    Handle requests on a bounded pool of worker threads, rather than a
+    thread per connection. A keep-alive connection only holds a worker while
+    one of its requests is handled; in between, a single thread watches it,
+    hands it back to the pool when its next request arrives, and closes it
+    once it's been idle for idle_timeout seconds. The handler must be a
+    PooledHandlerMixIn.
+    """
+    idle_timeout = IDLE_TIMEOUT
+
+    def init_pool(self, workers):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Connections whose requests are being handled.
+        self.connections = set()
+        # Idle keep-alive connections, to a (client address, idle since)
+        # tuple.
+        self.idle = {}
+        self.connections_lock = threading.Lock()
+        self.closing = False
+        # Written to, to wake the watcher when a connection goes idle.
+        self.wake_fds = os.pipe()
+        self.watcher = threading.Thread(target=self._watch)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        keep_alive = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        with self.connections_lock:
+            self.connections.discard(request)
+            keep_alive = keep_alive and not self.closing
+            if keep_alive:
+                self.idle[request] = (client_address, time.time())
+        if keep_alive:
+            self._wake()
+        else:
+            self.shutdown_request(request)
+
+    def _wake(self):
+        os.write(self.wake_fds[1], b'.')
+
+    def _watch(self):
+        while True:
+            with self.connections_lock:
+                if self.closing:
+                    return
+                idle = dict(self.idle)
+            timeout = self.idle_timeout
+            if idle:
+                oldest = min(since for _, since in idle.values())
+                timeout = max(0, oldest + self.idle_timeout - time.time())
+            try:
+                readable = select.select(
+                    [self.wake_fds[0]] + list(idle),
+                    [],
+                    [],
+                    timeout
+                )[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wake_fds[0] in readable:
+                os.read(self.wake_fds[0], 4096)
+            ready = []
+            expired = []
+            with self.connections_lock:
+                for connection in readable:
+                    if connection in self.idle:
+                        client_address, _ = self.idle.pop(connection)
+                        ready.append((connection, client_address))
+                now = time.time()
+                for connection, (_, since) in list(self.idle.items()):
+                    if since + self.idle_timeout <= now:
+                        del self.idle[connection]
+                        expired.append(connection)
+            for connection, client_address in ready:
+                self.executor.submit(
+                    self._process_request,
+                    connection,
+                    client_address
+                )
+            for connection in expired:
+                self.shutdown_request(connection)
+
+    def handle_error(self, request, client_address):
+        logger.exception('Error handling a connection.')
+
+    def server_close(self):
+        super(PooledMixIn, self).server_close()
+        with self.connections_lock:
+            self.closing = True
+            # Wake up workers waiting on the rest of a request, so they
+            # don't hold up the shutdown.
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+        self._wake()
+        self.watcher.join()
+        self.executor.shutdown(wait=True)
+        with self.connections_lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for connection in idle:
+            self.shutdown_request(connection)
+        for fd in self.wake_fds:
+            os.close(fd)
+
+
+class _ServiceMixIn(PooledMixIn):
+    def init_service(
+            self,
+            config_file,
+            workers,
+            event_workers,
+            timeout,
+            function_name
+            ):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.config_file = config_file
+        self.invocation_timeout = timeout
+        self.function_name = function_name
+        self.init_pool(workers)
+        # Event invocations run on their own pool, so a burst of them can't
+        # hold up RequestResponse invocations.
+        self.event_executor = ThreadPoolExecutor(max_workers=event_workers)
+
+    def submit(self, function, *args):
+        return self.event_executor.submit(function, *args)
+
+    def server_close(self):
+        super(_ServiceMixIn, self).server_close()
+        self.event_executor.shutdown(wait=True)
+
+
+class HTTPService(_ServiceMixIn, BaseHTTPServer.HTTPServer, object):
+    def __init__(
+            self,
+            address,
+            config_file=None,
+            workers=DEFAULT_WORKERS,
+            timeout=DEFAULT_TIMEOUT,
+            function_name='awseipext',
+            event_workers=DEFAULT_EVENT_WORKERS
+            ):
+        """
+        Serve lambda_handler over HTTP.
+
+        :param address: A (host, port) tuple to listen on.
+        :param config_file: Config file for lambda_handler.
+        :param workers: Number of requests to handle at once.
+        :param timeout: Seconds each invocation may run for.
+        :param function_name: Name the service is invoked as.
+        :param event_workers: Number of Event invocations to run at once.
+        """
+        self.init_service(
+            config_file,
+            workers,
+            event_workers,
+            timeout,
+            function_name
+        )
+        BaseHTTPServer.HTTPServer.__init__(self, address, InvocationHandler)
+
+
+class UnixHTTPService(_ServiceMixIn, SocketServer.UnixStreamServer, object):
+    def __init__(
+            self,
+            path,
+            config_file=None,
+            workers=DEFAULT_WORKERS,
+            timeout=DEFAULT_TIMEOUT,
+            function_name='awseipext',
+            event_workers=DEFAULT_EVENT_WORKERS
+            ):
+        """
+        Serve lambda_handler over HTTP on a unix socket. A stale socket
+        file at path is replaced.
+
+        :param path: Path of the socket.
+        """
+        self.init_service(
+            config_file,
+            workers,
+            event_workers,
+            timeout,
+            function_name
+        )
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, InvocationHandler)
+
+    def server_close(self):
+        super(UnixHTTPService, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        """
+        An HTTP connection over a unix socket, for clients of a service
+        listening on one.
+
+        :param path: Path of the socket.
+        :param timeout: Socket timeout, in seconds. Default: none.
+        """
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class UnixSocketLambdaClient(object):
+    def __init__(self, path, timeout=None):
+        """
+        A stand-in for a boto3 lambda client that invokes a service
+        listening on a unix socket. Each thread gets its own connection.
+
+        :param path: Path of the service's socket.
+        :param timeout: Socket timeout, in seconds.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _request(self, function_name, body, headers):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = UnixHTTPConnection(self.path, self.timeout)
+            self.local.connection = connection
+        try:
+            connection.request(
+                'POST',
+                '/2015-03-31/functions/{0}/invocations'.format(function_name),
+                body,
+                headers
+            )
+            return connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The service may have closed an idle connection; retry once on
+            # a new one.
+            connection.close()
+            connection.request(
+                'POST',
+                '/2015-03-31/functions/{0}/invocations'.format(function_name),
+                body,
+                headers
+            )
+            return connection.getresponse()
+
+    def invoke(
+            self,
+            FunctionName,
+            Payload='',
+            InvocationType='RequestResponse',
+            LogType='None',
+            **kwargs
+            ):
+        response = self._request(
+            FunctionName,
+            Payload,
+            {
+                'X-Amz-Invocation-Type': InvocationType,
+                'X-Amz-Log-Type': LogType
+            }
+        )
+        body = response.read()
+        if response.status >= 400:
+            raise RuntimeError('Invoke failed ({0}): {1}'.format(
+                response.status,
+                body
+            ))
+        result = {
+            'StatusCode': response.status,
+            'Payload': _Payload(body)
+        }
+        function_error = response.getheader('X-Amz-Function-Error')
+        if function_error:
+            result['FunctionError'] = function_error
+        return result
+
+
+class _Payload(object):
+    """A readable payload, as botocore's StreamingBody is."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        body, self.body = self.body, ''
+        return body
+
+
+class LocalLambdaClient(object):
+    def __init__(
+            self,
+            config_file=None,
+            timeout=DEFAULT_TIMEOUT,
+            latency=0,
+            function_name='awseipext'
+            ):
+        """
+        A stand-in for a boto3 lambda client that runs lambda_handler in
+        this process, with no service in between. Every invocation shares
+        this process's caches, as if they all landed on one warm container.
+
+        :param config_file: Config file for lambda_handler.
+        :param timeout: Seconds each invocation may run for.
+        :param latency: Seconds of invocation overhead to add to each
+            call, split between the request and the response.
+        :param function_name: Name the function is invoked as.
+        """
+        self.config_file = config_file
+        self.timeout = timeout
+        self.latency = latency
+        self.function_name = function_name
+
+    def _invoke(self, payload):
+        context = InvocationContext(self.function_name, self.timeout)
+        # Events go through JSON both ways, as they would over the wire.
+        return invoke(json.loads(payload or '{}'), context, self.config_file)
+
+    def invoke(
+            self,
+            FunctionName,
+            Payload='',
+            InvocationType='RequestResponse',
+            LogType='None',
+            **kwargs
+            ):
+        if self.latency:
+            time.sleep(self.latency / 2.0)
+        if InvocationType == 'DryRun':
+            return {'StatusCode': 204, 'Payload': _Payload('')}
+        if InvocationType == 'Event':
+            thread = threading.Thread(target=self._invoke, args=(Payload,))
+            thread.daemon = True
+            thread.start()
+            return {'StatusCode': 202, 'Payload': _Payload('')}
+        payload, function_error = self._invoke(Payload)
+        if self.latency:
+            time.sleep(self.latency / 2.0)
+        result = {
+            'StatusCode': 200,
+            'Payload': _Payload(json.dumps(payload))
+        }
+        if function_error is not None:
+            result['FunctionError'] = function_error
+        return result
+
+
+def warm(config_file=None):
+    """
+    Load the lambda function and its config before the first request, so
+    config errors are reported at startup.
+    """
+    from awseipext.aws_lambda import lambda_function
+
+    if config_file is None:
+        config_file = os.path.join(
+            os.path.dirname(lambda_function.__file__),
+            'lambda_deploy.cfg'
+        )
+    lambda_function.get_runtime(config_file, os.environ['AWS_REGION'])
+
+
+def _serve(args, config_file):
+    warm(config_file)
+    kwargs = {
+        'config_file': config_file,
+        'workers': args.workers,
+        'event_workers': args.event_workers,
+        'timeout': args.timeout
+    }
+    if args.socket:
+        server = UnixHTTPService(args.socket, **kwargs)
+        logger.info('Listening on {0}.'.format(args.socket))
+    else:
+        server = HTTPService((args.host, args.port), **kwargs)
+        logger.info('Listening on {0}:{1}.'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the awseipext lambda from a long-lived process.'
+    )
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument(
+        '--port',
+        type=int,
+        help='Port to listen on. Default: 8080',
+        default=8080
+    )
+    listen.add_argument(
+        '--socket',
+        help='Path of a unix socket to listen on, instead of a port.'
+    )
+    parser.add_argument(
+        '--host',
+        help='Address to listen on. Default: 127.0.0.1',
+        default='127.0.0.1'
+    )
+    parser.add_argument(
+        '--config',
+        help='Lambda config file. Default: the lambda function\'s own.'
+    )
+    parser.add_argument(
+        '--region',
+        help='AWS region. Default: $AWS_REGION.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of requests to handle at once. Default: 10',
+        default=DEFAULT_WORKERS
+    )
+    parser.add_argument(
+        '--event-workers',
+        type=int,
+        help='Number of Event invocations to run at once. Default: 10',
+        default=DEFAULT_EVENT_WORKERS
+    )
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        help='Seconds each invocation may run for. Default: 30',
+        default=DEFAULT_TIMEOUT
+    )
+    parser.add_argument(
+        '--stand-in',
+        action='store_true',
+        help='Run against in-process EC2 and KMS stand-ins, for local load'
+             ' testing.'
+    )
+    parser.add_argument(
+        '--log-level',
+        help='Logging verbosity.',
+        default='info'
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.event_workers < 1:
+        parser.error('--event-workers must be at least 1')
+
+    numeric_loglevel = getattr(logging, args.log_level.upper(), None)
+    if not isinstance(numeric_loglevel, int):
+        raise ValueError('Invalid log level: {0}'.format(args.log_level))
+    logging.basicConfig(
+        level=numeric_loglevel,
+        format='%(asctime)s %(name)s: %(levelname)s %(message)s',
+        stream=sys.stderr
+    )
+    if args.region:
+        os.environ['AWS_REGION'] = args.region
+    elif 'AWS_REGION' not in os.environ:
+        parser.error('--region is required without $AWS_REGION')
+
+    if args.stand_in:
+        from awseipext.testing import benchmark
+
+        with benchmark.Backends() as backends:
+            backends.ec2.reset(
+                [
+                    benchmark.free_address(),
+                    benchmark.free_address(
+                        benchmark.OTHER_PUBLIC_IP,
+                        'eipalloc-00000002'
+                    )
+                ],
+                benchmark.INSTANCES
+            )
+            _serve(args, backends.config_file)
+    else:
+        _serve(args, args.config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+"""
+.. module: awseipext.testing.benchmark
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Offline benchmark of lambda_handler, run against in-process EC2 and KMS
+stand-ins with simulated latencies.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from awseipext import metrics
+from awseipext.request.validator import RECONCILE, get_mapping_digest
+from awseipext.testing.fakes import FakeEC2Client, FakeKMSClient
+
+REGION = 'us-east-1'
+KMSAUTH_KEY = 'alias/awseipext'
+KMSAUTH_KEY_ARN = (
+    'arn:aws:kms:us-east-1:123456789012:key/'
+    '00000000-0000-0000-0000-000000000000'
+)
+TO_CONTEXT = 'awseipext'
+ROLE = 'myservice'
+OTHER_ROLE = 'otherservice'
+PUBLIC_IP = '198.51.100.1'
+OTHER_PUBLIC_IP = '198.51.100.2'
+INSTANCE_ID = 'i-00000001'
+OTHER_INSTANCE_ID = 'i-00000002'
+# An instance in the same role as INSTANCE_ID, for moves between the two.
+SPARE_INSTANCE_ID = 'i-00000003'
+INSTANCES = {
+    INSTANCE_ID: 'arn:aws:iam::123456789012:instance-profile/' + ROLE,
+    OTHER_INSTANCE_ID: 'arn:aws:iam::123456789012:instance-profile/' +
+    OTHER_ROLE,
+    SPARE_INSTANCE_ID: 'arn:aws:iam::123456789012:instance-profile/' + ROLE
+}
+CONFIG = '''[lambda_config]
+kmsauth_key = {0}
+kmsauth_to_context = {1}
+logging_level_option = CRITICAL
+'''.format(KMSAUTH_KEY, TO_CONTEXT)
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    'benchmarks',
+    'lambda_handler.json'
+)
+MODES = ('cold', 'warm')
+
+
+def free_address(public_ip=PUBLIC_IP, allocation_id='eipalloc-00000001'):
+    return {
+        'PublicIp': public_ip,
+        'AllocationId': allocation_id,
+        'Domain': 'vpc'
+    }
+
+
+def associated_address(
+        instance_id=INSTANCE_ID,
+        public_ip=PUBLIC_IP,
+        allocation_id='eipalloc-00000001'
+        ):
+    address = free_address(public_ip, allocation_id)
+    address.update({
+        'AssociationId': 'eipassoc-00000000',
+        'InstanceId': instance_id
+    })
+    return address
+
+
+# Each path is the address state it starts from, the request to make, and
+# the resource the request's token is minted for. Batch and reconcile
+# requests have None, and get the tokens they'd be sent with.
+PATHS = [
+    ('already_associated', [associated_address()], {
+        'action': 'associate',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, PUBLIC_IP),
+    ('associate', [free_address()], {
+        'action': 'associate',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, PUBLIC_IP),
+    ('disassociate', [associated_address()], {
+        'action': 'disassociate',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, PUBLIC_IP),
+    ('not_associated', [free_address()], {
+        'action': 'disassociate',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, PUBLIC_IP),
+    ('auth_failure', [free_address()], {
+        'action': 'associate',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, OTHER_PUBLIC_IP),
+    ('role_mismatch', [free_address()], {
+        'action': 'associate',
+        'resource': PUBLIC_IP,
+        'instance_id': OTHER_INSTANCE_ID
+    }, PUBLIC_IP),
+    ('move', [associated_address(SPARE_INSTANCE_ID)], {
+        'action': 'move',
+        'resource': PUBLIC_IP,
+        'instance_id': INSTANCE_ID
+    }, PUBLIC_IP),
+    ('batch', [
+        free_address(),
+        associated_address(
+            INSTANCE_ID,
+            OTHER_PUBLIC_IP,
+            'eipalloc-00000002'
+        )
+    ], {
+        'operations': [
+            {
+                'action': 'associate',
+                'resource': PUBLIC_IP,
+                'instance_id': INSTANCE_ID
+            },
+            {
+                'action': 'disassociate',
+                'resource': OTHER_PUBLIC_IP,
+                'instance_id': INSTANCE_ID
+            }
+        ]
+    }, None),
+    ('reconcile', [
+        free_address(),
+        associated_address(
+            INSTANCE_ID,
+            OTHER_PUBLIC_IP,
+            'eipalloc-00000002'
+        )
+    ], {
+        'action': RECONCILE,
+        'mapping': {PUBLIC_IP: INSTANCE_ID, OTHER_PUBLIC_IP: None}
+    }, None)
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(latencies):
+    """
+    Summarize a list of latencies, in seconds, as milliseconds.
+    """
+    return {
+        'min': min(latencies) * 1000,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p90': percentile(latencies, 0.9) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': max(latencies) * 1000,
+        'mean': sum(latencies) / len(latencies) * 1000
+    }
+
+
+class Backends(object):
+    def __init__(self, ec2_latency=0, kms_latency=0):
+        """
+        Fake EC2 and KMS backends, injected into the lambda function's
+        client caches for as long as the object is used as a context
+        manager.
+        """
+        self.ec2 = FakeEC2Client(instances=INSTANCES, latency=ec2_latency)
+        self.kms = FakeKMSClient(
+            keys={KMSAUTH_KEY: KMSAUTH_KEY_ARN},
+            latency=kms_latency
+        )
+        self.metrics = metrics.MemorySink()
+        self._saved = None
+        self._saved_sink = None
+        self._tmpdir = None
+        self.config_file = None
+
+    def __enter__(self):
+        from awseipext.aws_lambda import lambda_function
+
+        self._saved = (
+            lambda_function.ec2_clients.get(None),
+            lambda_function.kms_clients.get(REGION),
+            os.environ.get('AWS_REGION')
+        )
+        lambda_function.ec2_clients[None] = self.ec2
+        lambda_function.kms_clients[REGION] = self.kms
+        os.environ['AWS_REGION'] = REGION
+        # Keep the handler's metrics records off stdout.
+        self._saved_sink = metrics.set_sink(self.metrics)
+        self._tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self._tmpdir, 'lambda_deploy.cfg')
+        with open(self.config_file, 'w') as f:
+            f.write(CONFIG)
+        return self
+
+    def __exit__(self, *args):
+        from awseipext.aws_lambda import lambda_function
+
+        ec2, kms, region = self._saved
+        for clients, key, client in (
+                (lambda_function.ec2_clients, None, ec2),
+                (lambda_function.kms_clients, REGION, kms)):
+            if client is None:
+                clients.pop(key, None)
+            else:
+                clients[key] = client
+        if region is None:
+            os.environ.pop('AWS_REGION', None)
+        else:
+            os.environ['AWS_REGION'] = region
+        metrics.set_sink(self._saved_sink)
+        lambda_function.runtime = None
+        shutil.rmtree(self._tmpdir)
+
+    def get_token(self, action, resource, role=ROLE):
+        """
+        Mint a kmsauth token against the fake KMS.
+
+        :return: A (username, token) tuple.
+        """
+        import kmsauth
+
+        generator = kmsauth.KMSTokenGenerator(
+            KMSAUTH_KEY,
+            {
+                'to': TO_CONTEXT,
+                'from': role,
+                'user_type': 'service',
+                'action': action,
+                'resource': resource
+            },
+            REGION
+        )
+        generator.kms_client = self.kms
+        return generator.get_username(), generator.get_token()
+
+    def reset_calls(self):
+        self.ec2.reset_calls()
+        self.kms.reset_calls()
+
+    def calls(self):
+        calls = {}
+        for service, client in (('ec2', self.ec2), ('kms', self.kms)):
+            for operation, count in client.calls.items():
+                calls['{0}:{1}'.format(service, operation)] = count
+        return calls
+
+
+def reset_caches(backends, mode):
+    """
+    Reset the lambda function's per-container caches between iterations.
+
+    In cold mode, every cache that depends on the instance, address or
+    token is dropped, so each iteration pays for its full set of API calls,
+    as the first request for a resource on a warm container would. In warm
+    mode the caches are kept, and the address inventory is brought in line
+    with the fake's state without counting a call.
+    """
+    from awseipext.aws_lambda import lambda_function
+
+    if mode == 'cold':
+        lambda_function.invalidate_role()
+        lambda_function.address_inventory.invalidate()
+        if lambda_function.runtime is not None:
+            lambda_function.runtime.validators.invalidate()
+    else:
+        lambda_function.address_inventory.load(backends.ec2.snapshot())
+
+
+def sign(backends, request, token_resource=None):
+    """
+    Add the tokens a request would be sent with.
+
+    :param token_resource: The resource to mint a single request's token
+        for. Default: the request's own resource.
+    :return: The event to invoke lambda_handler with.
+    """
+    if 'operations' in request:
+        return dict(request, operations=[
+            sign(backends, operation)
+            for operation in request['operations']
+        ])
+    if request['action'] == RECONCILE:
+        token_resource = get_mapping_digest(request['mapping'])
+    elif token_resource is None:
+        token_resource = request['resource']
+    username, token = backends.get_token(request['action'], token_resource)
+    return dict(request, username=username, token=token)
+
+
+def run_path(backends, path, iterations, mode):
+    from awseipext.aws_lambda.lambda_function import lambda_handler
+
+    name, addresses, request, token_resource = path
+    event = sign(backends, request, token_resource)
+    latencies = []
+    calls = {}
+    result = None
+    # The first iteration primes one-time, per-container state (config,
+    # validators, KMS key metadata) and isn't measured.
+    for i in range(iterations + 1):
+        backends.ec2.reset(addresses, INSTANCES)
+        reset_caches(backends, mode)
+        backends.reset_calls()
+        start = time.time()
+        ret = lambda_handler(event, config_file=backends.config_file)
+        elapsed = time.time() - start
+        if i == 0:
+            continue
+        latencies.append(elapsed)
+        result = ret['result']
+        for operation, count in backends.calls().items():
+            calls[operation] = calls.get(operation, 0) + count
+    api_calls = dict(
+        (operation, float(count) / iterations)
+        for operation, count in sorted(calls.items())
+    )
+    return {
+        'result': result,
+        'api_calls': api_calls,
+        'api_calls_per_request': sum(api_calls.values()),
+        'latency_ms': summarize(latencies)
+    }
+
+
+def run(iterations=20, ec2_latency=0, kms_latency=0, mode='cold'):
+    """
+    Benchmark every lambda_handler path.
+
+    :param iterations: Number of measured requests per path.
+    :param ec2_latency: Simulated latency of each EC2 call, in seconds.
+    :param kms_latency: Simulated latency of each KMS call, in seconds.
+    :param mode: 'cold' to drop per-resource caches between requests, or
+        'warm' to keep them.
+    :return: A dict of results, keyed by path name under 'paths'.
+    """
+    if mode not in MODES:
+        raise ValueError('Invalid mode: {0}'.format(mode))
+    results = {
+        'iterations': iterations,
+        'ec2_latency': ec2_latency,
+        'kms_latency': kms_latency,
+        'mode': mode,
+        'paths': {}
+    }
+    with Backends(ec2_latency, kms_latency) as backends:
+        for path in PATHS:
+            results['paths'][path[0]] = run_path(
+                backends,
+                path,
+                iterations,
+                mode
+            )
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare benchmark results to a baseline.
+
+    Any increase in API calls per request is a regression. Latency is only
+    compared when both runs used the same simulated latencies, and is a
+    regression when a path's p50 grows by more than tolerance.
+
+    :return: A list of regression messages.
+    """
+    regressions = []
+    same_latencies = all(
+        results.get(key) == baseline.get(key)
+        for key in ('ec2_latency', 'kms_latency', 'mode')
+    )
+    for name, path in sorted(results['paths'].items()):
+        base = baseline['paths'].get(name)
+        if base is None:
+            continue
+        for operation, count in sorted(path['api_calls'].items()):
+            base_count = base['api_calls'].get(operation, 0)
+            if count > base_count + 1e-9:
+                regressions.append(
+                    '{0}: {1} calls per request went from {2} to {3}'.format(
+                        name,
+                        operation,
+                        base_count,
+                        count
+                    )
+                )
+        if not same_latencies:
+            continue
+        p50 = path['latency_ms']['p50']
+        base_p50 = base['latency_ms']['p50']
+        if p50 > base_p50 * (1 + tolerance):
+            regressions.append(
+                '{0}: p50 went from {1:.2f}ms to {2:.2f}ms'.format(
+                    name,
+                    base_p50,
+                    p50
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark lambda_handler against fake EC2 and KMS.'
+    )
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument(
+        '--ec2-latency',
+        type=float,
+        default=0.02,
+        help='Simulated EC2 call latency, in seconds. Default: 0.02'
+    )
+    parser.add_argument(
+        '--kms-latency',
+        type=float,
+        default=0.01,
+        help='Simulated KMS call latency, in seconds. Default: 0.01'
+    )
+    parser.add_argument('--mode', choices=MODES, default='cold')
+    parser.add_argument(
+        '--baseline',
+        default=DEFAULT_BASELINE,
+        help='Baseline to compare against.'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Write the results to --baseline instead of comparing.'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed p50 latency growth over the baseline. Default: 0.2'
+    )
+    args = parser.parse_args()
+    results = run(
+        iterations=args.iterations,
+        ec2_latency=args.ec2_latency,
+        kms_latency=args.kms_latency,
+        mode=args.mode
+    )
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('mode') != results['mode']:
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        sys.stderr.write('REGRESSION: {0}\n'.format(regression))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
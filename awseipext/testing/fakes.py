@@ -0,0 +1,337 @@
+"""
+.. module: awseipext.testing.fakes
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import base64
+import collections
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}},
+        operation
+    )
+
+
+class FakeAWSClient(object):
+    def __init__(self, latency=0, error_rate=0, error_code=None, seed=None):
+        """
+        Base class for in-process stand-ins of boto3 clients. Every call is
+        counted, delayed by latency, and fails with error_code at
+        error_rate.
+
+        :param latency: Seconds each call takes, or a function returning
+            that for an operation name.
+        :param error_rate: Fraction of calls, between 0 and 1, to fail.
+        :param error_code: Error code of injected failures.
+        :param seed: Seed for the injected failures.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.lock = threading.RLock()
+
+    def _call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+            fail = (
+                self.error_rate and
+                self.random.random() < self.error_rate
+            )
+        latency = self.latency
+        if callable(latency):
+            latency = latency(operation)
+        if latency:
+            time.sleep(latency)
+        if fail:
+            raise client_error(self.error_code, operation)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    @property
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+class FakePaginator(object):
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class FakeEC2Client(FakeAWSClient):
+    def __init__(self, addresses=None, instances=None, **kwargs):
+        """
+        An in-process stand-in for a boto3 EC2 client, covering the calls
+        awseipext makes.
+
+        :param addresses: A list of describe_addresses entries.
+        :param instances: A dict of instance id to instance profile ARN
+            (or None, for instances without a profile).
+        """
+        kwargs.setdefault('error_code', 'RequestLimitExceeded')
+        super(FakeEC2Client, self).__init__(**kwargs)
+        self._association_ids = itertools.count(1)
+        self.reset(addresses, instances)
+
+    def reset(self, addresses=None, instances=None):
+        """
+        Replace the fake's addresses and instances.
+        """
+        with self.lock:
+            self.addresses = collections.OrderedDict(
+                (address['PublicIp'], copy.deepcopy(address))
+                for address in addresses or []
+            )
+            self.instances = dict(instances or {})
+
+    def snapshot(self):
+        """
+        The current addresses, as describe_addresses would return them,
+        without counting as a call.
+        """
+        with self.lock:
+            return copy.deepcopy(list(self.addresses.values()))
+
+    def describe_addresses(self, PublicIps=None, **kwargs):
+        self._call('describe_addresses')
+        with self.lock:
+            if PublicIps is None:
+                return {'Addresses': self.snapshot()}
+            for public_ip in PublicIps:
+                if public_ip not in self.addresses:
+                    raise client_error(
+                        'InvalidAddress.NotFound',
+                        'DescribeAddresses'
+                    )
+            return {
+                'Addresses': [
+                    copy.deepcopy(self.addresses[public_ip])
+                    for public_ip in PublicIps
+                ]
+            }
+
+    def describe_instances(self, InstanceIds=None, **kwargs):
+        self._call('describe_instances')
+        instances = []
+        for instance_id in InstanceIds or []:
+            if instance_id not in self.instances:
+                raise client_error(
+                    'InvalidInstanceID.NotFound',
+                    'DescribeInstances'
+                )
+            instance = {'InstanceId': instance_id}
+            if self.instances[instance_id]:
+                instance['IamInstanceProfile'] = {
+                    'Arn': self.instances[instance_id]
+                }
+            instances.append(instance)
+        return {'Reservations': [{'Instances': instances}]}
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def _find_allocation(self, allocation_id):
+        for address in self.addresses.values():
+            if address.get('AllocationId') == allocation_id:
+                return address
+        raise client_error('InvalidAllocationID.NotFound', 'AssociateAddress')
+
+    def associate_address(
+            self,
+            InstanceId,
+            AllocationId,
+            AllowReassociation=False,
+            **kwargs
+            ):
+        self._call('associate_address')
+        with self.lock:
+            if InstanceId not in self.instances:
+                raise client_error(
+                    'InvalidInstanceID.NotFound',
+                    'AssociateAddress'
+                )
+            address = self._find_allocation(AllocationId)
+            if address.get('InstanceId') and not AllowReassociation:
+                raise client_error(
+                    'Resource.AlreadyAssociated',
+                    'AssociateAddress'
+                )
+            association_id = 'eipassoc-{0:08x}'.format(
+                next(self._association_ids)
+            )
+            address['InstanceId'] = InstanceId
+            address['AssociationId'] = association_id
+            return {'AssociationId': association_id}
+
+    def disassociate_address(self, AssociationId, **kwargs):
+        self._call('disassociate_address')
+        with self.lock:
+            for address in self.addresses.values():
+                if address.get('AssociationId') == AssociationId:
+                    address.pop('InstanceId', None)
+                    address.pop('AssociationId', None)
+                    address.pop('NetworkInterfaceId', None)
+                    return {}
+            raise client_error(
+                'InvalidAssociationID.NotFound',
+                'DisassociateAddress'
+            )
+
+
+class FakeKMSClient(FakeAWSClient):
+    def __init__(self, keys=None, **kwargs):
+        """
+        An in-process stand-in for a boto3 KMS client. Ciphertexts are
+        plain JSON that record the key and encryption context, so decrypt
+        enforces the context the way KMS does.
+
+        :param keys: A dict of key alias to key ARN.
+        """
+        kwargs.setdefault('error_code', 'ThrottlingException')
+        super(FakeKMSClient, self).__init__(**kwargs)
+        self.keys = dict(keys or {})
+
+    def _get_arn(self, key_id):
+        if key_id.startswith('arn:aws:kms:'):
+            return key_id
+        if key_id not in self.keys:
+            raise client_error('NotFoundException', 'DescribeKey')
+        return self.keys[key_id]
+
+    def describe_key(self, KeyId, **kwargs):
+        self._call('describe_key')
+        return {'KeyMetadata': {'Arn': self._get_arn(KeyId)}}
+
+    def encrypt(self, KeyId, Plaintext, EncryptionContext=None, **kwargs):
+        self._call('encrypt')
+        blob = json.dumps({
+            'key': self._get_arn(KeyId),
+            'context': EncryptionContext or {},
+            'plaintext': base64.b64encode(Plaintext.encode('utf-8')).decode(
+                'ascii'
+            )
+        }, sort_keys=True)
+        return {'CiphertextBlob': blob.encode('utf-8')}
+
+    def decrypt(self, CiphertextBlob, EncryptionContext=None, **kwargs):
+        self._call('decrypt')
+        try:
+            blob = json.loads(CiphertextBlob.decode('utf-8'))
+        except ValueError:
+            raise client_error('InvalidCiphertextException', 'Decrypt')
+        if blob['context'] != (EncryptionContext or {}):
+            raise client_error('InvalidCiphertextException', 'Decrypt')
+        return {
+            'KeyId': blob['key'],
+            'Plaintext': base64.b64decode(blob['plaintext'])
+        }
+
+
+class FakeDynamoDBClient(FakeAWSClient):
+    def __init__(self, key='resource', **kwargs):
+        """
+        An in-process stand-in for a boto3 DynamoDB client, covering the
+        item calls awseipext makes. Condition expressions may be made of
+        attribute_not_exists(#name), #name = :value and #name < :value
+        clauses joined by OR.
+
+        :param key: Name of the tables' partition key.
+        """
+        kwargs.setdefault(
+            'error_code',
+            'ProvisionedThroughputExceededException'
+        )
+        super(FakeDynamoDBClient, self).__init__(**kwargs)
+        self.key = key
+        # Table name to a dict of key value to item.
+        self.tables = collections.defaultdict(dict)
+
+    @staticmethod
+    def _value(value):
+        if 'N' in value:
+            return float(value['N'])
+        return value['S']
+
+    def _check(self, item, condition, names, values, operation):
+        if condition is None:
+            return
+        for clause in condition.split(' OR '):
+            clause = clause.strip()
+            if clause.startswith('attribute_not_exists('):
+                name = names[clause[len('attribute_not_exists('):-1]]
+                if item is None or name not in item:
+                    return
+                continue
+            name, op, value = clause.split(' ')
+            name = names[name]
+            if item is None or name not in item:
+                continue
+            current = self._value(item[name])
+            expected = self._value(values[value])
+            if op == '=' and current == expected:
+                return
+            if op == '<' and current < expected:
+                return
+        raise client_error('ConditionalCheckFailedException', operation)
+
+    def _key(self, item):
+        return self._value(item[self.key])
+
+    def put_item(self, TableName, Item, ConditionExpression=None,
+                 ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._call('put_item')
+        key = self._key(Item)
+        with self.lock:
+            table = self.tables[TableName]
+            self._check(
+                table.get(key),
+                ConditionExpression,
+                ExpressionAttributeNames or {},
+                ExpressionAttributeValues or {},
+                'PutItem'
+            )
+            table[key] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call('get_item')
+        with self.lock:
+            item = self.tables[TableName].get(self._key(Key))
+            if item is None:
+                return {}
+            return {'Item': copy.deepcopy(item)}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self._call('delete_item')
+        key = self._key(Key)
+        with self.lock:
+            table = self.tables[TableName]
+            self._check(
+                table.get(key),
+                ConditionExpression,
+                ExpressionAttributeNames or {},
+                ExpressionAttributeValues or {},
+                'DeleteItem'
+            )
+            table.pop(key, None)
+        return {}
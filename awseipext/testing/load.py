@@ -0,0 +1,419 @@
+"""
+.. module: awseipext.testing.load
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Load generator for the full client to handler path. A fleet of instances,
+each with an EIP, makes one request apiece at once (as they would when
+failing over together), through AwseipextClient and a local Lambda
+stand-in running lambda_handler against in-process EC2 and KMS stand-ins.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from awseipext.client import AwseipextClient
+from awseipext.ec2.retry import AdaptiveTokenBucket
+from awseipext.testing import benchmark
+
+ACTIONS = ('associate', 'disassociate', 'move')
+TRANSPORTS = ('inprocess', 'socket')
+DEFAULT_MIX = {'move': 1}
+# Number of distinct error messages to keep in a report.
+MAX_ERRORS = 10
+
+
+def parse_mix(value):
+    """
+    Parse a request mix such as 'move=2,associate=1' into a dict of action
+    to weight.
+    """
+    mix = {}
+    for item in value.split(','):
+        action, _, weight = item.partition('=')
+        action = action.strip()
+        if action not in ACTIONS:
+            raise ValueError('Invalid action: {0}'.format(action))
+        mix[action] = float(weight) if weight else 1.0
+        if mix[action] < 0:
+            raise ValueError('Weights must not be negative.')
+    if not sum(mix.values()):
+        raise ValueError('At least one action needs a weight.')
+    return mix
+
+
+def _public_ip(index):
+    # Addresses from the 198.18.0.0/15 benchmarking range.
+    return '198.{0}.{1}.{2}'.format(
+        18 + index // 65536,
+        index // 256 % 256,
+        index % 256
+    )
+
+
+def build_fleet(size, mix=None, seed=None):
+    """
+    Build a fleet of size instance pairs, each with an EIP, and one
+    operation per pair, with actions drawn from mix. Every operation would
+    succeed on its own: associations start from a free address,
+    disassociations from one on the primary, and moves take an address
+    from the primary to its standby.
+
+    :param mix: A dict of action to weight. Default: DEFAULT_MIX
+    :param seed: Seed for drawing the actions.
+    :return: An (addresses, instances, operations, expected) tuple, where
+        expected maps each IP to the instance it should end up on.
+    """
+    if mix is None:
+        mix = DEFAULT_MIX
+    rand = random.Random(seed)
+    actions = sorted(mix)
+    total = sum(mix.values())
+    profile = benchmark.INSTANCES[benchmark.INSTANCE_ID]
+    addresses = []
+    instances = {}
+    operations = []
+    expected = {}
+    for index in range(size):
+        public_ip = _public_ip(index)
+        primary = 'i-{0:08x}'.format(0x1000 + 2 * index)
+        standby = 'i-{0:08x}'.format(0x1000 + 2 * index + 1)
+        instances[primary] = profile
+        instances[standby] = profile
+        draw = rand.random() * total
+        for action in actions:
+            draw -= mix[action]
+            if draw < 0:
+                break
+        allocation_id = 'eipalloc-{0:08x}'.format(index)
+        if action == 'associate':
+            address = benchmark.free_address(public_ip, allocation_id)
+            operations.append((action, public_ip, primary))
+            expected[public_ip] = primary
+        else:
+            address = benchmark.associated_address(
+                primary,
+                public_ip,
+                allocation_id
+            )
+            # Kept clear of the ids the fake hands out for new associations.
+            address['AssociationId'] = 'eipassoc-{0:08x}'.format(
+                0x80000000 + index
+            )
+            if action == 'disassociate':
+                operations.append((action, public_ip, primary))
+                expected[public_ip] = None
+            else:
+                operations.append((action, public_ip, standby))
+                expected[public_ip] = standby
+        addresses.append(address)
+    return addresses, instances, operations, expected
+
+
+class _StandInClient(AwseipextClient):
+    """An AwseipextClient that mints its tokens against the fake KMS."""
+
+    def __init__(self, kms, **kwargs):
+        super(_StandInClient, self).__init__(
+            'awseipext',
+            benchmark.KMSAUTH_KEY,
+            benchmark.ROLE,
+            benchmark.TO_CONTEXT,
+            'service',
+            **kwargs
+        )
+        self.kms = kms
+
+    def _get_generator(self, action, resource):
+        generator = super(_StandInClient, self)._get_generator(
+            action,
+            resource
+        )
+        generator.kms_client = self.kms
+        return generator
+
+
+class _SocketTransport(object):
+    def __init__(self, config_file, workers):
+        """
+        An awseipext.service on a unix socket, served from a background
+        thread while used as a context manager.
+        """
+        self.config_file = config_file
+        self.workers = workers
+        self.tmpdir = None
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        from awseipext import service
+
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'awseipext.sock')
+        self.server = service.UnixHTTPService(
+            path,
+            config_file=self.config_file,
+            workers=self.workers
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return service.UnixSocketLambdaClient(path)
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+
+class _InProcessTransport(object):
+    def __init__(self, config_file, latency):
+        self.config_file = config_file
+        self.latency = latency
+
+    def __enter__(self):
+        from awseipext import service
+
+        return service.LocalLambdaClient(
+            self.config_file,
+            latency=self.latency
+        )
+
+    def __exit__(self, *args):
+        pass
+
+
+def _call(client, operation):
+    """
+    Make one operation's call.
+
+    :return: A (latency, outcome, error) tuple, where outcome is
+        'success', 'failure' or 'error'.
+    """
+    action, resource, instance_id = operation
+    start = time.time()
+    try:
+        response = json.loads(
+            getattr(client, action)(resource, instance_id)
+        )
+    except Exception as e:
+        return time.time() - start, 'error', '{0}: {1}'.format(
+            type(e).__name__,
+            e
+        )
+    elapsed = time.time() - start
+    if 'result' not in response:
+        # An unhandled error in the function.
+        return elapsed, 'error', response.get('errorMessage')
+    if response['result']:
+        return elapsed, 'success', None
+    return elapsed, 'failure', response.get('error')
+
+
+def run(
+        instances=500,
+        concurrency=50,
+        mix=None,
+        ec2_latency=0,
+        kms_latency=0,
+        invoke_latency=0,
+        ec2_error_rate=0,
+        kms_error_rate=0,
+        transport='inprocess',
+        seed=None
+        ):
+    """
+    Run a load test: one request per instance pair of a fleet, made from
+    concurrency client threads at once.
+
+    :param instances: Number of instance pairs (and EIPs) in the fleet.
+    :param concurrency: Number of requests in flight at once.
+    :param mix: A dict of action to weight. Default: DEFAULT_MIX
+    :param ec2_latency: Simulated latency of each EC2 call, in seconds.
+    :param kms_latency: Simulated latency of each KMS call, in seconds.
+    :param invoke_latency: Simulated overhead of each Lambda invocation, in
+        seconds, for the inprocess transport.
+    :param ec2_error_rate: Fraction of EC2 calls to throttle.
+    :param kms_error_rate: Fraction of KMS calls to throttle.
+    :param transport: 'inprocess' to call lambda_handler directly, or
+        'socket' to go through an awseipext.service on a unix socket.
+    :param seed: Seed for the request mix and injected errors.
+    :return: A dict report.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from awseipext.aws_lambda import lambda_function
+
+    if transport not in TRANSPORTS:
+        raise ValueError('Invalid transport: {0}'.format(transport))
+    if mix is None:
+        mix = DEFAULT_MIX
+    addresses, fleet, operations, expected = build_fleet(instances, mix, seed)
+    retrier = lambda_function.ec2_retrier
+    saved_bucket = retrier.bucket
+    with benchmark.Backends(ec2_latency, kms_latency) as backends:
+        backends.ec2.error_rate = ec2_error_rate
+        backends.ec2.random = random.Random(seed)
+        backends.kms.error_rate = kms_error_rate
+        backends.kms.random = random.Random(seed)
+        backends.ec2.reset(addresses, fleet)
+        benchmark.reset_caches(backends, 'cold')
+        # Start from a container's rate limit, rather than whatever an
+        # earlier run in this process left it at.
+        retrier.bucket = AdaptiveTokenBucket(lambda_function.EC2_MAX_RATE)
+        retries = retrier.retries
+        throttles = retrier.throttles
+        if transport == 'socket':
+            context = _SocketTransport(backends.config_file, concurrency)
+        else:
+            context = _InProcessTransport(
+                backends.config_file,
+                invoke_latency
+            )
+        try:
+            with context as lambda_client:
+                client = _StandInClient(
+                    backends.kms,
+                    lambda_client=lambda_client
+                )
+                backends.reset_calls()
+                start = time.time()
+                executor = ThreadPoolExecutor(max_workers=concurrency)
+                try:
+                    results = list(executor.map(
+                        lambda operation: _call(client, operation),
+                        operations
+                    ))
+                finally:
+                    executor.shutdown(wait=True)
+                duration = time.time() - start
+            calls = backends.calls()
+            final = dict(
+                (address['PublicIp'], address.get('InstanceId'))
+                for address in backends.ec2.snapshot()
+            )
+        finally:
+            retries = retrier.retries - retries
+            throttles = retrier.throttles - throttles
+            retrier.bucket = saved_bucket
+    outcomes = collections.Counter(outcome for _, outcome, _ in results)
+    errors = collections.Counter(
+        error for _, _, error in results if error is not None
+    )
+    api_calls = dict(
+        (operation, float(count) / len(operations))
+        for operation, count in sorted(calls.items())
+    )
+    return {
+        'instances': instances,
+        'concurrency': concurrency,
+        'mix': mix,
+        'transport': transport,
+        'ec2_latency': ec2_latency,
+        'kms_latency': kms_latency,
+        'invoke_latency': invoke_latency,
+        'ec2_error_rate': ec2_error_rate,
+        'kms_error_rate': kms_error_rate,
+        'requests': len(operations),
+        'duration_s': duration,
+        'throughput_rps': len(operations) / duration if duration else None,
+        'latency_ms': benchmark.summarize(
+            [latency for latency, _, _ in results]
+        ),
+        'outcomes': dict(outcomes),
+        'errors': dict(errors.most_common(MAX_ERRORS)),
+        'api_calls': api_calls,
+        'api_calls_per_request': sum(api_calls.values()),
+        'ec2_retries': retries,
+        'ec2_throttles': throttles,
+        # IPs not on the instance their operation should have left them on.
+        'misplaced': sum(
+            1 for public_ip, instance_id in expected.items()
+            if final.get(public_ip) != instance_id
+        )
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test AwseipextClient against a local lambda'
+                    ' stand-in, with fake EC2 and KMS.'
+    )
+    parser.add_argument(
+        '--instances',
+        type=int,
+        default=500,
+        help='Number of instances making a request at once. Default: 500'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=50,
+        help='Number of requests in flight at once. Default: 50'
+    )
+    parser.add_argument(
+        '--mix',
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help='Weighted request mix, such as move=2,associate=1,'
+             'disassociate=1. Default: move=1'
+    )
+    parser.add_argument(
+        '--ec2-latency',
+        type=float,
+        default=0.02,
+        help='Simulated EC2 call latency, in seconds. Default: 0.02'
+    )
+    parser.add_argument(
+        '--kms-latency',
+        type=float,
+        default=0.01,
+        help='Simulated KMS call latency, in seconds. Default: 0.01'
+    )
+    parser.add_argument(
+        '--invoke-latency',
+        type=float,
+        default=0.01,
+        help='Simulated Lambda invocation overhead, in seconds, for the'
+             ' inprocess transport. Default: 0.01'
+    )
+    parser.add_argument(
+        '--ec2-error-rate',
+        type=float,
+        default=0,
+        help='Fraction of EC2 calls to throttle. Default: 0'
+    )
+    parser.add_argument(
+        '--kms-error-rate',
+        type=float,
+        default=0,
+        help='Fraction of KMS calls to throttle. Default: 0'
+    )
+    parser.add_argument('--transport', choices=TRANSPORTS, default='inprocess')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.instances < 1 or args.concurrency < 1:
+        parser.error('--instances and --concurrency must be at least 1')
+    report = run(
+        instances=args.instances,
+        concurrency=args.concurrency,
+        mix=args.mix,
+        ec2_latency=args.ec2_latency,
+        kms_latency=args.kms_latency,
+        invoke_latency=args.invoke_latency,
+        ec2_error_rate=args.ec2_error_rate,
+        kms_error_rate=args.kms_error_rate,
+        transport=args.transport,
+        seed=args.seed
+    )
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+.. module: awseipext.testing.request_benchmark
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+
+Compares the precompiled request validator against the marshmallow schemas
+it replaced in the lambda function.
+"""
+import argparse
+import json
+import timeit
+
+from awseipext.request import validator
+from awseipext.request.lambda_request import LambdaBatchSchema, LambdaSchema
+
+REQUEST = {
+    'action': 'associate',
+    'resource': '198.51.100.1',
+    'instance_id': 'i-00000001',
+    'username': '2/service/test-development-iad',
+    'token': 'faketoken'
+}
+BATCH_REQUEST = {'operations': [REQUEST] * 10}
+
+
+def load_with_schema(event):
+    if 'operations' in event:
+        return LambdaBatchSchema(strict=True).load(event).data
+    return LambdaSchema(strict=True).load(event).data
+
+
+def load_with_validator(event):
+    if 'operations' in event:
+        batch = validator.load_batch_request(event)
+        for request in batch.operations:
+            validator.get_request_error(request)
+        return batch
+    request = validator.load_request(event)
+    validator.get_request_error(request)
+    return request
+
+
+def _time(function, event, number, repeat):
+    timings = timeit.repeat(
+        lambda: function(event),
+        number=number,
+        repeat=repeat
+    )
+    # Microseconds per load, from the fastest run.
+    return min(timings) / number * 1000000
+
+
+def run(number=10000, repeat=3):
+    """
+    Time loading a single and a batch request with each implementation.
+
+    :param number: Loads per timed run.
+    :param repeat: Timed runs; the fastest one is reported.
+    :return: A dict of event name to microseconds per load, and speedup.
+    """
+    results = {}
+    for name, event in (('single', REQUEST), ('batch', BATCH_REQUEST)):
+        schema = _time(load_with_schema, event, number, repeat)
+        fast = _time(load_with_validator, event, number, repeat)
+        results[name] = {
+            'schema_us': round(schema, 2),
+            'validator_us': round(fast, 2),
+            'speedup': round(schema / fast, 1)
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the request validator against the schemas.'
+    )
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    results = run(number=args.number, repeat=args.repeat)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+.. module: awseipext.token_cache
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache(object):
+    def __init__(self, cache_file=None, safety_margin=60):
+        """
+        A cache of kmsauth tokens, keyed on the token's auth context.
+
+        Tokens are handed back until safety_margin seconds before they
+        expire. If cache_file is set, tokens are also persisted there, so
+        that short-lived processes on the same host can share them.
+
+        :param cache_file: Path of a file to persist tokens to. Optional.
+        :param safety_margin: Seconds before expiry to stop using a token.
+        """
+        self.cache_file = cache_file
+        self.safety_margin = safety_margin
+        self.tokens = {}
+        self.lock = threading.Lock()
+        if self.cache_file:
+            with self.lock:
+                self._load()
+
+    @staticmethod
+    def _format_key(key):
+        return json.dumps(list(key))
+
+    def _is_fresh(self, entry, now):
+        return now < entry['not_after'] - self.safety_margin
+
+    def _load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                tokens = json.load(f)
+        except IOError as e:
+            logger.debug('Failed to read token cache: {0}'.format(e))
+            return
+        except Exception:
+            logger.exception('Failed to read token cache.')
+            return
+        now = time.time()
+        for key, entry in tokens.items():
+            current = self.tokens.get(key)
+            if current and current['not_after'] >= entry['not_after']:
+                continue
+            if self._is_fresh(entry, now):
+                self.tokens[key] = entry
+
+    def _save(self):
+        try:
+            cachedir = os.path.dirname(os.path.abspath(self.cache_file))
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            # Write to a private temp file and rename it into place, so
+            # concurrent readers never see a partial file.
+            fd, path = tempfile.mkstemp(dir=cachedir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.tokens, f)
+            os.rename(path, self.cache_file)
+        except Exception:
+            logger.exception('Failed to write token cache.')
+
+    def get(self, key):
+        """
+        Get a cached token.
+
+        :param key: A tuple identifying the token's auth context.
+        :return: A (username, token) tuple, or None if no fresh token is
+            cached.
+        """
+        key = self._format_key(key)
+        now = time.time()
+        with self.lock:
+            entry = self.tokens.get(key)
+            if (entry is None or not self._is_fresh(entry, now)) and \
+                    self.cache_file:
+                # Another process may have minted the token.
+                self._load()
+                entry = self.tokens.get(key)
+            if entry is None or not self._is_fresh(entry, now):
+                return None
+            return entry['username'], entry['token']
+
+    def ttl(self, key):
+        """
+        Seconds a cached token will still be handed out for.
+
+        :param key: A tuple identifying the token's auth context.
+        :return: The seconds left, or None if no fresh token is cached.
+        """
+        key = self._format_key(key)
+        now = time.time()
+        with self.lock:
+            entry = self.tokens.get(key)
+            if (entry is None or not self._is_fresh(entry, now)) and \
+                    self.cache_file:
+                self._load()
+                entry = self.tokens.get(key)
+            if entry is None or not self._is_fresh(entry, now):
+                return None
+            return entry['not_after'] - self.safety_margin - now
+
+    def set(self, key, username, token, not_after):
+        """
+        Cache a token.
+
+        :param key: A tuple identifying the token's auth context.
+        :param username: The kmsauth username for the token.
+        :param token: The kmsauth token.
+        :param not_after: Expiry of the token, in seconds since the epoch.
+        """
+        key = self._format_key(key)
+        now = time.time()
+        with self.lock:
+            if self.cache_file:
+                # Merge in tokens written by other processes first.
+                self._load()
+            self.tokens = dict(
+                (_key, entry) for _key, entry in self.tokens.items()
+                if self._is_fresh(entry, now)
+            )
+            self.tokens[key] = {
+                'username': username,
+                'token': token,
+                'not_after': not_after
+            }
+            if self.cache_file:
+                self._save()
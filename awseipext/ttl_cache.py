@@ -0,0 +1,82 @@
+"""
+.. module: awseipext.ttl_cache
+    :copyright: (c) 2016 by Lyft Inc.
+    :license: Apache, see LICENSE for more details.
+"""
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    def __init__(self, capacity, ttl, clock=time.time):
+        """
+        A thread-safe, bounded cache whose entries expire after a TTL. When
+        full, the least recently used entry is evicted.
+
+        :param capacity: Maximum number of entries to keep.
+        :param ttl: Default lifetime of an entry, in seconds.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Look up a key.
+
+        :return: A (found, value) tuple. Cached values may be None, so found
+            says whether the key was in the cache.
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return False, None
+            # Re-insert to mark the entry as most recently used.
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache a value.
+
+        :param ttl: Lifetime of this entry, in seconds. Default: the cache's
+            ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = self.clock() + ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+            self.entries[key] = (expires, value)
+
+    def invalidate(self, key=None):
+        """
+        Drop a key from the cache, or every key if none is given.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def __len__(self):
+        return len(self.entries)
@@ -18,6 +18,7 @@ setup(
     license=about["__license__"],
     packages=find_packages(exclude=["test*"]),
     install_requires=[
+        'futures>=3.0.5,<4.0.0',
         'kmsauth>=0.1.5,<0.2.0',
         'marshmallow>=2.9.0,<3.0.0'
     ],
@@ -35,7 +36,9 @@ setup(
     },
     entry_points={
         "console_scripts": [
-            "awseipext = awseipext.client:main"
+            "awseipext = awseipext.client:main",
+            "awseipext-service = awseipext.service:main",
+            "awseipext-agent = awseipext.agent:main"
         ]
     }
 )
@@ -1,10 +1,23 @@
+import base64
+import datetime
+import json
 import os
+import threading
+import time
 
+import botocore
 import pytest
+from mock import ANY
 from mock import patch
 from mock import MagicMock
 
+from awseipext import metrics
+from awseipext import result_sink
+from awseipext import result_store
+from awseipext.aws_lambda import lambda_function
+from awseipext.aws_lambda.lambda_function import get_runtime
 from awseipext.aws_lambda.lambda_function import lambda_handler
+from awseipext.ec2.address import Address
 
 
 class Context(object):
@@ -36,9 +49,38 @@ INVALID_TEST_REQUEST = {
 
 GOOD_TOKEN = {'payload': 'test', 'key_alias': 'authnz'}
 
+UNASSOCIATED_ADDRESS = Address(
+    '10.0.0.1',
+    allocation_id='eipalloc-12345',
+    domain='vpc'
+)
+ASSOCIATED_ADDRESS = Address(
+    '10.0.0.1',
+    allocation_id='eipalloc-12345',
+    association_id='eipassoc-12345',
+    instance_id='i-12345',
+    domain='vpc'
+)
+OTHER_ASSOCIATED_ADDRESS = Address(
+    '10.0.0.1',
+    allocation_id='eipalloc-12345',
+    association_id='eipassoc-56789',
+    instance_id='i-56789',
+    domain='vpc'
+)
+
 os.environ['AWS_REGION'] = 'us-west-2'
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    lambda_function.invalidate_role()
+    lambda_function.address_inventory.invalidate()
+    if lambda_function.runtime is not None:
+        lambda_function.runtime.validators.invalidate()
+        lambda_function.runtime.result_store.entries.invalidate()
+
+
 @patch(
     'awseipext.aws_lambda.lambda_function.get_role_name',
     MagicMock(return_value='test-development-iad')
@@ -48,8 +90,8 @@ os.environ['AWS_REGION'] = 'us-west-2'
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value='i-12345')
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
 )
 def test_basic_associate_request_already_done():
     # Already associated
@@ -72,11 +114,11 @@ def test_basic_associate_request_already_done():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value=None)
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.ec2_client',
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
     MagicMock()
 )
 def test_basic_associate_request_to_associate():
@@ -100,8 +142,8 @@ def test_basic_associate_request_to_associate():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value='i-56790')
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=OTHER_ASSOCIATED_ADDRESS)
 )
 def test_invalid_associate_request():
     ret = lambda_handler(
@@ -124,11 +166,11 @@ def test_invalid_associate_request():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value=None)
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.ec2_client',
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
     MagicMock()
 )
 def test_basic_disassociate_request_already_done():
@@ -152,11 +194,11 @@ def test_basic_disassociate_request_already_done():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value='i-12345')
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.ec2_client',
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
     MagicMock()
 )
 def test_basic_disassociate_request_disassociated():
@@ -180,11 +222,11 @@ def test_basic_disassociate_request_disassociated():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value='i-56789')
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=OTHER_ASSOCIATED_ADDRESS)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.ec2_client',
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
     MagicMock()
 )
 def test_invalid_disassociate_request():
@@ -208,11 +250,11 @@ def test_invalid_disassociate_request():
     MagicMock(return_value=GOOD_TOKEN)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.get_instance_id',
-    MagicMock(return_value='i-12345')
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
 )
 @patch(
-    'awseipext.aws_lambda.lambda_function.ec2_client',
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
     MagicMock()
 )
 def test_invalid_action_request():
@@ -227,6 +269,87 @@ def test_invalid_action_request():
     assert ret['error'] == 'invalid is not a valid action.'
 
 
+@patch('kmsauth.KMSTokenValidator.decrypt_token')
+@patch('awseipext.aws_lambda.lambda_function.get_role_name')
+def test_malformed_request_rejected_before_auth(get_role_name, decrypt_token):
+    event = {
+        'operations': [
+            dict(ASSOCIATE_TEST_REQUEST, resource='10.0.0.256'),
+            dict(ASSOCIATE_TEST_REQUEST, instance_id='instance')
+        ]
+    }
+    ret = lambda_handler(
+        event, context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert not ret['result']
+    assert [r['error'] for r in ret['results']] == [
+        '10.0.0.256 is not a valid IP address.',
+        'instance is not a valid instance id.'
+    ]
+    assert not decrypt_token.called
+    assert not get_role_name.called
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=None)
+)
+def test_address_lookup_failed():
+    ret = lambda_handler(
+        ASSOCIATE_TEST_REQUEST, context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert not ret['result']
+    assert ret['error'] == 'Could not lookup IP.'
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
+)
+def test_disassociate_uses_snapshot_association_id():
+    ec2_client = MagicMock()
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            DISASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    assert ret['result']
+    ec2_client.disassociate_address.assert_called_once_with(
+        AssociationId='eipassoc-12345'
+    )
+    assert not ec2_client.describe_addresses.called
+
+
 def test_local_request_config_not_found():
     with pytest.raises(ValueError):
         lambda_handler(
@@ -247,7 +370,14 @@ def test_local_request_config_not_found():
     'kmsauth.KMSTokenValidator.decrypt_token',
     MagicMock(return_value=GOOD_TOKEN)
 )
-def test_invalid_from_request():
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_ec2_client'
+)
+def test_invalid_from_request(get_ec2_client):
     ret = lambda_handler(
         ASSOCIATE_TEST_REQUEST, context=Context,
         config_file=os.path.join(
@@ -259,3 +389,1276 @@ def test_invalid_from_request():
     msg = ('Instance is not in role (test-development-iad) associated'
            ' with kms token (2/service/test-development-iad).')
     assert ret['error'] == msg
+    # The address is looked up alongside the role, but nothing is changed.
+    assert not get_ec2_client.return_value.associate_address.called
+
+
+def test_runtime_reused_across_invocations():
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    ctx = get_runtime(config_file, 'us-west-2')
+    assert get_runtime(config_file, 'us-west-2') is ctx
+    validator = ctx.get_validator({'action': 'associate', 'resource': 'a'})
+    assert ctx.get_validator(
+        {'action': 'associate', 'resource': 'a'}
+    ) is validator
+    other = ctx.get_validator({'action': 'disassociate', 'resource': 'a'})
+    assert other is not validator
+    assert other.KEY_METADATA is validator.KEY_METADATA
+    assert get_runtime(config_file, 'us-east-1') is not ctx
+
+
+def test_runtime_rebuilt_on_config_change(tmpdir):
+    config_file = tmpdir.join('lambda.cfg')
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/authnz\n'
+        'kmsauth_to_context = alias/authnz\n'
+    )
+    ctx = get_runtime(str(config_file), 'us-west-2')
+    assert ctx.kmsauth_key == 'alias/authnz'
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/other\n'
+        'kmsauth_to_context = alias/authnz\n'
+    )
+    config_file.setmtime(ctx.config_mtime + 10)
+    new_ctx = get_runtime(str(config_file), 'us-west-2')
+    assert new_ctx is not ctx
+    assert new_ctx.kmsauth_key == 'alias/other'
+    assert lambda_function.runtime is new_ctx
+
+
+def test_runtime_built_once_concurrently(monkeypatch, tmpdir):
+    config_file = tmpdir.join('lambda.cfg')
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/authnz\n'
+        'kmsauth_to_context = alias/authnz\n'
+    )
+    built = []
+    runtime_context = lambda_function.RuntimeContext
+
+    def slow_runtime_context(*args):
+        built.append(args)
+        time.sleep(0.05)
+        return runtime_context(*args)
+
+    monkeypatch.setattr(
+        lambda_function,
+        'RuntimeContext',
+        slow_runtime_context
+    )
+    contexts = []
+    threads = [
+        threading.Thread(
+            target=lambda: contexts.append(
+                get_runtime(str(config_file), 'us-west-2')
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(built) == 1
+    assert all(ctx is contexts[0] for ctx in contexts)
+
+
+def _config_without_leases(tmpdir):
+    # Requests that lease IPs in a shared store read them afresh, so only
+    # those that don't use the address inventory.
+    config_file = tmpdir.join('lambda.cfg')
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/authnz\n'
+        'kmsauth_to_context = alias/authnz\n'
+        'lease_store = none\n'
+    )
+    return str(config_file)
+
+
+def test_get_address_from_inventory():
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.return_value = {
+        'Addresses': [{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'AssociationId': 'eipassoc-12345',
+            'InstanceId': 'i-12345',
+            'Domain': 'vpc'
+        }]
+    }
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        address = lambda_function.get_address('10.0.0.1')
+        assert lambda_function.get_address('10.0.0.1') is address
+    assert address == ASSOCIATED_ADDRESS
+    # The inventory is loaded with one describe of every address.
+    ec2_client.describe_addresses.assert_called_once_with()
+
+
+def _batch_ec2_client():
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.return_value = {
+        'Addresses': [
+            {
+                'PublicIp': '10.0.0.1',
+                'AllocationId': 'eipalloc-1',
+                'Domain': 'vpc'
+            },
+            {
+                'PublicIp': '10.0.0.2',
+                'AllocationId': 'eipalloc-2',
+                'AssociationId': 'eipassoc-2',
+                'InstanceId': 'i-12345',
+                'Domain': 'vpc'
+            }
+        ]
+    }
+    profile = 'arn:aws:iam::12345:instance-profile/test-development-iad'
+    ec2_client.get_paginator.return_value.paginate.return_value = [{
+        'Reservations': [{
+            'Instances': [
+                {
+                    'InstanceId': 'i-12345',
+                    'IamInstanceProfile': {'Arn': profile}
+                },
+                {
+                    'InstanceId': 'i-67890',
+                    'IamInstanceProfile': {'Arn': profile}
+                }
+            ]
+        }]
+    }]
+    return ec2_client
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_batch_request():
+    ec2_client = _batch_ec2_client()
+    event = {
+        'operations': [
+            dict(ASSOCIATE_TEST_REQUEST, instance_id='i-67890'),
+            dict(DISASSOCIATE_TEST_REQUEST, resource='10.0.0.2'),
+            dict(DISASSOCIATE_TEST_REQUEST, resource='10.0.0.2'),
+            INVALID_TEST_REQUEST
+        ]
+    }
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            event, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    assert not ret['result']
+    results = ret['results']
+    assert [r['resource'] for r in results] == [
+        '10.0.0.1', '10.0.0.2', '10.0.0.2', '10.0.0.1'
+    ]
+    assert results[0]['result']
+    assert results[1]['result']
+    assert results[2]['error'] == 'IP is already targeted in this batch.'
+    assert results[3]['error'] == 'invalid is not a valid action.'
+    # One lookup each for all addresses and all instances.
+    ec2_client.describe_addresses.assert_called_once_with()
+    ec2_client.get_paginator.return_value.paginate.assert_called_once_with(
+        InstanceIds=['i-12345', 'i-67890']
+    )
+    ec2_client.associate_address.assert_called_once_with(
+        InstanceId='i-67890',
+        AllocationId='eipalloc-1'
+    )
+    ec2_client.disassociate_address.assert_called_once_with(
+        AssociationId='eipassoc-2'
+    )
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.extract_username_field',
+    MagicMock(return_value='invalid-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_batch_request_invalid_role():
+    ec2_client = _batch_ec2_client()
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            {'operations': [ASSOCIATE_TEST_REQUEST]}, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    assert not ret['result']
+    assert ret['results'][0]['error'].startswith('Instance is not in role')
+    assert not ec2_client.describe_addresses.called
+    assert not ec2_client.associate_address.called
+
+
+def _instances(profile):
+    instance = {'InstanceId': 'i-12345'}
+    if profile:
+        instance['IamInstanceProfile'] = {'Arn': profile}
+    return {'Reservations': [{'Instances': [instance]}]}
+
+
+def test_get_role_name_cached():
+    profile = 'arn:aws:iam::12345:instance-profile/test-development-iad'
+    ec2_client = MagicMock()
+    ec2_client.describe_instances.return_value = _instances(profile)
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        assert lambda_function.get_role_name('i-12345') == (
+            'test-development-iad'
+        )
+        assert lambda_function.get_role_name('i-12345') == (
+            'test-development-iad'
+        )
+        ec2_client.describe_instances.assert_called_once_with(
+            InstanceIds=['i-12345']
+        )
+        lambda_function.invalidate_role('i-12345')
+        lambda_function.get_role_name('i-12345')
+        assert ec2_client.describe_instances.call_count == 2
+
+
+def _instance_error(code):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}},
+        'DescribeInstances'
+    )
+
+
+def test_get_role_name_negative_cache():
+    ec2_client = MagicMock()
+    ec2_client.describe_instances.side_effect = _instance_error(
+        'InvalidInstanceID.Malformed'
+    )
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        assert lambda_function.get_role_name('i-12345') is None
+        assert lambda_function.get_role_name('i-12345') is None
+        assert ec2_client.describe_instances.call_count == 1
+        # Transient errors aren't cached
+        ec2_client.describe_instances.side_effect = _instance_error(
+            'RequestLimitExceeded'
+        )
+        assert lambda_function.get_role_name('i-67890') is None
+        assert lambda_function.get_role_name('i-67890') is None
+        assert ec2_client.describe_instances.call_count == 3
+        # Nor are instances that aren't found, which may just have been
+        # launched
+        ec2_client.describe_instances.side_effect = _instance_error(
+            'InvalidInstanceID.NotFound'
+        )
+        assert lambda_function.get_role_name('i-fffff') is None
+        ec2_client.describe_instances.side_effect = None
+        ec2_client.describe_instances.return_value = _instances(
+            'arn:aws:iam::12345:instance-profile/test-development-iad'
+        )
+        assert lambda_function.get_role_name('i-fffff') == \
+            'test-development-iad'
+        assert ec2_client.describe_instances.call_count == 5
+        # Instances without a profile are
+        ec2_client.describe_instances.return_value = _instances(None)
+        assert lambda_function.get_role_name('i-abcde') is None
+        assert lambda_function.get_role_name('i-abcde') is None
+        assert ec2_client.describe_instances.call_count == 6
+
+
+def test_get_address_not_in_inventory():
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.side_effect = [
+        {'Addresses': []},
+        {'Addresses': [{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'Domain': 'vpc'
+        }]}
+    ]
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        address = lambda_function.get_address('10.0.0.1')
+    assert address == UNASSOCIATED_ADDRESS
+    ec2_client.describe_addresses.assert_called_with(PublicIps=['10.0.0.1'])
+    assert lambda_function.address_inventory.get('10.0.0.1') == address
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_inventory_updated_by_mutations(tmpdir):
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.return_value = {
+        'Addresses': [{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'Domain': 'vpc'
+        }]
+    }
+    ec2_client.associate_address.return_value = {
+        'AssociationId': 'eipassoc-12345'
+    }
+    config_file = _config_without_leases(tmpdir)
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        assert lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+        )['result']
+        assert lambda_function.address_inventory.get(
+            '10.0.0.1'
+        ) == ASSOCIATED_ADDRESS
+        # Already associated, according to the inventory, which is
+        # confirmed with a describe of the IP.
+        ec2_client.describe_addresses.return_value = {
+            'Addresses': [{
+                'PublicIp': '10.0.0.1',
+                'AllocationId': 'eipalloc-12345',
+                'AssociationId': 'eipassoc-12345',
+                'InstanceId': 'i-12345',
+                'Domain': 'vpc'
+            }]
+        }
+        assert lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+        )['result']
+        assert ec2_client.associate_address.call_count == 1
+        ec2_client.describe_addresses.assert_called_with(
+            PublicIps=['10.0.0.1']
+        )
+        assert lambda_handler(
+            DISASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=config_file
+        )['result']
+        ec2_client.disassociate_address.assert_called_once_with(
+            AssociationId='eipassoc-12345'
+        )
+    assert lambda_function.address_inventory.get(
+        '10.0.0.1'
+    ) == UNASSOCIATED_ADDRESS
+    assert ec2_client.describe_addresses.call_count == 2
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_stale_inventory_not_reported_done(monkeypatch, tmpdir):
+    from awseipext.testing.fakes import FakeEC2Client
+
+    ec2_client = FakeEC2Client(
+        addresses=[{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'Domain': 'vpc'
+        }],
+        instances={'i-12345': None}
+    )
+    monkeypatch.setitem(lambda_function.ec2_clients, None, ec2_client)
+    config_file = _config_without_leases(tmpdir)
+    assert lambda_handler(
+        ASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+    )['result']
+    # Disassociated behind the inventory's back.
+    with ec2_client.lock:
+        del ec2_client.addresses['10.0.0.1']['InstanceId']
+        del ec2_client.addresses['10.0.0.1']['AssociationId']
+    assert lambda_handler(
+        ASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+    )['result']
+    assert ec2_client.calls['associate_address'] == 2
+    assert ec2_client.snapshot()[0]['InstanceId'] == 'i-12345'
+    assert lambda_handler(
+        DISASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+    )['result']
+    # Associated behind the inventory's back.
+    with ec2_client.lock:
+        ec2_client.addresses['10.0.0.1'].update({
+            'AssociationId': 'eipassoc-99999',
+            'InstanceId': 'i-12345'
+        })
+    assert lambda_handler(
+        DISASSOCIATE_TEST_REQUEST, context=Context, config_file=config_file
+    )['result']
+    assert ec2_client.calls['disassociate_address'] == 2
+    assert 'InstanceId' not in ec2_client.snapshot()[0]
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
+)
+@patch('kmsauth.KMSTokenValidator.decrypt_token')
+def test_idempotent_request_replayed(decrypt_token):
+    decrypt_token.return_value = GOOD_TOKEN
+    ec2_client = MagicMock()
+    ec2_client.associate_address.return_value = {
+        'AssociationId': 'eipassoc-12345'
+    }
+    event = dict(ASSOCIATE_TEST_REQUEST, idempotency_key='retry-1')
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        first = lambda_handler(event, context=Context, config_file=config_file)
+        second = lambda_handler(
+            event, context=Context, config_file=config_file
+        )
+        assert first == second == {'result': True}
+        assert ec2_client.associate_address.call_count == 1
+        assert decrypt_token.call_count == 1
+        # The same key with a different payload isn't replayed
+        lambda_handler(
+            dict(event, token='othertoken'), context=Context,
+            config_file=config_file
+        )
+        assert decrypt_token.call_count == 2
+
+
+class ShortContext(Context):
+    @staticmethod
+    def get_remaining_time_in_millis():
+        return 1100
+
+
+@patch('awseipext.aws_lambda.lambda_function.handle_request')
+def test_idempotent_request_in_progress(handle_request):
+    event = dict(ASSOCIATE_TEST_REQUEST, idempotency_key='retry-1')
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    ctx = get_runtime(config_file, 'us-west-2')
+    key = lambda_function._get_result_key(event)
+    assert ctx.result_store.begin(key) == (result_store.NEW, None)
+    # Only waits until shortly before the lambda would time out
+    ret = lambda_handler(event, context=ShortContext, config_file=config_file)
+    assert ret == {
+        'result': False,
+        'error': 'A request with this idempotency key is in progress.'
+    }
+    assert not handle_request.called
+
+
+@patch('awseipext.aws_lambda.lambda_function.handle_request')
+def test_idempotent_request_failure_not_recorded(handle_request):
+    handle_request.side_effect = RuntimeError
+    event = dict(ASSOCIATE_TEST_REQUEST, idempotency_key='retry-1')
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    with pytest.raises(RuntimeError):
+        lambda_handler(event, context=Context, config_file=config_file)
+    key = lambda_function._get_result_key(event)
+    assert lambda_function.runtime.result_store.begin(key) == (
+        result_store.NEW,
+        None
+    )
+
+
+@patch('awseipext.aws_lambda.lambda_function.handle_request')
+def test_idempotent_request_transient_failure_not_recorded(handle_request):
+    handle_request.return_value = {
+        'result': False,
+        'error': 'Could not lookup IP.'
+    }
+    event = dict(ASSOCIATE_TEST_REQUEST, idempotency_key='retry-1')
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    lambda_handler(event, context=Context, config_file=config_file)
+    handle_request.return_value = {'result': True}
+    ret = lambda_handler(event, context=Context, config_file=config_file)
+    assert ret == {'result': True}
+    assert handle_request.call_count == 2
+
+
+def test_idempotent_request_invalid_recorded():
+    event = dict(
+        ASSOCIATE_TEST_REQUEST,
+        resource='not-an-ip',
+        idempotency_key='retry-1'
+    )
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    first = lambda_handler(event, context=Context, config_file=config_file)
+    assert first['result'] is False
+    key = lambda_function._get_result_key(event)
+    assert lambda_function.runtime.result_store.begin(key) == (
+        result_store.DONE,
+        first
+    )
+
+
+def _result_sink_config(tmpdir):
+    config_file = tmpdir.join('lambda.cfg')
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/authnz\n'
+        'kmsauth_to_context = alias/authnz\n'
+        'result_sink = file\n'
+        'result_sink_directory = {0}\n'.format(tmpdir.join('results'))
+    )
+    return str(config_file)
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.handle_request',
+    MagicMock(return_value={'result': True})
+)
+def test_result_delivered_to_sink(tmpdir):
+    config_file = _result_sink_config(tmpdir)
+    event = dict(ASSOCIATE_TEST_REQUEST, correlation_id='call-1')
+    ret = lambda_handler(event, context=Context, config_file=config_file)
+    assert ret == {'result': True}
+    sink = result_sink.FileResultSink(str(tmpdir.join('results')))
+    assert sink.poll(['call-1'], 0) == [('call-1', {'result': True})]
+
+
+def test_validation_error_delivered_to_sink(tmpdir):
+    config_file = _result_sink_config(tmpdir)
+    event = dict(ASSOCIATE_TEST_REQUEST, correlation_id='call-1')
+    del event['token']
+    with pytest.raises(ValueError):
+        lambda_handler(event, context=Context, config_file=config_file)
+    sink = result_sink.FileResultSink(str(tmpdir.join('results')))
+    assert sink.poll(['call-1'], 0) == [
+        ('call-1', {'result': False, 'error': 'token is required.'})
+    ]
+
+
+def _kms_client(minutes):
+    # Decrypts every token to a payload valid for another few minutes.
+    now = datetime.datetime.utcnow()
+    payload = {
+        'not_before': (now - datetime.timedelta(minutes=3)).strftime(
+            '%Y%m%dT%H%M%SZ'
+        ),
+        'not_after': (now + datetime.timedelta(minutes=minutes)).strftime(
+            '%Y%m%dT%H%M%SZ'
+        )
+    }
+    key_arn = 'arn:aws:kms:us-west-2:12345:key/authnz'
+    kms_client = MagicMock()
+    kms_client.describe_key.return_value = {'KeyMetadata': {'Arn': key_arn}}
+    kms_client.decrypt.return_value = {
+        'KeyId': key_arn,
+        'Plaintext': json.dumps(payload)
+    }
+    return kms_client
+
+
+# Tokens are base64 encoded ciphertexts.
+KMS_TOKEN = base64.b64encode('ciphertext')
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
+    MagicMock()
+)
+def test_validated_token_reused(monkeypatch):
+    kms_client = _kms_client(5)
+    monkeypatch.setattr(
+        lambda_function,
+        'get_kms_client',
+        MagicMock(return_value=kms_client)
+    )
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    for _ in range(2):
+        assert lambda_handler(
+            dict(ASSOCIATE_TEST_REQUEST, token=KMS_TOKEN), context=Context,
+            config_file=config_file
+        )['result']
+    assert kms_client.decrypt.call_count == 1
+    # A different context or token is validated again
+    lambda_handler(
+        dict(DISASSOCIATE_TEST_REQUEST, token=KMS_TOKEN), context=Context,
+        config_file=config_file
+    )
+    lambda_handler(
+        dict(ASSOCIATE_TEST_REQUEST, token=base64.b64encode('other')),
+        context=Context,
+        config_file=config_file
+    )
+    assert kms_client.decrypt.call_count == 3
+
+
+def test_validators_kept_per_region():
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    ctx = get_runtime(config_file, 'us-west-2')
+    extra_context = {'action': 'associate', 'resource': '10.0.0.1'}
+    validator = ctx.get_validator(extra_context, 'us-east-1')
+    assert ctx.get_validator(extra_context, 'eu-west-1') is not validator
+    assert validator.TOKENS.capacity == \
+        lambda_function.VALIDATOR_TOKEN_CACHE_SIZE
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
+    MagicMock()
+)
+def test_expired_validated_token_not_reused(monkeypatch):
+    kms_client = _kms_client(-1)
+    monkeypatch.setattr(
+        lambda_function,
+        'get_kms_client',
+        MagicMock(return_value=kms_client)
+    )
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    for _ in range(2):
+        assert not lambda_handler(
+            dict(ASSOCIATE_TEST_REQUEST, token=KMS_TOKEN), context=Context,
+            config_file=config_file
+        )['result']
+    assert kms_client.decrypt.call_count == 2
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
+    MagicMock()
+)
+def test_stage_metrics_emitted():
+    sink = metrics.MemorySink()
+    old_sink = metrics.set_sink(sink)
+    try:
+        lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+        lambda_handler(
+            dict(INVALID_TEST_REQUEST, action='bogus'), context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    finally:
+        metrics.set_sink(old_sink)
+    record, invalid_record = sink.records
+    assert record['Action'] == 'associate'
+    assert record['Outcome'] == 'success'
+    assert record['StartType'] == 'warm'
+    assert record['RequestId'] == 'bogus aws_request_id'
+    names = [
+        metric['Name']
+        for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']
+    ]
+    for name in ('ConfigLoad', 'SchemaLoad', 'KmsDecrypt', 'RoleLookup',
+                 'AddressLookup', 'Ec2Mutation', 'Total'):
+        assert name in names
+        assert record[name] >= 0
+    assert invalid_record['Action'] == 'invalid'
+    assert invalid_record['Outcome'] == 'failure'
+    assert 'Ec2Mutation' not in invalid_record
+
+
+def test_stage_metrics_emitted_on_error():
+    sink = metrics.MemorySink()
+    old_sink = metrics.set_sink(sink)
+    try:
+        with pytest.raises(ValueError):
+            lambda_handler(
+                ASSOCIATE_TEST_REQUEST, context=Context,
+                config_file=os.path.join(os.path.dirname(__file__), 'none')
+            )
+    finally:
+        metrics.set_sink(old_sink)
+    assert sink.records[0]['Outcome'] == 'error'
+    assert sink.records[0]['Action'] == 'unknown'
+
+
+def test_ec2_calls_retried_within_lambda_time(monkeypatch):
+    from awseipext.testing.fakes import client_error
+
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.side_effect = [
+        client_error('RequestLimitExceeded', 'DescribeAddresses'),
+        {'Addresses': []}
+    ]
+    monkeypatch.setitem(lambda_function.ec2_clients, None, ec2_client)
+    monkeypatch.setattr(lambda_function.ec2_retrier, 'base_delay', 0.001)
+    assert lambda_function.get_ec2_client().describe_addresses() == {
+        'Addresses': []
+    }
+    assert ec2_client.describe_addresses.call_count == 2
+
+    deadline = lambda_function._get_ec2_deadline(ShortContext)
+    assert 0 < deadline - time.time() <= 0.1
+    assert lambda_function._get_ec2_deadline(Context) is None
+
+    # Each invocation's calls keep to its own deadline, though they share
+    # the region's retrier.
+    ec2_client.describe_addresses.side_effect = None
+    ec2_client.describe_addresses.return_value = {'Addresses': []}
+    late = lambda_function.get_ec2_client(deadline=time.time() - 1)
+    with pytest.raises(botocore.exceptions.ClientError):
+        late.describe_addresses()
+    assert lambda_function.get_ec2_client(
+        deadline=time.time() + 10
+    ).describe_addresses() == {'Addresses': []}
+    assert ec2_client.describe_addresses.call_count == 3
+
+
+MOVE_TEST_REQUEST = dict(ASSOCIATE_TEST_REQUEST, action='move')
+
+
+def _roles(**roles):
+    return lambda instance_id, region=None, deadline=None: roles.get(
+        instance_id.replace('-', '_'),
+        'test-development-iad'
+    )
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch('awseipext.aws_lambda.lambda_function.get_ec2_client')
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=OTHER_ASSOCIATED_ADDRESS)
+)
+@patch('awseipext.aws_lambda.lambda_function.get_role_name')
+def test_move_request(get_role_name, get_ec2_client):
+    get_role_name.side_effect = _roles()
+    ec2_client = get_ec2_client.return_value
+    ec2_client.associate_address.return_value = {
+        'AssociationId': 'eipassoc-12345'
+    }
+    ret = lambda_handler(
+        MOVE_TEST_REQUEST, context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert ret['result']
+    lambda_function.get_address.assert_called_once_with(
+        '10.0.0.1',
+        fresh=True,
+        region=None,
+        deadline=ANY
+    )
+    # EC2 calls under the lease stop before it expires.
+    deadline = lambda_function.get_address.call_args[1]['deadline']
+    assert deadline <= time.time() + lambda_function.runtime.lease_duration
+    assert sorted(c[0][0] for c in get_role_name.call_args_list) == [
+        'i-12345', 'i-56789'
+    ]
+    ec2_client.associate_address.assert_called_once_with(
+        InstanceId='i-12345',
+        AllocationId='eipalloc-12345',
+        AllowReassociation=True
+    )
+    assert not ec2_client.disassociate_address.called
+    assert lambda_function.address_inventory.get(
+        '10.0.0.1'
+    ) == ASSOCIATED_ADDRESS
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch('awseipext.aws_lambda.lambda_function.get_ec2_client')
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=OTHER_ASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(side_effect=_roles(i_56789='other-role'))
+)
+def test_move_request_from_other_role(get_ec2_client):
+    ret = lambda_handler(
+        MOVE_TEST_REQUEST, context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert not ret['result']
+    assert ret['error'].startswith('Instance is not in role (other-role)')
+    assert not get_ec2_client.return_value.associate_address.called
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch('awseipext.aws_lambda.lambda_function.get_ec2_client')
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=UNASSOCIATED_ADDRESS)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(side_effect=_roles())
+)
+def test_move_unassociated_request(get_ec2_client):
+    ret = lambda_handler(
+        MOVE_TEST_REQUEST, context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert ret['result']
+    get_ec2_client.return_value.associate_address.assert_called_once_with(
+        InstanceId='i-12345',
+        AllocationId='eipalloc-12345'
+    )
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_batch_move_request():
+    from awseipext.testing.fakes import FakeEC2Client
+
+    profile = 'arn:aws:iam::12345:instance-profile/{0}'
+    ec2_client = FakeEC2Client(
+        addresses=[
+            {
+                'PublicIp': '10.0.0.1',
+                'AllocationId': 'eipalloc-1',
+                'AssociationId': 'eipassoc-1',
+                'InstanceId': 'i-12345',
+                'Domain': 'vpc'
+            },
+            {
+                'PublicIp': '10.0.0.2',
+                'AllocationId': 'eipalloc-2',
+                'AssociationId': 'eipassoc-2',
+                'InstanceId': 'i-99999',
+                'Domain': 'vpc'
+            }
+        ],
+        instances={
+            'i-12345': profile.format('test-development-iad'),
+            'i-67890': profile.format('test-development-iad'),
+            'i-99999': profile.format('other-role')
+        }
+    )
+    event = {
+        'operations': [
+            dict(MOVE_TEST_REQUEST, instance_id='i-67890'),
+            dict(MOVE_TEST_REQUEST, instance_id='i-67890', resource='10.0.0.2')
+        ]
+    }
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            event, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    first, second = ret['results']
+    assert first['result']
+    assert not second['result']
+    assert second['error'].startswith('Instance is not in role (other-role)')
+    assert [a.get('InstanceId') for a in ec2_client.snapshot()] == [
+        'i-67890', 'i-99999'
+    ]
+    assert ec2_client.calls['associate_address'] == 1
+    assert not ec2_client.calls['disassociate_address']
+
+
+def _reconcile_ec2_client():
+    from awseipext.testing.fakes import FakeEC2Client
+
+    profile = 'arn:aws:iam::12345:instance-profile/{0}'
+    addresses = []
+    for i, instance_id in enumerate(
+            ['i-12345', None, 'i-12345', 'i-12345', 'i-99999'], 1):
+        address = {
+            'PublicIp': '10.0.0.{0}'.format(i),
+            'AllocationId': 'eipalloc-{0}'.format(i),
+            'Domain': 'vpc'
+        }
+        if instance_id:
+            address.update({
+                'AssociationId': 'eipassoc-f{0}'.format(i),
+                'InstanceId': instance_id
+            })
+        addresses.append(address)
+    return FakeEC2Client(
+        addresses=addresses,
+        instances={
+            'i-12345': profile.format('test-development-iad'),
+            'i-67890': profile.format('test-development-iad'),
+            'i-99999': profile.format('other-role')
+        }
+    )
+
+
+RECONCILE_TEST_REQUEST = {
+    'action': 'reconcile',
+    'mapping': {
+        '10.0.0.1': 'i-12345',
+        '10.0.0.2': 'i-12345',
+        '10.0.0.3': None,
+        '10.0.0.4': 'i-67890',
+        '10.0.0.5': 'i-12345',
+        '10.0.0.6': 'i-12345'
+    },
+    'username': '2/service/test-development-iad',
+    'token': 'faketoken'
+}
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@pytest.mark.parametrize('dry_run', [False, True])
+def test_reconcile_request(dry_run):
+    ec2_client = _reconcile_ec2_client()
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            dict(RECONCILE_TEST_REQUEST, dry_run=dry_run), context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    assert not ret['result']
+    assert ret['dry_run'] == dry_run
+    assert ret['plan'] == {
+        'none': 1,
+        'associate': 1,
+        'disassociate': 1,
+        'reassociate': 2
+    }
+    results = dict((r['resource'], r) for r in ret['results'])
+    assert [results['10.0.0.{0}'.format(i)]['change'] for i in range(1, 7)] \
+        == ['none', 'associate', 'disassociate', 'reassociate',
+            'reassociate', None]
+    assert results['10.0.0.5']['error'].startswith(
+        'Instance is not in role (other-role)'
+    )
+    assert results['10.0.0.6']['error'] == 'Could not find IP.'
+    # The current instance is only reported for IPs the token may act on.
+    assert results['10.0.0.4']['current_instance_id'] == 'i-12345'
+    assert results['10.0.0.2']['current_instance_id'] is None
+    assert 'current_instance_id' not in results['10.0.0.5']
+    assert 'current_instance_id' not in results['10.0.0.6']
+    # One snapshot, and one lookup for every instance involved.
+    assert ec2_client.calls['describe_addresses'] == 1
+    assert ec2_client.calls['describe_instances'] == 1
+    instances = [a.get('InstanceId') for a in ec2_client.snapshot()]
+    if dry_run:
+        assert instances == [
+            'i-12345', None, 'i-12345', 'i-12345', 'i-99999'
+        ]
+        assert not ec2_client.calls['associate_address']
+    else:
+        assert instances == [
+            'i-12345', 'i-12345', None, 'i-67890', 'i-99999'
+        ]
+        assert ec2_client.calls['associate_address'] == 2
+        assert ec2_client.calls['disassociate_address'] == 1
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_reconcile_unchanged_ip_checks_role():
+    ec2_client = _reconcile_ec2_client()
+    with patch(
+        'awseipext.aws_lambda.lambda_function.get_ec2_client',
+        MagicMock(return_value=ec2_client)
+    ):
+        ret = lambda_handler(
+            dict(
+                RECONCILE_TEST_REQUEST,
+                mapping={'10.0.0.5': 'i-99999'},
+                dry_run=True
+            ),
+            context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    assert not ret['result']
+    result = ret['results'][0]
+    assert result['change'] == 'none'
+    assert result['error'].startswith('Instance is not in role (other-role)')
+    assert 'current_instance_id' not in result
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_request_for_other_region(monkeypatch):
+    from awseipext.testing.fakes import FakeEC2Client
+
+    profile = 'arn:aws:iam::12345:instance-profile/test-development-iad'
+    local = FakeEC2Client(addresses=[], instances={})
+    remote = FakeEC2Client(
+        addresses=[{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'Domain': 'vpc'
+        }],
+        instances={'i-12345': profile}
+    )
+    monkeypatch.setitem(lambda_function.ec2_clients, None, local)
+    monkeypatch.setitem(lambda_function.ec2_clients, 'eu-west-1', remote)
+    monkeypatch.setitem(
+        lambda_function.region_states,
+        'eu-west-1',
+        lambda_function.RegionState()
+    )
+    ret = lambda_handler(
+        dict(ASSOCIATE_TEST_REQUEST, region='eu-west-1'), context=Context,
+        config_file=os.path.join(
+            os.path.dirname(__file__),
+            'lambda-test.cfg'
+        )
+    )
+    assert ret['result']
+    assert remote.calls['associate_address'] == 1
+    assert not local.calls
+    state = lambda_function.region_states['eu-west-1']
+    assert state.address_inventory.get('10.0.0.1').instance_id == 'i-12345'
+    assert state.role_cache.lookup('i-12345') == (
+        True,
+        'test-development-iad'
+    )
+    # The token is checked against the region's KMS key.
+    found, validator = lambda_function.runtime.validators.lookup((
+        'eu-west-1',
+        ('action', 'associate'),
+        ('resource', '10.0.0.1')
+    ))
+    assert found
+    assert validator.region == 'eu-west-1'
+
+
+def test_request_for_invalid_region():
+    from awseipext.request.validator import ValidationError
+
+    with pytest.raises(ValidationError):
+        lambda_handler(
+            dict(ASSOCIATE_TEST_REQUEST, region='moon-1'), context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+def test_leased_request_reads_current_state(monkeypatch, tmpdir):
+    from awseipext.testing.fakes import FakeEC2Client
+
+    config_file = tmpdir.join('lambda.cfg')
+    config_file.write(
+        '[lambda_config]\n'
+        'kmsauth_key = alias/authnz\n'
+        'kmsauth_to_context = alias/authnz\n'
+        'lease_store = file\n'
+        'lease_directory = {0}\n'.format(tmpdir.join('leases'))
+    )
+
+    ec2_client = FakeEC2Client(
+        addresses=[{
+            'PublicIp': '10.0.0.1',
+            'AllocationId': 'eipalloc-12345',
+            'Domain': 'vpc'
+        }],
+        instances={'i-12345': None}
+    )
+    monkeypatch.setitem(lambda_function.ec2_clients, None, ec2_client)
+    # The inventory still has the IP on the instance, after it was
+    # disassociated elsewhere.
+    lambda_function.address_inventory.load([{
+        'PublicIp': '10.0.0.1',
+        'AllocationId': 'eipalloc-12345',
+        'AssociationId': 'eipassoc-12345',
+        'InstanceId': 'i-12345',
+        'Domain': 'vpc'
+    }])
+    ret = lambda_handler(
+        ASSOCIATE_TEST_REQUEST, context=Context,
+        config_file=str(config_file)
+    )
+    assert ret['result']
+    # The IP was described under its lease, not trusted from the inventory.
+    assert ec2_client.calls['describe_addresses'] == 1
+    assert ec2_client.calls['associate_address'] == 1
+    assert ec2_client.snapshot()[0]['InstanceId'] == 'i-12345'
+
+
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_role_name',
+    MagicMock(return_value='test-development-iad')
+)
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_address',
+    MagicMock(return_value=ASSOCIATED_ADDRESS)
+)
+def test_request_waits_for_lease(monkeypatch):
+    config_file = os.path.join(os.path.dirname(__file__), 'lambda-test.cfg')
+    ctx = get_runtime(config_file, 'us-west-2')
+    monkeypatch.setattr(ctx, 'lease_wait', 0.05)
+    store = ctx.lease_store
+    assert store.try_acquire('us-west-2:10.0.0.1', 'other', 60)
+    try:
+        ret = lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=config_file
+        )
+        assert ret == {
+            'result': False,
+            'error': 'IP is in use by another request.'
+        }
+        assert not lambda_function.get_address.called
+
+        # Requests queue for the IP rather than failing.
+        monkeypatch.setattr(ctx, 'lease_wait', 5)
+        timer = threading.Timer(
+            0.05,
+            lambda: store.release('us-west-2:10.0.0.1', 'other')
+        )
+        timer.start()
+        ret = lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=config_file
+        )
+        timer.join()
+        assert ret['result']
+    finally:
+        store.release('us-west-2:10.0.0.1', 'other')
+    # The lease is released afterwards.
+    assert store.leases == {}
+
+
+@patch(
+    'kmsauth.KMSTokenValidator.decrypt_token',
+    MagicMock(return_value=GOOD_TOKEN)
+)
+@patch(
+    'awseipext.aws_lambda.lambda_function.get_ec2_client',
+    MagicMock()
+)
+def test_role_and_address_lookups_overlap(monkeypatch):
+    def slow(value):
+        def lookup(*args, **kwargs):
+            time.sleep(0.2)
+            return value
+        return lookup
+
+    monkeypatch.setattr(
+        lambda_function,
+        'get_role_name',
+        slow('test-development-iad')
+    )
+    monkeypatch.setattr(
+        lambda_function,
+        'get_address',
+        slow(UNASSOCIATED_ADDRESS)
+    )
+    sink = metrics.MemorySink()
+    old_sink = metrics.set_sink(sink)
+    start = time.time()
+    try:
+        ret = lambda_handler(
+            ASSOCIATE_TEST_REQUEST, context=Context,
+            config_file=os.path.join(
+                os.path.dirname(__file__),
+                'lambda-test.cfg'
+            )
+        )
+    finally:
+        metrics.set_sink(old_sink)
+    assert ret['result']
+    assert time.time() - start < 0.35
+    # Each lookup is timed for its own duration, not its wait.
+    record = sink.records[0]
+    assert record['RoleLookup'] >= 200
+    assert record['AddressLookup'] >= 200
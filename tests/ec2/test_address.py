@@ -0,0 +1,31 @@
+from awseipext.ec2.address import Address
+
+
+def test_address_from_vpc_description():
+    addr = Address.from_description({
+        'PublicIp': '10.0.0.1',
+        'AllocationId': 'eipalloc-12345',
+        'AssociationId': 'eipassoc-12345',
+        'InstanceId': 'i-12345',
+        'NetworkInterfaceId': 'eni-12345',
+        'Domain': 'vpc'
+    })
+    assert addr.public_ip == '10.0.0.1'
+    assert addr.allocation_id == 'eipalloc-12345'
+    assert addr.association_id == 'eipassoc-12345'
+    assert addr.instance_id == 'i-12345'
+    assert addr.network_interface_id == 'eni-12345'
+    assert addr.domain == 'vpc'
+
+
+def test_address_from_unassociated_description():
+    # Classic addresses report an empty InstanceId when unassociated.
+    addr = Address.from_description({
+        'PublicIp': '10.0.0.1',
+        'InstanceId': '',
+        'Domain': 'standard'
+    })
+    assert addr.instance_id is None
+    assert addr.allocation_id is None
+    assert addr.association_id is None
+    assert addr == Address('10.0.0.1', domain='standard')
@@ -0,0 +1,84 @@
+from mock import MagicMock
+
+from awseipext.ec2.address import Address
+from awseipext.ec2.inventory import AddressInventory
+
+ADDRESSES = [
+    {
+        'PublicIp': '10.0.0.1',
+        'AllocationId': 'eipalloc-1',
+        'AssociationId': 'eipassoc-1',
+        'InstanceId': 'i-12345',
+        'Domain': 'vpc'
+    },
+    {
+        'PublicIp': '10.0.0.2',
+        'AllocationId': 'eipalloc-2',
+        'AssociationId': 'eipassoc-2',
+        'InstanceId': 'i-12345',
+        'Domain': 'vpc'
+    },
+    {
+        'PublicIp': '10.0.0.3',
+        'AllocationId': 'eipalloc-3',
+        'Domain': 'vpc'
+    }
+]
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_inventory_indexes():
+    inventory = AddressInventory(60)
+    inventory.load(ADDRESSES)
+    assert len(inventory) == 3
+    assert inventory.get('10.0.0.3').allocation_id == 'eipalloc-3'
+    assert inventory.get('10.0.0.4') is None
+    assert inventory.get_by_allocation_id('eipalloc-2').public_ip == (
+        '10.0.0.2'
+    )
+    assert [a.public_ip for a in inventory.get_by_instance_id('i-12345')] == [
+        '10.0.0.1', '10.0.0.2'
+    ]
+
+
+def test_inventory_update():
+    inventory = AddressInventory(60)
+    inventory.load(ADDRESSES)
+    inventory.update(Address('10.0.0.1', allocation_id='eipalloc-1'))
+    inventory.update(Address(
+        '10.0.0.3',
+        allocation_id='eipalloc-3',
+        association_id='eipassoc-3',
+        instance_id='i-67890'
+    ))
+    assert [a.public_ip for a in inventory.get_by_instance_id('i-12345')] == [
+        '10.0.0.2'
+    ]
+    assert [a.public_ip for a in inventory.get_by_instance_id('i-67890')] == [
+        '10.0.0.3'
+    ]
+    assert inventory.get('10.0.0.1').instance_id is None
+
+
+def test_inventory_refresh():
+    clock = Clock()
+    ec2_client = MagicMock()
+    ec2_client.describe_addresses.return_value = {'Addresses': ADDRESSES}
+    inventory = AddressInventory(60, clock=clock)
+    assert inventory.is_stale()
+    inventory.refresh(ec2_client)
+    inventory.refresh(ec2_client)
+    assert ec2_client.describe_addresses.call_count == 1
+    clock.now += 60
+    inventory.refresh(ec2_client)
+    assert ec2_client.describe_addresses.call_count == 2
+    inventory.invalidate()
+    inventory.refresh(ec2_client)
+    assert ec2_client.describe_addresses.call_count == 3
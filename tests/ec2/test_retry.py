@@ -0,0 +1,179 @@
+import botocore.exceptions
+import pytest
+
+from awseipext.ec2 import retry
+from awseipext.ec2.retry import AdaptiveTokenBucket, Retrier, RetryingClient
+from awseipext.testing.fakes import FakeEC2Client, client_error
+
+ADDRESS = {
+    'PublicIp': '198.51.100.1',
+    'AllocationId': 'eipalloc-1',
+    'Domain': 'vpc'
+}
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _retrier(clock, rate=100, **kwargs):
+    bucket = AdaptiveTokenBucket(rate, clock=clock, sleep=clock.sleep)
+    return Retrier(bucket, clock=clock, sleep=clock.sleep, seed=1, **kwargs)
+
+
+class Flaky(object):
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def test_classify_error():
+    assert retry.classify_error(
+        client_error('RequestLimitExceeded', 'DescribeAddresses')
+    ) == retry.THROTTLE
+    assert retry.classify_error(
+        client_error('InternalError', 'DescribeAddresses')
+    ) == retry.TRANSIENT
+    assert retry.classify_error(
+        botocore.exceptions.EndpointConnectionError(endpoint_url='x')
+    ) == retry.TRANSIENT
+    assert retry.classify_error(
+        client_error('InvalidAddress.NotFound', 'DescribeAddresses')
+    ) == retry.PERMANENT
+    assert retry.classify_error(ValueError()) == retry.PERMANENT
+
+
+def test_bucket_waits_for_tokens():
+    clock = Clock()
+    bucket = AdaptiveTokenBucket(2, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert bucket.acquire()
+    assert abs(clock.now - 1000.5) < 1e-9
+    assert not bucket.acquire(deadline=clock.now + 0.1)
+
+
+def test_bucket_adapts_to_throttles():
+    clock = Clock()
+    bucket = AdaptiveTokenBucket(8, min_rate=1, increase=1, clock=clock)
+    for _ in range(5):
+        bucket.on_throttle()
+    assert bucket.rate == 1
+    for _ in range(20):
+        bucket.on_success()
+    assert bucket.rate == 8
+
+
+def test_retries_throttles_with_backoff():
+    clock = Clock()
+    retrier = _retrier(clock)
+    function = Flaky(
+        client_error('RequestLimitExceeded', 'AssociateAddress'),
+        client_error('RequestLimitExceeded', 'AssociateAddress')
+    )
+    assert retrier.call(
+        'associate_address',
+        function,
+        retry_transient=False
+    ) == 'ok'
+    assert function.calls == 3
+    assert retrier.retries == retrier.throttles == 2
+    assert retrier.bucket.rate < 100
+    assert all(
+        retrier.base_delay <= delay <= retrier.max_delay
+        for delay in clock.sleeps
+    )
+
+
+def test_transient_errors_only_retried_when_safe():
+    clock = Clock()
+    retrier = _retrier(clock)
+    error = client_error('InternalError', 'AssociateAddress')
+    assert retrier.call('describe_addresses', Flaky(error)) == 'ok'
+    function = Flaky(error)
+    with pytest.raises(botocore.exceptions.ClientError):
+        retrier.call('associate_address', function, retry_transient=False)
+    assert function.calls == 1
+
+
+def test_permanent_errors_not_retried():
+    clock = Clock()
+    function = Flaky(client_error('InvalidAddress.NotFound', 'Describe'))
+    with pytest.raises(botocore.exceptions.ClientError):
+        _retrier(clock).call('describe_addresses', function)
+    assert function.calls == 1
+
+
+def test_retries_stop_at_max_attempts():
+    clock = Clock()
+    function = Flaky(
+        *[client_error('RequestLimitExceeded', 'Describe')] * 10
+    )
+    with pytest.raises(botocore.exceptions.ClientError):
+        _retrier(clock, max_attempts=3).call('describe_addresses', function)
+    assert function.calls == 3
+
+
+def test_retries_stop_at_deadline():
+    clock = Clock()
+    retrier = _retrier(clock, base_delay=1, max_delay=1)
+    deadline = clock.now + 2.5
+    function = Flaky(
+        *[client_error('RequestLimitExceeded', 'Describe')] * 10
+    )
+    with pytest.raises(botocore.exceptions.ClientError):
+        retrier.call('describe_addresses', function, deadline=deadline)
+    assert function.calls == 3
+    assert clock.now <= deadline
+
+
+def test_rate_limited_at_deadline():
+    clock = Clock()
+    retrier = _retrier(clock, rate=1)
+    deadline = clock.now + 0.5
+    assert retrier.call(
+        'describe_addresses',
+        Flaky(),
+        deadline=deadline
+    ) == 'ok'
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+        retrier.call('describe_addresses', Flaky(), deadline=deadline)
+    assert retry.classify_error(e.value) == retry.THROTTLE
+    # Another caller's deadline doesn't apply.
+    assert retrier.call('describe_addresses', Flaky()) == 'ok'
+
+
+def test_retrying_client():
+    clock = Clock()
+    ec2 = FakeEC2Client(
+        addresses=[ADDRESS],
+        instances={'i-1': None},
+        error_rate=0.5,
+        seed=3
+    )
+    client = RetryingClient(ec2, _retrier(clock, max_attempts=20))
+    for _ in range(5):
+        assert client.describe_addresses()['Addresses'][0]['PublicIp'] == \
+            '198.51.100.1'
+        pages = client.get_paginator('describe_instances').paginate(
+            InstanceIds=['i-1']
+        )
+        assert pages[0]['Reservations'][0]['Instances'][0]['InstanceId'] == \
+            'i-1'
+    assert ec2.total_calls > 10
+    # Other attributes are passed through
+    assert client.snapshot() == [ADDRESS]
@@ -0,0 +1,36 @@
+import pytest
+from marshmallow import ValidationError
+
+from awseipext.request.lambda_request import LambdaBatchSchema
+from awseipext.request.lambda_request import LambdaRequest
+from awseipext.request.lambda_request import MAX_BATCH_SIZE
+
+OPERATION = {
+    "action": "associate",
+    "resource": "10.0.0.1",
+    "instance_id": "i-12345",
+    "username": "2/service/test-development-iad",
+    "token": "faketoken"
+}
+
+
+def test_batch_schema():
+    batch = LambdaBatchSchema(strict=True).load(
+        {'operations': [OPERATION, dict(OPERATION, resource='10.0.0.2')]}
+    ).data
+    assert batch.operations == [
+        LambdaRequest(**OPERATION),
+        LambdaRequest(**dict(OPERATION, resource='10.0.0.2'))
+    ]
+
+
+def test_batch_schema_empty():
+    with pytest.raises(ValidationError):
+        LambdaBatchSchema(strict=True).load({'operations': []})
+
+
+def test_batch_schema_too_large():
+    with pytest.raises(ValidationError):
+        LambdaBatchSchema(strict=True).load(
+            {'operations': [OPERATION] * (MAX_BATCH_SIZE + 1)}
+        )
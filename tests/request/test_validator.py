@@ -0,0 +1,180 @@
+import pytest
+from marshmallow import ValidationError as SchemaValidationError
+
+from awseipext.request.lambda_request import LambdaBatchSchema
+from awseipext.request.lambda_request import LambdaSchema
+from awseipext.request.validator import LambdaRequest
+from awseipext.request.validator import MAX_BATCH_SIZE
+from awseipext.request.validator import ValidationError
+from awseipext.request.validator import get_mapping_digest
+from awseipext.request.validator import get_reconcile_error
+from awseipext.request.validator import get_request_error
+from awseipext.request.validator import load_batch_request
+from awseipext.request.validator import load_correlation_id
+from awseipext.request.validator import load_idempotency_key
+from awseipext.request.validator import load_reconcile_request
+from awseipext.request.validator import load_region
+from awseipext.request.validator import load_request
+
+OPERATION = {
+    "action": "associate",
+    "resource": "10.0.0.1",
+    "instance_id": "i-12345",
+    "username": "2/service/test-development-iad",
+    "token": "faketoken"
+}
+
+
+def test_load_request_matches_schema():
+    assert load_request(OPERATION) == \
+        LambdaSchema(strict=True).load(OPERATION).data
+
+
+def test_load_request_ignores_extra_keys():
+    assert load_request(dict(OPERATION, extra='value')) == \
+        LambdaRequest(**OPERATION)
+
+
+def test_load_batch_request_matches_schema():
+    event = {'operations': [OPERATION, dict(OPERATION, resource='10.0.0.2')]}
+    assert load_batch_request(event) == \
+        LambdaBatchSchema(strict=True).load(event).data
+
+
+@pytest.mark.parametrize('event', [
+    dict(OPERATION, action=1),
+    dict(OPERATION, resource=None),
+    dict(OPERATION, token=['faketoken']),
+    'not a dict'
+])
+def test_load_request_rejects_what_schema_rejects(event):
+    with pytest.raises(SchemaValidationError):
+        LambdaSchema(strict=True).load(event)
+    with pytest.raises(ValidationError):
+        load_request(event)
+
+
+def test_load_request_missing_field():
+    event = dict(OPERATION)
+    del event['username']
+    with pytest.raises(ValidationError):
+        load_request(event)
+
+
+@pytest.mark.parametrize('event', [
+    {},
+    {'operations': OPERATION},
+    {'operations': []},
+    {'operations': [OPERATION] * (MAX_BATCH_SIZE + 1)},
+    {'operations': [OPERATION, dict(OPERATION, instance_id=None)]}
+])
+def test_load_batch_request_invalid(event):
+    with pytest.raises(ValidationError):
+        load_batch_request(event)
+
+
+def test_request_is_immutable():
+    request = load_request(OPERATION)
+    with pytest.raises(AttributeError):
+        request.action = 'disassociate'
+    with pytest.raises(AttributeError):
+        request.extra = 'value'
+    assert not hasattr(request, '__dict__')
+    assert hash(request) == hash(LambdaRequest(**OPERATION))
+
+
+def test_request_repr_hides_token():
+    assert 'faketoken' not in repr(load_request(OPERATION))
+
+
+@pytest.mark.parametrize('changes,error', [
+    ({}, None),
+    ({'action': 'move'}, None),
+    ({'resource': '255.255.255.255'}, None),
+    ({'instance_id': 'i-0123456789abcdef0'}, None),
+    ({'action': 'invalid'}, 'invalid is not a valid action.'),
+    ({'resource': '10.0.0.256'}, '10.0.0.256 is not a valid IP address.'),
+    ({'resource': '10.0.0'}, '10.0.0 is not a valid IP address.'),
+    ({'resource': '10.0.0.1\n'}, '10.0.0.1\n is not a valid IP address.'),
+    ({'instance_id': 'i-XYZ'}, 'i-XYZ is not a valid instance id.'),
+    ({'instance_id': '12345'}, '12345 is not a valid instance id.')
+])
+def test_get_request_error(changes, error):
+    request = load_request(dict(OPERATION, **changes))
+    assert get_request_error(request) == error
+
+
+def test_load_idempotency_key():
+    assert load_idempotency_key(OPERATION) is None
+    assert load_idempotency_key(dict(OPERATION, idempotency_key='a')) == 'a'
+    for key in ('', 'a' * 257, 1):
+        with pytest.raises(ValidationError):
+            load_idempotency_key(dict(OPERATION, idempotency_key=key))
+
+
+def test_load_correlation_id():
+    assert load_correlation_id(OPERATION) is None
+    assert load_correlation_id(dict(OPERATION, correlation_id='a')) == 'a'
+    with pytest.raises(ValidationError):
+        load_correlation_id(dict(OPERATION, correlation_id=''))
+
+
+@pytest.mark.parametrize('region', [
+    'us-east-1',
+    'eu-west-2',
+    'ap-southeast-1',
+    'us-gov-west-1'
+])
+def test_load_region(region):
+    assert load_region(OPERATION) is None
+    assert load_region(dict(OPERATION, region=region)) == region
+
+
+@pytest.mark.parametrize('region', ['', 'us-east', 'US-EAST-1', 1])
+def test_load_region_invalid(region):
+    with pytest.raises(ValidationError):
+        load_region(dict(OPERATION, region=region))
+
+
+RECONCILE_REQUEST = {
+    'action': 'reconcile',
+    'mapping': {'10.0.0.1': 'i-12345', '10.0.0.2': None},
+    'username': '2/service/test-development-iad',
+    'token': 'faketoken'
+}
+
+
+def test_load_reconcile_request():
+    request = load_reconcile_request(RECONCILE_REQUEST)
+    assert request.action == 'reconcile'
+    assert request.mapping == RECONCILE_REQUEST['mapping']
+    assert not request.dry_run
+    assert request.resource == get_mapping_digest(
+        {'10.0.0.2': None, '10.0.0.1': 'i-12345'}
+    )
+    assert request.resource != get_mapping_digest({'10.0.0.1': 'i-12345'})
+    assert load_reconcile_request(
+        dict(RECONCILE_REQUEST, dry_run=True)
+    ).dry_run
+
+
+@pytest.mark.parametrize('changes', [
+    {'mapping': {}},
+    {'mapping': ['10.0.0.1']},
+    {'mapping': {'10.0.0.1': 1}},
+    {'token': None},
+    {'dry_run': 'yes'}
+])
+def test_load_reconcile_request_invalid(changes):
+    with pytest.raises(ValidationError):
+        load_reconcile_request(dict(RECONCILE_REQUEST, **changes))
+
+
+@pytest.mark.parametrize('mapping,error', [
+    ({'10.0.0.1': 'i-12345', '10.0.0.2': None}, None),
+    ({'10.0.0.256': None}, '10.0.0.256 is not a valid IP address.'),
+    ({'10.0.0.1': 'i-XYZ'}, 'i-XYZ is not a valid instance id.')
+])
+def test_get_reconcile_error(mapping, error):
+    request = load_reconcile_request(dict(RECONCILE_REQUEST, mapping=mapping))
+    assert get_reconcile_error(request) == error
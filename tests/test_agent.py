@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+from mock import MagicMock
+
+from awseipext import agent
+
+
+class BlockingClient(object):
+    """Stands in for AwseipextClient, holding calls until released."""
+
+    function_name = 'awseipext'
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _call(self, action, resource, instance_id):
+        with self.lock:
+            self.calls.append((action, resource, instance_id))
+        self.release.wait(5)
+        return json.dumps({'result': True, 'action': action})
+
+    def associate(self, resource, instance_id):
+        return self._call('associate', resource, instance_id)
+
+    def disassociate(self, resource, instance_id):
+        return self._call('disassociate', resource, instance_id)
+
+
+def _start(function, *args):
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(function(*args))
+    )
+    thread.start()
+    return thread, results
+
+
+def _wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError('Timed out.')
+
+
+def test_duplicate_calls_coalesced():
+    client = BlockingClient()
+    eip_agent = agent.EIPAgent(client)
+    threads = [
+        _start(eip_agent.call, 'associate', '10.0.0.1', 'i-12345')
+        for _ in range(3)
+    ]
+    _wait_for(lambda: eip_agent.coalesced == 2)
+    client.release.set()
+    for thread, results in threads:
+        thread.join()
+        assert results == ['{"action": "associate", "result": true}']
+    assert client.calls == [('associate', '10.0.0.1', 'i-12345')]
+    assert eip_agent.calls == {}
+
+
+def test_conflicting_calls_serialized():
+    client = BlockingClient()
+    eip_agent = agent.EIPAgent(client)
+    first = _start(eip_agent.call, 'associate', '10.0.0.1', 'i-12345')
+    _wait_for(lambda: len(client.calls) == 1)
+    second = _start(eip_agent.call, 'disassociate', '10.0.0.1', 'i-12345')
+    # Calls for other IPs aren't held up.
+    other = _start(eip_agent.call, 'associate', '10.0.0.2', 'i-12345')
+    _wait_for(lambda: len(client.calls) == 2)
+    assert client.calls[1][1] == '10.0.0.2'
+    client.release.set()
+    for thread, _ in (first, second, other):
+        thread.join()
+    assert client.calls[2] == ('disassociate', '10.0.0.1', 'i-12345')
+
+
+def test_errors_shared():
+    client = MagicMock()
+    client.associate.side_effect = RuntimeError('boom')
+    eip_agent = agent.EIPAgent(client)
+    with pytest.raises(RuntimeError):
+        eip_agent.call('associate', '10.0.0.1', 'i-12345')
+    assert eip_agent.calls == {}
+    with pytest.raises(ValueError):
+        eip_agent.call('bogus', '10.0.0.1', 'i-12345')
+
+
+def test_refresh_tokens():
+    client = MagicMock()
+    client.warm_token.return_value = True
+    eip_agent = agent.EIPAgent(
+        client,
+        warm_resources=['10.0.0.1'],
+        refresh_interval=30
+    )
+    assert eip_agent.refresh_tokens() == 2
+    client.warm_token.assert_any_call('associate', '10.0.0.1', min_ttl=60)
+    client.warm_token.assert_any_call('disassociate', '10.0.0.1', min_ttl=60)
+    # IPs that have been used are kept warm too.
+    eip_agent.call('move', '10.0.0.2', 'i-12345')
+    assert eip_agent.refresh_tokens() == 3
+    client.warm_token.assert_any_call('move', '10.0.0.2', min_ttl=60)
+    # Until they go unused for the warm TTL.
+    eip_agent.warm[('move', '10.0.0.2')] -= eip_agent.warm_ttl + 1
+    assert eip_agent.refresh_tokens() == 2
+    assert eip_agent.warm == {}
+
+
+def test_server_socket_mode(tmpdir):
+    path = str(tmpdir.join('agent.sock'))
+    server = agent.AgentServer(
+        path,
+        agent.EIPAgent(MagicMock()),
+        workers=1,
+        mode=0o600
+    )
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    finally:
+        server.server_close()
+
+
+def test_server(request, tmpdir):
+    client = MagicMock()
+    client.associate.return_value = '{"result": true}'
+    path = str(tmpdir.join('agent.sock'))
+    server = agent.AgentServer(path, agent.EIPAgent(client), workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    request.addfinalizer(stop)
+
+    agent_client = agent.AgentClient(path, timeout=10)
+    assert agent_client.associate('10.0.0.1', 'i-12345') == '{"result": true}'
+    client.associate.assert_called_once_with('10.0.0.1', 'i-12345')
+    client.disassociate.side_effect = RuntimeError('boom')
+    with pytest.raises(RuntimeError) as e:
+        agent_client.disassociate('10.0.0.1', 'i-12345')
+    assert '502' in str(e.value)
+    with pytest.raises(RuntimeError) as e:
+        agent_client._call('associate', ['10.0.0.1'], 'i-12345')
+    assert '400' in str(e.value)
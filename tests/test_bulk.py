@@ -0,0 +1,78 @@
+import json
+from StringIO import StringIO
+
+from mock import MagicMock
+
+from awseipext import bulk
+
+
+def test_read_operations_jsonl():
+    stream = StringIO(
+        '{"action": "associate", "resource": "10.0.0.1",'
+        ' "instance_id": "i-12345"}\n'
+        '\n'
+        'not json\n'
+    )
+    operations = list(bulk.read_operations(stream, 'jsonl'))
+    assert operations == [
+        (1, {
+            'action': 'associate',
+            'resource': '10.0.0.1',
+            'instance_id': 'i-12345'
+        }),
+        (3, 'not json')
+    ]
+
+
+def test_read_operations_csv():
+    stream = StringIO(
+        'action,resource,instance_id\n'
+        'disassociate,10.0.0.1,i-12345\n'
+    )
+    operations = list(bulk.read_operations(stream, 'csv'))
+    assert operations == [
+        (2, {
+            'action': 'disassociate',
+            'resource': '10.0.0.1',
+            'instance_id': 'i-12345'
+        })
+    ]
+
+
+def test_run_operations():
+    client = MagicMock()
+    client.associate.return_value = '{"result": true}'
+    client.disassociate.return_value = json.dumps({
+        'result': False,
+        'error': 'IP is not associated with this instance id.'
+    })
+    operations = [
+        (1, {
+            'action': 'associate',
+            'resource': '10.0.0.1',
+            'instance_id': 'i-12345'
+        }),
+        (2, {
+            'action': 'disassociate',
+            'resource': '10.0.0.2',
+            'instance_id': 'i-12345'
+        }),
+        (3, {'action': 'invalid'}),
+        (4, 'not json')
+    ]
+    output = StringIO()
+    failures = bulk.run_operations(client, operations, output, concurrency=2)
+    assert failures == 3
+    results = sorted(
+        [json.loads(line) for line in output.getvalue().splitlines()],
+        key=lambda result: result['line']
+    )
+    assert [result['result'] for result in results] == [
+        True, False, False, False
+    ]
+    assert results[1]['error'] == (
+        'IP is not associated with this instance id.'
+    )
+    assert results[2]['error'] == 'invalid is not a valid action.'
+    assert results[3]['error'] == 'Invalid input line.'
+    client.associate.assert_called_once_with('10.0.0.1', 'i-12345')
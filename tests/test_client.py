@@ -0,0 +1,306 @@
+import json
+
+import pytest
+from mock import patch
+from mock import MagicMock
+
+from awseipext import result_sink
+from awseipext.client import AwseipextClient
+from awseipext.request.validator import get_mapping_digest
+
+
+def _client(**kwargs):
+    return AwseipextClient(
+        'awseipext',
+        'alias/authnz',
+        'myservice',
+        'awseipext-production',
+        'service',
+        **kwargs
+    )
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token')
+def test_token_reused(get_token):
+    get_token.return_value = 'faketoken'
+    client = _client(lambda_client=MagicMock())
+    client.associate('10.0.0.1', 'i-12345')
+    client.associate('10.0.0.1', 'i-12345')
+    assert get_token.call_count == 1
+    client.disassociate('10.0.0.1', 'i-12345')
+    client.associate('10.0.0.2', 'i-12345')
+    assert get_token.call_count == 3
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_injected_lambda_client():
+    lambda_client = MagicMock()
+    lambda_client.invoke.return_value['Payload'].read.return_value = '{}'
+    client = _client(lambda_client=lambda_client)
+    assert client.associate('10.0.0.1', 'i-12345') == '{}'
+    assert client.disassociate('10.0.0.1', 'i-12345') == '{}'
+    assert lambda_client.invoke.call_count == 2
+
+
+def test_lambda_client_created_once():
+    client = _client(max_pool_connections=25, read_timeout=300)
+    lambda_client = client.lambda_client
+    assert client.lambda_client is lambda_client
+    assert lambda_client.meta.config.max_pool_connections == 25
+    assert lambda_client.meta.config.read_timeout == 300
+
+
+def _payloads(lambda_client):
+    return [
+        json.loads(call[1]['Payload'])
+        for call in lambda_client.invoke.call_args_list
+    ]
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_idempotency_key():
+    lambda_client = MagicMock()
+    client = _client(lambda_client=lambda_client)
+    client.associate('10.0.0.1', 'i-12345')
+    client.associate('10.0.0.1', 'i-12345', idempotency_key='retry-1')
+    client.batch(
+        [('disassociate', '10.0.0.1', 'i-12345')],
+        idempotency_key='retry-2'
+    )
+    client.move('10.0.0.1', 'i-67890', idempotency_key='retry-3')
+    payloads = _payloads(lambda_client)
+    assert 'idempotency_key' not in payloads[0]
+    assert payloads[1]['idempotency_key'] == 'retry-1'
+    assert payloads[2]['idempotency_key'] == 'retry-2'
+    assert payloads[3]['idempotency_key'] == 'retry-3'
+    assert payloads[3]['action'] == 'move'
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_idempotent_client_generates_keys():
+    lambda_client = MagicMock()
+    client = _client(lambda_client=lambda_client, idempotent=True)
+    client.associate('10.0.0.1', 'i-12345')
+    client.associate('10.0.0.1', 'i-12345')
+    first, second = _payloads(lambda_client)
+    assert first['idempotency_key'] != second['idempotency_key']
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_log_type():
+    lambda_client = MagicMock()
+    _client(lambda_client=lambda_client).associate('10.0.0.1', 'i-12345')
+    assert lambda_client.invoke.call_args[1]['LogType'] == 'Tail'
+    _client(lambda_client=lambda_client, log_type='None').associate(
+        '10.0.0.1',
+        'i-12345'
+    )
+    assert lambda_client.invoke.call_args[1]['LogType'] == 'None'
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_async_calls():
+    sink = result_sink.QueueResultSink()
+    lambda_client = MagicMock()
+
+    def invoke(**kwargs):
+        # Stands in for the function putting its result into the sink.
+        payload = json.loads(kwargs['Payload'])
+        assert kwargs['InvocationType'] == 'Event'
+        sink.put(payload['correlation_id'], {'result': True})
+        return {'StatusCode': 202}
+    lambda_client.invoke.side_effect = invoke
+    client = _client(lambda_client=lambda_client, result_sink=sink)
+    futures = [
+        client.associate_async('10.0.0.1', 'i-12345'),
+        client.move_async('10.0.0.2', 'i-12345', idempotency_key='move-1'),
+        client.batch_async([('disassociate', '10.0.0.3', 'i-12345')])
+    ]
+    assert [future.result(5) for future in futures] == [
+        '{"result": true}'
+    ] * 3
+    payloads = _payloads(lambda_client)
+    assert len(set(payload['correlation_id'] for payload in payloads)) == 3
+    # Async calls are made idempotent, since Lambda retries them.
+    assert payloads[0]['idempotency_key'] == payloads[0]['correlation_id']
+    assert payloads[1]['idempotency_key'] == 'move-1'
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_async_calls_require_sink():
+    with pytest.raises(ValueError):
+        _client(lambda_client=MagicMock()).associate_async(
+            '10.0.0.1',
+            'i-12345'
+        )
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_async_invoke_failure():
+    lambda_client = MagicMock()
+    lambda_client.invoke.side_effect = RuntimeError
+    client = _client(
+        lambda_client=lambda_client,
+        result_sink=result_sink.QueueResultSink()
+    )
+    with pytest.raises(RuntimeError):
+        client.associate_async('10.0.0.1', 'i-12345')
+    assert client.collector.pending == {}
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token')
+def test_warm_token(get_token):
+    get_token.return_value = 't'
+    client = _client(lambda_client=MagicMock())
+    assert client.warm_token('associate', '10.0.0.1')
+    assert not client.warm_token('associate', '10.0.0.1', min_ttl=60)
+    # Tokens last 7 minutes, and are used until a minute before then.
+    assert client.warm_token('associate', '10.0.0.1', min_ttl=400)
+    client.associate('10.0.0.1', 'i-12345')
+    assert get_token.call_count == 2
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_reconcile():
+    lambda_client = MagicMock()
+    client = _client(lambda_client=lambda_client)
+    mapping = {'10.0.0.1': 'i-12345', '10.0.0.2': None}
+    with patch.object(
+            client,
+            '_get_generator',
+            wraps=client._get_generator) as get_generator:
+        client.reconcile(mapping, dry_run=True)
+    # The token is minted for the mapping as a whole.
+    get_generator.assert_called_once_with(
+        'reconcile',
+        get_mapping_digest(mapping)
+    )
+    payload = _payloads(lambda_client)[0]
+    assert payload['action'] == 'reconcile'
+    assert payload['mapping'] == mapping
+    assert payload['dry_run'] is True
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_region():
+    lambda_client = MagicMock()
+    client = _client(lambda_client=lambda_client, region='eu-west-1')
+    with patch('kmsauth.KMSTokenGenerator.__init__',
+               MagicMock(return_value=None)) as generator:
+        with patch('kmsauth.KMSTokenGenerator.get_username',
+                   MagicMock(return_value='u')):
+            client.associate('10.0.0.1', 'i-12345')
+    # Tokens are minted with the region's KMS key, and the function is
+    # asked to act in the region.
+    assert generator.call_args[0][2] == 'eu-west-1'
+    assert _payloads(lambda_client)[0]['region'] == 'eu-west-1'
+    assert client._get_token_key('associate', '10.0.0.1') != \
+        _client()._get_token_key('associate', '10.0.0.1')
+
+
+def test_token_key():
+    key = _client()._get_token_key('associate', '10.0.0.1')
+    # Tokens minted with another KMS key or lifetime aren't shared.
+    other_key = AwseipextClient(
+        'awseipext',
+        'alias/other',
+        'myservice',
+        'awseipext-production',
+        'service'
+    )
+    assert other_key._get_token_key('associate', '10.0.0.1') != key
+    assert _client(token_lifetime=5)._get_token_key(
+        'associate',
+        '10.0.0.1'
+    ) != key
+
+
+def test_function_region():
+    assert _client(region='eu-west-1').lambda_client.meta.region_name == \
+        'eu-west-1'
+    assert _client(
+        region='eu-west-1',
+        function_region='us-east-1'
+    ).lambda_client.meta.region_name == 'us-east-1'
+
+
+def test_for_region():
+    client = _client(region='us-east-1')
+    regional = client.for_region('eu-west-1')
+    assert regional.region == 'eu-west-1'
+    assert regional.token_cache is client.token_cache
+    assert client.for_region('eu-west-1') is regional
+    assert client.for_region('us-east-1') is client
+    assert client.for_region('eu-west-1', 'awseipext-eu') is not regional
+    # Without an endpoint, each region's calls go to its own deployment.
+    assert regional.endpoint_url is None
+    assert regional.function_region == 'eu-west-1'
+
+
+def test_for_region_keeps_endpoint():
+    client = _client(
+        region='us-east-1',
+        endpoint_url='http://127.0.0.1:8080',
+        function_region='us-east-1'
+    )
+    regional = client.for_region('eu-west-1')
+    assert regional.endpoint_url == 'http://127.0.0.1:8080'
+    assert regional.function_region == 'us-east-1'
+    assert regional.lambda_client.meta.endpoint_url == \
+        'http://127.0.0.1:8080'
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_batch_regions():
+    client = _client(region='us-east-1')
+    east = MagicMock()
+    east.invoke.return_value['Payload'].read.return_value = json.dumps({
+        'result': True,
+        'results': [
+            {'result': True, 'action': 'associate', 'resource': '10.0.0.1',
+             'instance_id': 'i-1'},
+            {'result': True, 'action': 'move', 'resource': '10.0.0.3',
+             'instance_id': 'i-3'}
+        ]
+    })
+    west = MagicMock()
+    west.invoke.side_effect = RuntimeError('boom')
+    client._lambda_client = east
+    client.for_region('eu-west-1')._lambda_client = west
+    response = json.loads(client.batch_regions([
+        ('us-east-1', 'associate', '10.0.0.1', 'i-1'),
+        ('eu-west-1', 'disassociate', '10.0.0.2', 'i-2'),
+        ('us-east-1', 'move', '10.0.0.3', 'i-3')
+    ]))
+    assert not response['result']
+    assert [
+        (r['region'], r['resource'], r['result'])
+        for r in response['results']
+    ] == [
+        ('us-east-1', '10.0.0.1', True),
+        ('eu-west-1', '10.0.0.2', False),
+        ('us-east-1', '10.0.0.3', True)
+    ]
+    assert response['results'][1]['error'] == 'RuntimeError: boom'
+    payload = _payloads(east)[0]
+    assert payload['region'] == 'us-east-1'
+    assert len(payload['operations']) == 2
+    assert _payloads(west)[0]['region'] == 'eu-west-1'
+
+
+@patch('kmsauth.KMSTokenGenerator.get_token', MagicMock(return_value='t'))
+def test_batch_regions_injected_lambda_client():
+    lambda_client = MagicMock()
+    lambda_client.invoke.return_value['Payload'].read.return_value = \
+        json.dumps({'result': True, 'results': [{'result': True}]})
+    client = _client(region='us-east-1', lambda_client=lambda_client)
+    assert client.for_region('eu-west-1').lambda_client is lambda_client
+    response = json.loads(client.batch_regions([
+        ('us-east-1', 'associate', '10.0.0.1', 'i-1'),
+        ('eu-west-1', 'disassociate', '10.0.0.2', 'i-2')
+    ]))
+    assert response['result']
+    # Both regions' batches went to the injected client.
+    assert sorted(p['region'] for p in _payloads(lambda_client)) == [
+        'eu-west-1', 'us-east-1'
+    ]
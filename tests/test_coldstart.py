@@ -0,0 +1,19 @@
+from awseipext import coldstart
+
+
+def test_lambda_function_import_is_light():
+    # Import timings vary too much from machine to machine to assert on
+    # here; make coldstart checks them against a budget. What the import
+    # loads doesn't vary.
+    result = coldstart.measure_import(
+        'awseipext.aws_lambda.lambda_function',
+        runs=1
+    )
+    # Imports without any AWS region configured, and leaves boto3,
+    # botocore's session, kmsauth and marshmallow to the first request.
+    assert result['heavy_modules'] == []
+
+
+def test_measure_import_reports_heavy_modules():
+    result = coldstart.measure_import('marshmallow', runs=1)
+    assert result['heavy_modules'] == ['marshmallow']
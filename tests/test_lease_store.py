@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+
+import pytest
+
+from awseipext import lease_store
+from awseipext.testing.fakes import FakeDynamoDBClient
+
+
+@pytest.fixture(params=['memory', 'file', 'dynamodb'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        return lease_store.MemoryLeaseStore()
+    if request.param == 'file':
+        return lease_store.FileLeaseStore(
+            str(tmpdir.join('leases')),
+            poll_interval=0.01
+        )
+    return lease_store.DynamoDBLeaseStore(
+        'awseipext-leases',
+        dynamodb_client=FakeDynamoDBClient(),
+        poll_interval=0.01
+    )
+
+
+def test_try_acquire_release(store):
+    assert store.try_acquire('key', 'a', 60)
+    assert not store.try_acquire('key', 'b', 60)
+    # The holder may renew its lease.
+    assert store.try_acquire('key', 'a', 60)
+    assert store.try_acquire('other', 'b', 60)
+    # Only the holder can release a lease.
+    store.release('key', 'b')
+    assert not store.try_acquire('key', 'b', 60)
+    store.release('key', 'a')
+    assert store.try_acquire('key', 'b', 60)
+
+
+def test_expired_lease_taken_over(store):
+    assert store.try_acquire('key', 'a', 0.05)
+    time.sleep(0.1)
+    assert store.try_acquire('key', 'b', 60)
+    # The old holder's release doesn't drop the new lease.
+    store.release('key', 'a')
+    assert not store.try_acquire('key', 'a', 60)
+
+
+def test_acquire_waits_for_release(store):
+    assert store.try_acquire('key', 'a', 60)
+    timer = threading.Timer(0.05, lambda: store.release('key', 'a'))
+    timer.start()
+    try:
+        assert store.acquire('key', 'b', 60, 5)
+    finally:
+        timer.join()
+    assert not store.try_acquire('key', 'a', 60)
+
+
+def test_acquire_timeout(store):
+    assert store.try_acquire('key', 'a', 60)
+    start = time.time()
+    assert not store.acquire('key', 'b', 60, 0.05)
+    assert time.time() - start >= 0.05
+
+
+def test_memory_store_serves_waiters_in_order():
+    store = lease_store.MemoryLeaseStore()
+    assert store.try_acquire('key', 'holder', 60)
+    order = []
+
+    def wait(owner):
+        assert store.acquire('key', owner, 60, 5)
+        order.append(owner)
+        time.sleep(0.01)
+        store.release('key', owner)
+
+    threads = []
+    for owner in ('first', 'second', 'third'):
+        thread = threading.Thread(target=wait, args=(owner,))
+        thread.start()
+        threads.append(thread)
+        # Let each waiter join the queue before the next.
+        while len(store.waiters.get('key', ())) < len(threads):
+            time.sleep(0.001)
+    # A newcomer can't jump the queue.
+    assert not store.try_acquire('key', 'newcomer', 60)
+    store.release('key', 'holder')
+    for thread in threads:
+        thread.join()
+    assert order == ['first', 'second', 'third']
+    assert store.waiters == {}
+    assert store.leases == {}
+
+
+def test_file_store_unreadable_lease_expires(tmpdir):
+    store = lease_store.FileLeaseStore(str(tmpdir))
+    path = store._path('key')
+    with open(path, 'w') as f:
+        f.write('{"owner": ')
+    assert not store.try_acquire('key', 'a', 60)
+    # Once it's older than the lease would last, it's taken over.
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+    assert store.try_acquire('key', 'a', 60)
+    assert not store.try_acquire('key', 'b', 60)
+
+
+def test_file_store_expired_lease_taken_over_once(tmpdir):
+    directory = str(tmpdir)
+    for attempt in range(20):
+        key = 'key-{0}'.format(attempt)
+        assert lease_store.FileLeaseStore(directory).try_acquire(
+            key,
+            'old',
+            0.01
+        )
+        time.sleep(0.02)
+        start = threading.Event()
+        winners = []
+
+        def take(owner):
+            store = lease_store.FileLeaseStore(directory)
+            start.wait()
+            if store.try_acquire(key, owner, 60):
+                winners.append(owner)
+
+        threads = [
+            threading.Thread(target=take, args=('owner-{0}'.format(i),))
+            for i in range(16)
+        ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert len(winners) == 1
+
+
+def test_create_lease_store(tmpdir):
+    assert isinstance(
+        lease_store.create_lease_store('memory'),
+        lease_store.MemoryLeaseStore
+    )
+    assert isinstance(
+        lease_store.create_lease_store('file', str(tmpdir)),
+        lease_store.FileLeaseStore
+    )
+    assert isinstance(
+        lease_store.create_lease_store('dynamodb', table='leases'),
+        lease_store.DynamoDBLeaseStore
+    )
+    assert lease_store.create_lease_store('none') is None
+    with pytest.raises(ValueError):
+        lease_store.create_lease_store('file')
+    with pytest.raises(ValueError):
+        lease_store.create_lease_store('dynamodb')
+    with pytest.raises(ValueError):
+        lease_store.create_lease_store('redis')
@@ -0,0 +1,54 @@
+import json
+from StringIO import StringIO
+
+from awseipext import metrics
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_stage_timer():
+    clock = Clock()
+    timer = metrics.StageTimer(clock=clock)
+    with timer.stage('KmsDecrypt'):
+        clock.now += 0.01
+    with timer.stage('Ec2Mutation'):
+        clock.now += 0.02
+    with timer.stage('KmsDecrypt'):
+        clock.now += 0.01
+    assert list(timer.timings) == ['KmsDecrypt', 'Ec2Mutation']
+    assert round(timer.timings['KmsDecrypt'], 6) == 20
+    assert round(timer.timings['Ec2Mutation'], 6) == 20
+    assert round(timer.total(), 6) == 40
+
+
+def test_emf_record():
+    record = metrics.emf_record(
+        'awseipext',
+        {'Action': 'associate', 'Outcome': 'success'},
+        {'KmsDecrypt': 12.5},
+        properties={'RequestId': 'abc'},
+        timestamp=1000
+    )
+    assert record['_aws'] == {
+        'Timestamp': 1000000,
+        'CloudWatchMetrics': [{
+            'Namespace': 'awseipext',
+            'Dimensions': [['Action', 'Outcome']],
+            'Metrics': [{'Name': 'KmsDecrypt', 'Unit': 'Milliseconds'}]
+        }]
+    }
+    assert record['Action'] == 'associate'
+    assert record['KmsDecrypt'] == 12.5
+    assert record['RequestId'] == 'abc'
+
+
+def test_stdout_sink():
+    stream = StringIO()
+    metrics.StdoutSink(stream).emit({'a': 1})
+    assert json.loads(stream.getvalue()) == {'a': 1}
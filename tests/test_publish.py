@@ -0,0 +1,79 @@
+import zipfile
+
+from awseipext import publish
+
+
+def test_find_closure():
+    closure = publish.find_closure()
+    # The handler, awseipext's modules and dependencies, including those
+    # only imported once a request needs them.
+    for name in (
+            'lambda_function',
+            'awseipext.request.validator',
+            'awseipext.lease_store',
+            'kmsauth',
+            'concurrent.futures.thread'):
+        assert name in closure
+    assert closure['awseipext'][1]
+    assert not closure['lambda_function'][1]
+    # The standard library, modules the runtime provides and modules the
+    # lambda never imports are left out.
+    for name in (
+            'json',
+            'os',
+            'boto3',
+            'botocore.exceptions',
+            'awseipext.client',
+            'awseipext.testing.fakes',
+            'pytest',
+            'mock',
+            'pip',
+            'setuptools'):
+        assert name not in closure
+
+
+def test_find_closure_include_runtime_provided():
+    closure = publish.find_closure(excludes=())
+    assert 'boto3' in closure
+    assert 'botocore.exceptions' in closure
+
+
+def test_build(tmpdir):
+    config_dir = tmpdir.mkdir('configs')
+    config_dir.join('lambda_deploy.cfg').write(
+        '[lambda_config]\nkmsauth_key = k\nkmsauth_to_context = c\n'
+    )
+    output = str(tmpdir.join('publish', 'awseipext_lambda.zip'))
+    result = publish.build(output, config_dir=str(config_dir))
+    names = zipfile.ZipFile(output).namelist()
+    assert 'lambda_function.pyc' in names
+    assert 'awseipext/__init__.pyc' in names
+    assert 'kmsauth/__init__.pyc' in names
+    assert 'lambda_deploy.cfg' in names
+    assert not [name for name in names if name.endswith('.py')]
+    assert not [name for name in names if name.startswith('boto')]
+    assert result['files'] == len(names)
+    assert result['size'] == tmpdir.join(
+        'publish',
+        'awseipext_lambda.zip'
+    ).size()
+    assert 'lambda_function' in result['modules']
+
+    # Builds are reproducible.
+    with open(output, 'rb') as f:
+        first = f.read()
+    publish.build(output, config_dir=str(config_dir))
+    with open(output, 'rb') as f:
+        assert f.read() == first
+
+    # The handler imports from the zip alone, without the heavy modules.
+    cold_import = publish.measure_artifact(output, runs=1)
+    assert cold_import['heavy_modules'] == []
+
+
+def test_build_with_sources(tmpdir):
+    output = str(tmpdir.join('awseipext_lambda.zip'))
+    publish.build(output, sources=True)
+    names = zipfile.ZipFile(output).namelist()
+    assert 'lambda_function.py' in names
+    assert 'lambda_function.pyc' in names
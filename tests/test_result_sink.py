@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+
+import pytest
+from concurrent.futures import TimeoutError
+from mock import MagicMock
+from mock import patch
+
+from awseipext import result_sink
+
+
+def test_queue_sink():
+    sink = result_sink.QueueResultSink()
+    sink.put('a', {'result': True})
+    sink.put('b', {'result': False})
+    assert sink.poll(['a'], 0) == [('a', {'result': True})]
+    # Results for other ids are kept until they're polled for.
+    assert sink.poll(['a'], 0.01) == []
+    assert sink.poll(['b'], 0) == [('b', {'result': False})]
+
+
+def test_queue_sink_unclaimed_results_expire():
+    clock = [1000.0]
+    sink = result_sink.QueueResultSink(max_age=300, clock=lambda: clock[0])
+    sink.put('a', {'result': True})
+    assert sink.poll(['b'], 0) == []
+    assert 'a' in sink.unclaimed
+    clock[0] += 301
+    assert sink.poll(['b'], 0) == []
+    assert sink.unclaimed == {}
+
+
+def test_queue_sink_waits():
+    sink = result_sink.QueueResultSink()
+    timer = threading.Timer(0.05, sink.put, ['a', {'result': True}])
+    timer.start()
+    assert sink.poll(['a'], 5) == [('a', {'result': True})]
+
+
+def test_file_sink(tmpdir):
+    sink = result_sink.FileResultSink(str(tmpdir), poll_interval=0.01)
+    sink.put('../a', {'result': True})
+    # Ids are hashed into file names.
+    assert [path.dirname for path in tmpdir.listdir()] == [str(tmpdir)]
+    assert sink.poll(['b'], 0.02) == []
+    assert sink.poll(['../a', 'b'], 0) == [('../a', {'result': True})]
+    assert tmpdir.listdir() == []
+
+
+def test_file_sink_result_taken_once(tmpdir):
+    sink = result_sink.FileResultSink(str(tmpdir))
+    other = result_sink.FileResultSink(str(tmpdir))
+    sink.put('a', {'result': True})
+    path = sink._path('a')
+    # Both pollers read the result before either removes it.
+    with open(path) as f:
+        entry = json.load(f)
+    with patch('awseipext.file_store.read', MagicMock(return_value=entry)):
+        assert sink.poll(['a'], 0) == [('a', {'result': True})]
+        assert other.poll(['a'], 0) == []
+
+
+def test_file_sink_unclaimed_results_expire(tmpdir):
+    clock = [time.time()]
+    sink = result_sink.FileResultSink(
+        str(tmpdir),
+        max_age=300,
+        clock=lambda: clock[0]
+    )
+    sink.put('a', {'result': True})
+    assert sink.poll(['b'], 0) == []
+    assert len(tmpdir.listdir()) == 1
+    clock[0] += 301
+    assert sink.poll(['b'], 0) == []
+    assert tmpdir.listdir() == []
+
+
+def test_sqs_sink():
+    sqs_client = MagicMock()
+    sink = result_sink.SQSResultSink('https://queue', sqs_client=sqs_client)
+    sink.put('a', {'result': True})
+    body = sqs_client.send_message.call_args[1]['MessageBody']
+    assert json.loads(body) == {
+        'correlation_id': 'a',
+        'result': {'result': True}
+    }
+    sqs_client.receive_message.return_value = {
+        'Messages': [
+            {'MessageId': '1', 'ReceiptHandle': 'r1', 'Body': body},
+            {
+                'MessageId': '2',
+                'ReceiptHandle': 'r2',
+                'Body': json.dumps({'correlation_id': 'c', 'result': None})
+            },
+            {'MessageId': '3', 'ReceiptHandle': 'r3', 'Body': '{'},
+            {
+                'MessageId': '4',
+                'ReceiptHandle': 'r4',
+                'Body': json.dumps({'correlation_id': 'd', 'result': None}),
+                'Attributes': {
+                    'SentTimestamp': str(int((time.time() - 301) * 1000))
+                }
+            }
+        ]
+    }
+    assert sink.poll(['a', 'b'], 30) == [('a', {'result': True})]
+    assert sqs_client.receive_message.call_args[1]['WaitTimeSeconds'] == 20
+    # Only the messages that were waited on, or that nobody can be waiting
+    # on any more, are deleted.
+    sqs_client.delete_message_batch.assert_called_once_with(
+        QueueUrl='https://queue',
+        Entries=[
+            {'Id': '0', 'ReceiptHandle': 'r1'},
+            {'Id': '1', 'ReceiptHandle': 'r4'}
+        ]
+    )
+
+
+def test_create_result_sink(tmpdir):
+    assert result_sink.create_result_sink('none') is None
+    assert result_sink.create_result_sink('memory') is result_sink.local_sink
+    assert isinstance(
+        result_sink.create_result_sink('file', directory=str(tmpdir)),
+        result_sink.FileResultSink
+    )
+    with pytest.raises(ValueError):
+        result_sink.create_result_sink('sqs')
+    with pytest.raises(ValueError):
+        result_sink.create_result_sink('bogus')
+
+
+def test_collector_resolves_futures():
+    sink = result_sink.QueueResultSink()
+    collector = result_sink.ResultCollector(
+        sink,
+        poll_timeout=0.01,
+        transform=json.dumps
+    )
+    first = collector.register('a')
+    second = collector.register('b')
+    sink.put('b', {'result': False})
+    sink.put('a', {'result': True})
+    assert first.result(5) == '{"result": true}'
+    assert second.result(5) == '{"result": false}'
+    # The polling thread stops once nothing is pending.
+    for _ in range(100):
+        if collector.thread is None:
+            break
+        time.sleep(0.01)
+    assert collector.thread is None
+
+
+def test_collector_times_out():
+    collector = result_sink.ResultCollector(
+        result_sink.QueueResultSink(),
+        timeout=0.05,
+        poll_timeout=0.01
+    )
+    future = collector.register('a')
+    with pytest.raises(TimeoutError):
+        future.result(5)
+    assert collector.pending == {}
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+
+import pytest
+
+from awseipext import result_store
+from awseipext.result_store import DONE, NEW, PENDING
+from awseipext.testing.fakes import FakeDynamoDBClient
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=['memory', 'file', 'dynamodb'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        return result_store.MemoryResultStore(ttl=300, lease=60)
+    if request.param == 'dynamodb':
+        return result_store.DynamoDBResultStore(
+            'results',
+            ttl=300,
+            lease=60,
+            dynamodb_client=FakeDynamoDBClient(key='key'),
+            poll_interval=0.01
+        )
+    return result_store.FileResultStore(
+        str(tmpdir.join('results')),
+        ttl=300,
+        lease=60,
+        poll_interval=0.01
+    )
+
+
+def test_begin_finish(store):
+    assert store.begin('key') == (NEW, None)
+    assert store.begin('key') == (PENDING, None)
+    store.finish('key', {'result': True})
+    assert store.begin('key') == (DONE, {'result': True})
+    assert store.begin('other') == (NEW, None)
+
+
+def test_abandon(store):
+    assert store.begin('key') == (NEW, None)
+    store.abandon('key')
+    assert store.begin('key') == (NEW, None)
+
+
+def test_expired_claim_taken_over(store):
+    assert store.begin('key', lease=0.05) == (NEW, None)
+    time.sleep(0.1)
+    assert store.begin('key') == (NEW, None)
+
+
+def test_wait_for_result(store):
+    assert store.begin('key') == (NEW, None)
+    timer = threading.Timer(
+        0.05,
+        lambda: store.finish('key', {'result': True})
+    )
+    timer.start()
+    try:
+        assert store.wait('key', 5) == (DONE, {'result': True})
+    finally:
+        timer.join()
+
+
+def test_wait_claims_abandoned_key(store):
+    assert store.begin('key') == (NEW, None)
+    timer = threading.Timer(0.05, lambda: store.abandon('key'))
+    timer.start()
+    try:
+        assert store.wait('key', 5) == (NEW, None)
+    finally:
+        timer.join()
+
+
+def test_wait_timeout(store):
+    assert store.begin('key') == (NEW, None)
+    assert store.wait('key', 0.05) == (PENDING, None)
+
+
+def test_file_store_shared(tmpdir):
+    directory = str(tmpdir)
+    first = result_store.FileResultStore(directory)
+    second = result_store.FileResultStore(directory)
+    assert first.begin('key') == (NEW, None)
+    assert second.begin('key') == (PENDING, None)
+    first.finish('key', {'result': False, 'error': 'Authentication failed.'})
+    assert second.begin('key') == (
+        DONE,
+        {'result': False, 'error': 'Authentication failed.'}
+    )
+
+
+def test_dynamodb_store_shared():
+    client = FakeDynamoDBClient(key='key')
+    first = result_store.DynamoDBResultStore('results', dynamodb_client=client)
+    second = result_store.DynamoDBResultStore(
+        'results',
+        dynamodb_client=client
+    )
+    assert first.begin('key') == (NEW, None)
+    assert second.begin('key') == (PENDING, None)
+    first.finish('key', {'result': True})
+    assert second.begin('key') == (DONE, {'result': True})
+    assert client.calls['put_item'] == 4
+    assert client.calls['get_item'] == 2
+
+
+def test_file_store_unreadable_claim_expires(tmpdir):
+    store = result_store.FileResultStore(str(tmpdir), lease=60)
+    path = store._path('key')
+    with open(path, 'w') as f:
+        f.write('{"state": ')
+    assert store.begin('key') == (PENDING, None)
+    os.utime(path, (time.time() - 61, time.time() - 61))
+    assert store.begin('key') == (NEW, None)
+    assert store.begin('key') == (PENDING, None)
+
+
+def test_file_store_expired_claim_taken_over_once(tmpdir):
+    directory = str(tmpdir)
+    for attempt in range(20):
+        key = 'key-{0}'.format(attempt)
+        result_store.FileResultStore(directory).begin(key, lease=0)
+        claimed = []
+
+        def begin():
+            store = result_store.FileResultStore(directory)
+            if store.begin(key)[0] == NEW:
+                claimed.append(True)
+
+        threads = [threading.Thread(target=begin) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(claimed) == 1
+
+
+def test_memory_store_results_expire():
+    clock = Clock()
+    store = result_store.MemoryResultStore(ttl=300, clock=clock)
+    store.begin('key')
+    store.finish('key', {'result': True})
+    clock.now += 301
+    assert store.begin('key') == (NEW, None)
+
+
+def test_memory_store_returns_copies():
+    store = result_store.MemoryResultStore()
+    store.begin('key')
+    result = {'result': True}
+    store.finish('key', result)
+    result['result'] = False
+    state, recorded = store.begin('key')
+    recorded['error'] = 'changed'
+    assert store.begin('key') == (DONE, {'result': True})
+
+
+def test_create_result_store(tmpdir):
+    assert isinstance(
+        result_store.create_result_store('memory', 60),
+        result_store.MemoryResultStore
+    )
+    assert isinstance(
+        result_store.create_result_store('file', 60, str(tmpdir)),
+        result_store.FileResultStore
+    )
+    assert isinstance(
+        result_store.create_result_store('dynamodb', 60, table='results'),
+        result_store.DynamoDBResultStore
+    )
+    assert result_store.create_result_store('none', 60) is None
+    with pytest.raises(ValueError):
+        result_store.create_result_store('file', 60)
+    with pytest.raises(ValueError):
+        result_store.create_result_store('dynamodb', 60)
+    with pytest.raises(ValueError):
+        result_store.create_result_store('other', 60)
@@ -0,0 +1,209 @@
+import httplib
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from awseipext import service
+from awseipext.testing import benchmark
+
+
+@pytest.fixture
+def backends(request):
+    backends = benchmark.Backends().__enter__()
+    backends.ec2.reset(
+        [benchmark.free_address()],
+        benchmark.INSTANCES
+    )
+    benchmark.reset_caches(backends, 'cold')
+    request.addfinalizer(lambda: backends.__exit__(None, None, None))
+    return backends
+
+
+def _serve(request, server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    request.addfinalizer(stop)
+    return server
+
+
+def _event(backends, action='associate'):
+    username, token = backends.get_token(action, benchmark.PUBLIC_IP)
+    return {
+        'action': action,
+        'resource': benchmark.PUBLIC_IP,
+        'instance_id': benchmark.INSTANCE_ID,
+        'username': username,
+        'token': token
+    }
+
+
+def test_unix_socket_service(request, tmpdir, backends):
+    path = str(tmpdir.join('awseipext.sock'))
+    _serve(request, service.UnixHTTPService(
+        path,
+        config_file=backends.config_file,
+        workers=2
+    ))
+    lambda_client = service.UnixSocketLambdaClient(path, timeout=10)
+    # Tokens minted a minute apart differ, so the retry reuses this one.
+    event = _event(backends)
+    response = lambda_client.invoke(
+        FunctionName='awseipext',
+        Payload=json.dumps(event)
+    )
+    assert response['StatusCode'] == 200
+    assert json.loads(response['Payload'].read()) == {'result': True}
+    assert backends.ec2.snapshot()[0]['InstanceId'] == benchmark.INSTANCE_ID
+
+    # The connection is kept alive, and the handler's state stays warm.
+    backends.reset_calls()
+    response = lambda_client.invoke(
+        FunctionName='awseipext',
+        Payload=json.dumps(event)
+    )
+    assert json.loads(response['Payload'].read()) == {'result': True}
+    # Only the address is looked up again, to confirm there's nothing to do.
+    assert backends.calls() == {'ec2:describe_addresses': 1}
+
+    response = lambda_client.invoke(
+        FunctionName='awseipext',
+        Payload=json.dumps({'action': 'associate'})
+    )
+    assert response['FunctionError'] == 'Unhandled'
+    assert json.loads(response['Payload'].read())['errorType'] == \
+        'ValidationError'
+
+
+def test_event_invocation(request, tmpdir, backends):
+    path = str(tmpdir.join('awseipext.sock'))
+    _serve(request, service.UnixHTTPService(
+        path,
+        config_file=backends.config_file
+    ))
+    lambda_client = service.UnixSocketLambdaClient(path, timeout=10)
+    response = lambda_client.invoke(
+        FunctionName='awseipext',
+        InvocationType='Event',
+        Payload=json.dumps(_event(backends))
+    )
+    assert response['StatusCode'] == 202
+    for _ in range(100):
+        if backends.ec2.snapshot()[0].get('InstanceId'):
+            break
+        time.sleep(0.01)
+    assert backends.ec2.snapshot()[0]['InstanceId'] == benchmark.INSTANCE_ID
+
+
+def test_idle_connections_dont_hold_workers(request, backends):
+    server = _serve(request, service.HTTPService(
+        ('127.0.0.1', 0),
+        config_file=backends.config_file,
+        workers=1
+    ))
+    first = httplib.HTTPConnection(*server.server_address, timeout=5)
+    first.request('GET', '/ping')
+    assert first.getresponse().read() == '{"result": true}'
+    # The first connection is still open, but its worker is free.
+    second = httplib.HTTPConnection(*server.server_address, timeout=5)
+    second.request('GET', '/ping')
+    assert second.getresponse().read() == '{"result": true}'
+    first.request('GET', '/ping')
+    assert first.getresponse().read() == '{"result": true}'
+
+
+def test_idle_connections_closed(request, backends):
+    server = service.HTTPService(
+        ('127.0.0.1', 0),
+        config_file=backends.config_file
+    )
+    server.idle_timeout = 0.05
+    _serve(request, server)
+    connection = socket.create_connection(server.server_address, timeout=5)
+    connection.sendall('GET /ping HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = httplib.HTTPResponse(connection)
+    response.begin()
+    assert response.read() == '{"result": true}'
+    # The service closes the connection once it's been idle.
+    assert connection.recv(1) == ''
+
+
+def test_pipelined_requests(request, backends):
+    server = _serve(request, service.HTTPService(
+        ('127.0.0.1', 0),
+        config_file=backends.config_file
+    ))
+    connection = socket.create_connection(server.server_address, timeout=5)
+    connection.sendall(
+        'GET /ping HTTP/1.1\r\nHost: localhost\r\n\r\n' * 2
+    )
+    for _ in range(2):
+        response = httplib.HTTPResponse(connection)
+        response.begin()
+        assert response.read() == '{"result": true}'
+
+
+def test_socket_reader():
+    left, right = socket.socketpair()
+    reader = service.SocketReader(left, bufsize=4)
+    right.sendall('ab\ncdefg\nhij')
+    right.close()
+    assert reader.readline() == 'ab\n'
+    assert reader.buffered() == 1
+    assert reader.readline(3) == 'cde'
+    assert reader.read(5) == 'fg\nhi'
+    assert reader.read() == 'j'
+    assert reader.readline() == ''
+    assert reader.buffered() == 0
+    left.close()
+
+
+def test_http_service(request, backends):
+    server = _serve(request, service.HTTPService(
+        ('127.0.0.1', 0),
+        config_file=backends.config_file
+    ))
+    connection = httplib.HTTPConnection(*server.server_address, timeout=10)
+    connection.request('GET', '/ping')
+    assert connection.getresponse().read() == '{"result": true}'
+    connection.request('POST', '/', json.dumps(_event(backends)))
+    response = connection.getresponse()
+    assert response.status == 200
+    assert response.getheader('X-Amzn-RequestId')
+    assert json.loads(response.read()) == {'result': True}
+    connection.request('POST', '/2015-03-31/functions/x/invocations', '{')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 400
+    connection.request('POST', '/other', '{}')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 404
+
+
+def test_invocation_context():
+    context = service.InvocationContext('awseipext', 30)
+    assert 29000 < context.get_remaining_time_in_millis() <= 30000
+    assert context.aws_request_id != service.InvocationContext(
+        'awseipext', 30
+    ).aws_request_id
+
+
+def test_local_lambda_client(backends):
+    lambda_client = service.LocalLambdaClient(backends.config_file)
+    response = lambda_client.invoke(
+        FunctionName='awseipext',
+        Payload=json.dumps(_event(backends))
+    )
+    assert response['StatusCode'] == 200
+    assert json.loads(response['Payload'].read()) == {'result': True}
+    response = lambda_client.invoke(FunctionName='awseipext', Payload='{}')
+    assert response['FunctionError'] == 'Unhandled'
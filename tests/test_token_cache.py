@@ -0,0 +1,46 @@
+import time
+
+from awseipext.token_cache import TokenCache
+
+KEY = ('awseipext', 'myservice', 'service', 'associate', '10.0.0.1')
+
+
+def test_token_cache_expiry():
+    cache = TokenCache(safety_margin=60)
+    assert cache.get(KEY) is None
+    cache.set(KEY, '2/service/myservice', 'token', time.time() + 120)
+    assert cache.get(KEY) == ('2/service/myservice', 'token')
+    assert cache.get(KEY[:-1] + ('10.0.0.2',)) is None
+    # Within the safety margin of expiry
+    cache.set(KEY, '2/service/myservice', 'token', time.time() + 30)
+    assert cache.get(KEY) is None
+
+
+def test_token_cache_ttl():
+    cache = TokenCache(safety_margin=60)
+    assert cache.ttl(KEY) is None
+    cache.set(KEY, '2/service/myservice', 'token', time.time() + 120)
+    assert 59 < cache.ttl(KEY) <= 60
+    cache.set(KEY, '2/service/myservice', 'token', time.time() + 30)
+    assert cache.ttl(KEY) is None
+
+
+def test_token_cache_file_shared(tmpdir):
+    cache_file = str(tmpdir.join('cache', 'tokens.json'))
+    cache = TokenCache(cache_file=cache_file)
+    cache.set(KEY, '2/service/myservice', 'token', time.time() + 600)
+    # A new process picks up the persisted token
+    other = TokenCache(cache_file=cache_file)
+    assert other.get(KEY) == ('2/service/myservice', 'token')
+    # And tokens written after startup
+    key = KEY[:-1] + ('10.0.0.2',)
+    cache.set(key, '2/service/myservice', 'token2', time.time() + 600)
+    assert other.get(key) == ('2/service/myservice', 'token2')
+    assert other.get(KEY) == ('2/service/myservice', 'token')
+
+
+def test_token_cache_bad_file(tmpdir):
+    cache_file = tmpdir.join('tokens.json')
+    cache_file.write('not json')
+    cache = TokenCache(cache_file=str(cache_file))
+    assert cache.get(KEY) is None
@@ -0,0 +1,48 @@
+from awseipext.ttl_cache import TTLCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiry():
+    clock = Clock()
+    cache = TTLCache(10, 60, clock=clock)
+    assert cache.lookup('a') == (False, None)
+    cache.set('a', 'role')
+    cache.set('b', None, ttl=10)
+    assert cache.lookup('a') == (True, 'role')
+    assert cache.lookup('b') == (True, None)
+    clock.now += 30
+    assert cache.lookup('a') == (True, 'role')
+    assert cache.lookup('b') == (False, None)
+    clock.now += 30
+    assert cache.lookup('a') == (False, None)
+    assert cache.stats() == {'size': 0, 'hits': 3, 'misses': 3}
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.lookup('a')
+    cache.set('c', 3)
+    assert cache.lookup('b') == (False, None)
+    assert cache.lookup('a') == (True, 1)
+    assert cache.lookup('c') == (True, 3)
+    assert len(cache) == 2
+
+
+def test_ttl_cache_invalidate():
+    cache = TTLCache(10, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.invalidate('a')
+    assert cache.lookup('a') == (False, None)
+    assert cache.lookup('b') == (True, 2)
+    cache.invalidate()
+    assert len(cache) == 0
@@ -0,0 +1,45 @@
+import json
+
+from awseipext.testing import benchmark
+
+
+def test_benchmark_paths():
+    results = benchmark.run(iterations=2)
+    paths = results['paths']
+    assert sorted(paths) == sorted(path[0] for path in benchmark.PATHS)
+    for name in ('already_associated', 'associate', 'disassociate',
+                 'not_associated', 'move', 'batch', 'reconcile'):
+        assert paths[name]['result']
+    assert not paths['auth_failure']['result']
+    assert not paths['role_mismatch']['result']
+    assert paths['auth_failure']['api_calls'] == {'kms:decrypt': 1.0}
+    # A batch's instances are looked up together, and a reconcile's
+    # addresses come from one snapshot.
+    assert paths['batch']['api_calls']['ec2:describe_instances'] == 1.0
+    assert paths['reconcile']['api_calls']['ec2:describe_addresses'] == 1.0
+
+
+def test_benchmark_api_calls_match_baseline():
+    # Simulated latencies differ from the baseline's, so only API call
+    # counts are compared.
+    with open(benchmark.DEFAULT_BASELINE) as f:
+        baseline = json.load(f)
+    results = benchmark.run(iterations=2, mode=baseline['mode'])
+    assert benchmark.compare(results, baseline) == []
+
+
+def test_benchmark_warm_mode_skips_lookups():
+    results = benchmark.run(iterations=2, mode='warm')
+    # Only the address is looked up, to confirm there's nothing to do.
+    assert results['paths']['already_associated']['api_calls'] == {
+        'ec2:describe_addresses': 1.0
+    }
+    # The default memory leases don't stop the address inventory answering
+    # lookups for changes.
+    assert results['paths']['associate']['api_calls'] == {
+        'ec2:associate_address': 1.0
+    }
+    assert results['paths']['batch']['api_calls'] == {
+        'ec2:associate_address': 1.0,
+        'ec2:disassociate_address': 1.0
+    }
@@ -0,0 +1,47 @@
+import botocore.exceptions
+import pytest
+
+from awseipext.testing.fakes import FakeEC2Client, FakeKMSClient
+
+ADDRESS = {
+    'PublicIp': '198.51.100.1',
+    'AllocationId': 'eipalloc-1',
+    'Domain': 'vpc'
+}
+
+
+def test_fake_ec2_association():
+    ec2 = FakeEC2Client(addresses=[ADDRESS], instances={'i-1': None})
+    association_id = ec2.associate_address(
+        InstanceId='i-1',
+        AllocationId='eipalloc-1'
+    )['AssociationId']
+    address = ec2.describe_addresses(PublicIps=['198.51.100.1'])
+    assert address['Addresses'][0]['InstanceId'] == 'i-1'
+    with pytest.raises(botocore.exceptions.ClientError):
+        ec2.associate_address(InstanceId='i-1', AllocationId='eipalloc-1')
+    ec2.disassociate_address(AssociationId=association_id)
+    assert 'InstanceId' not in ec2.snapshot()[0]
+    assert ec2.calls['associate_address'] == 2
+    assert ec2.total_calls == 4
+
+
+def test_fake_ec2_error_injection():
+    ec2 = FakeEC2Client(addresses=[ADDRESS], error_rate=1)
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+        ec2.describe_addresses()
+    assert e.value.response['Error']['Code'] == 'RequestLimitExceeded'
+
+
+def test_fake_kms_enforces_context():
+    kms = FakeKMSClient(keys={'alias/test': 'arn:aws:kms:us-east-1:1:key/1'})
+    blob = kms.encrypt(
+        KeyId='alias/test',
+        Plaintext='{}',
+        EncryptionContext={'to': 'a'}
+    )['CiphertextBlob']
+    data = kms.decrypt(CiphertextBlob=blob, EncryptionContext={'to': 'a'})
+    assert data['KeyId'] == 'arn:aws:kms:us-east-1:1:key/1'
+    assert data['Plaintext'] == '{}'
+    with pytest.raises(botocore.exceptions.ClientError):
+        kms.decrypt(CiphertextBlob=blob, EncryptionContext={'to': 'b'})
@@ -0,0 +1,57 @@
+import pytest
+
+from awseipext.testing import load
+
+
+def test_parse_mix():
+    assert load.parse_mix('move=2,associate') == {
+        'move': 2.0,
+        'associate': 1.0
+    }
+    with pytest.raises(ValueError):
+        load.parse_mix('bogus=1')
+    with pytest.raises(ValueError):
+        load.parse_mix('move=0')
+
+
+def test_build_fleet():
+    mix = {'associate': 1, 'disassociate': 1, 'move': 1}
+    addresses, instances, operations, expected = load.build_fleet(
+        30,
+        mix,
+        seed=1
+    )
+    assert len(addresses) == len(operations) == len(expected) == 30
+    assert len(instances) == 60
+    assert set(action for action, _, _ in operations) == set(mix)
+    assert len(set(address['PublicIp'] for address in addresses)) == 30
+    assert load.build_fleet(30, mix, seed=1)[2] == operations
+
+
+def test_run():
+    report = load.run(
+        instances=20,
+        concurrency=5,
+        mix={'associate': 1, 'disassociate': 1, 'move': 2},
+        seed=1
+    )
+    assert report['requests'] == 20
+    assert report['outcomes'] == {'success': 20}
+    assert report['misplaced'] == 0
+    # Each client mints one token per request, and the handler decrypts it.
+    assert report['api_calls']['kms:encrypt'] == 1.0
+    assert report['api_calls']['kms:decrypt'] == 1.0
+    assert report['latency_ms']['p95'] >= report['latency_ms']['p50']
+
+
+def test_run_over_socket_with_throttling():
+    report = load.run(
+        instances=10,
+        concurrency=5,
+        ec2_error_rate=0.1,
+        transport='socket',
+        seed=3
+    )
+    assert report['outcomes'] == {'success': 10}
+    assert report['misplaced'] == 0
+    assert report['ec2_throttles'] == report['ec2_retries'] > 0
@@ -0,0 +1,15 @@
+from awseipext.testing import request_benchmark
+
+
+def test_implementations_agree():
+    for event in (request_benchmark.REQUEST, request_benchmark.BATCH_REQUEST):
+        assert request_benchmark.load_with_validator(event) == \
+            request_benchmark.load_with_schema(event)
+
+
+def test_run():
+    results = request_benchmark.run(number=10, repeat=1)
+    assert sorted(results) == ['batch', 'single']
+    for result in results.values():
+        assert result['schema_us'] > 0
+        assert result['validator_us'] > 0